@@ -0,0 +1,97 @@
+from xml.etree.ElementTree import XMLPullParser
+from custom_exceptions import AxlFault
+
+
+def local_name(tag):
+    # Strip the namespace from an element tag
+    return tag.rsplit('}', 1)[-1]
+
+
+def iter_chunks(body, chunk_size):
+    # Accept a whole response body or an iterable of chunks,
+    # EG: response.iter_content()
+    if isinstance(body, (bytes, str)):
+        for i in range(0, len(body), chunk_size):
+            yield body[i:i + chunk_size]
+    else:
+        yield from body
+
+
+def iter_body_events(body, chunk_size=65536):
+    # Incrementally parse a SOAP envelope, yielding (event, path, element)
+    # for everything inside the Body. "path" is a tuple of the local names
+    # below the Body, EG: ("getLineResponse", "return", "line").
+    # Raises AxlFault if the Body holds a SOAP fault
+    parser = XMLPullParser(events=('start', 'end'))
+    stack = []
+    fault = None
+    for chunk in iter_chunks(body, chunk_size):
+        parser.feed(chunk)
+        for event, elem in parser.read_events():
+            if event == 'start':
+                stack.append(local_name(elem.tag))
+            if len(stack) > 2 and stack[1] == 'Body':
+                path = tuple(stack[2:])
+                if path[0] == 'Fault':
+                    if event == 'end' and len(path) == 1:
+                        fault = elem
+                elif fault is None:
+                    yield event, path, elem
+            if event == 'end':
+                stack.pop()
+            if fault is not None:
+                raise AxlFault(format_fault(fault))
+    parser.close()
+
+
+def format_fault(fault):
+    # Build a message from the fault string and any AXL error code
+    values = {}
+    for elem in fault.iter():
+        values.setdefault(local_name(elem.tag), elem.text)
+    return 'AXL fault "{}" code "{}"'.format(
+        values.get('faultstring'), values.get('axlcode')
+    )
+
+
+def parse_axl_response(body, paths):
+    # Pull the text of each of the "/" separated "paths" below the Body,
+    # EG: "getLineResponse/return/line/callForwardAll/destination".
+    # Parsing stops as soon as every path has been found.
+    # Returns a dict of path to text, None for missing or empty elements
+    wanted = dict((tuple(p.split('/')), p) for p in paths)
+    values = dict.fromkeys(paths)
+    for event, path, elem in iter_body_events(body):
+        if event == 'end' and path in wanted:
+            values[wanted.pop(path)] = elem.text or None
+            if not wanted:
+                break
+    return values
+
+
+def iter_axl_rows(body):
+    # Yield each row of an executeSQLQuery response as a dict of column
+    # name to text, each row is discarded once it has been yielded
+    parent = None
+    for event, path, elem in iter_body_events(body):
+        if event == 'start' and path[-1] == 'return' and len(path) == 2:
+            parent = elem
+        elif event == 'end' and len(path) == 3 and path[-1] == 'row':
+            yield dict(
+                (local_name(c.tag), c.text or None) for c in elem
+            )
+            # Drop the row so memory stays flat for large results
+            if parent is not None:
+                parent.remove(elem)
+
+
+def get_axl_fault(body):
+    # Return the fault message of a response, or None if it has no fault
+    try:
+        for _ in iter_body_events(body):
+            pass
+    except AxlFault as e:
+        return str(e)
+    except Exception:
+        return None
+    return None
@@ -0,0 +1,106 @@
+from functools import lru_cache
+from types import MappingProxyType
+from xml.sax.saxutils import escape
+
+
+# The SOAP envelope around every AXL request body
+envelope_prefix = (
+    '<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" '
+    'xmlns:ns="http://www.cisco.com/AXL/API/{0}"><soapenv:Header/><soapenv:Body>'
+)
+
+envelope_suffix = '</soapenv:Body></soapenv:Envelope>'
+
+# The literal parts of each request body, the escaped values are
+# inserted between them in order
+request_parts = {
+    'getLine': (
+        '<ns:getLine><pattern>',
+        '</pattern><routePartitionName>',
+        '</routePartitionName><returnedTags><callForwardAll><destination/>'
+        '</callForwardAll></returnedTags></ns:getLine>'
+    ),
+    'updateLine': (
+        '<ns:updateLine><pattern>',
+        '</pattern><routePartitionName>',
+        '</routePartitionName><callForwardAll><destination>',
+        '</destination></callForwardAll></ns:updateLine>'
+    ),
+    'executeSQLQuery': (
+        '<ns:executeSQLQuery><sql>',
+        '</sql></ns:executeSQLQuery>'
+    ),
+    'executeSQLUpdate': (
+        '<ns:executeSQLUpdate><sql>',
+        '</sql></ns:executeSQLUpdate>'
+    )
+}
+
+# Read the call forward all destination of many lines in one query
+# The where clause is built from one condition per pattern and partition
+get_lines_cfwdall_dest_sql = (
+    "SELECT n.pkid, n.dnorpattern, rp.name AS partition, "
+    "cfd.cfadestination FROM numplan n "
+    "INNER JOIN routepartition rp ON n.fkroutepartition = rp.pkid "
+    "LEFT JOIN callforwarddynamic cfd ON cfd.fknumplan = n.pkid "
+    "WHERE {0}"
+)
+
+get_lines_cfwdall_dest_sql_condition = "(n.dnorpattern = '{0}' AND rp.name = '{1}')"
+
+# Update the call forward all destination of many lines in one statement
+update_lines_cfwdall_dest_sql = (
+    "UPDATE callforwarddynamic SET cfadestination = CASE fknumplan {0} END "
+    "WHERE fknumplan IN ({1})"
+)
+
+update_lines_cfwdall_dest_sql_case = "WHEN '{0}' THEN '{1}'"
+
+
+class AxlRequestBuilder():
+
+    def __init__(self, version):
+        # The AXL schema version, EG: "11.5"
+        self.version = version
+        prefix = envelope_prefix.format(escape(version, {'"': '&quot;'}))
+        # action -> the encoded literal parts, with the envelope folded
+        # into the first and last parts
+        self.templates = {}
+        # action -> the read only http headers
+        self.headers = {}
+        for action, parts in request_parts.items():
+            parts = list(parts)
+            parts[0] = prefix + parts[0]
+            parts[-1] = parts[-1] + envelope_suffix
+            self.templates[action] = tuple(p.encode() for p in parts)
+            self.headers[action] = MappingProxyType({
+                'Content-type': 'text/xml',
+                'SOAPAction': 'CUCM:DB ver={} {}'.format(version, action)
+            })
+
+    def build(self, action, *values):
+        # Returns the headers and the body bytes of an "action" request
+        parts = self.templates[action]
+        body = [parts[0]]
+        for value, part in zip(values, parts[1:]):
+            body.append(escape(str(value)).encode())
+            body.append(part)
+        return self.headers[action], b''.join(body)
+
+    def get_line(self, pattern, partition):
+        return self.build('getLine', pattern, partition)
+
+    def update_line(self, pattern, partition, cfwdall_value):
+        return self.build('updateLine', pattern, partition, cfwdall_value)
+
+    def execute_sql_query(self, sql):
+        return self.build('executeSQLQuery', sql)
+
+    def execute_sql_update(self, sql):
+        return self.build('executeSQLUpdate', sql)
+
+
+@lru_cache(maxsize=None)
+def get_builder(version):
+    # The builders are immutable, one is shared per AXL version
+    return AxlRequestBuilder(version)
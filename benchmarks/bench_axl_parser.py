@@ -0,0 +1,102 @@
+import os
+import sys
+import time
+import tracemalloc
+from json import loads, dumps
+import xmltodict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from axl_parser import parse_axl_response, iter_axl_rows  # noqa: E402
+
+
+envelope = (
+    '<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/">'
+    '<soapenv:Body>{}</soapenv:Body></soapenv:Envelope>'
+)
+
+get_line_response = envelope.format(
+    '<ns:getLineResponse xmlns:ns="http://www.cisco.com/AXL/API/11.5">'
+    '<return><line uuid="{{00000000-0000-0000-0000-000000000000}}">'
+    '<callForwardAll><destination>+447700900123</destination>'
+    '</callForwardAll></line></return></ns:getLineResponse>'
+).encode()
+
+
+def sql_response(rows):
+    row = (
+        '<row><pkid>{0:08d}-0000-0000-0000-000000000000</pkid>'
+        '<dnorpattern>\\+4420781{0:05d}</dnorpattern>'
+        '<partition>PAR_RESOURCES</partition>'
+        '<cfadestination>+4477009{0:05d}</cfadestination></row>'
+    )
+    return envelope.format(
+        '<ns:executeSQLQueryResponse xmlns:ns="http://www.cisco.com/AXL/API/11.5">'
+        '<return>{}</return></ns:executeSQLQueryResponse>'.format(
+            ''.join(row.format(i) for i in range(rows)))
+    ).encode()
+
+
+def xmltodict_get_line(body):
+    # The original getLine approach
+    return (
+        loads(dumps(xmltodict.parse(body)))
+        ['soapenv:Envelope']['soapenv:Body']['ns:getLineResponse']
+        ['return']['line']['callForwardAll']['destination']
+    )
+
+
+def parser_get_line(body):
+    path = 'getLineResponse/return/line/callForwardAll/destination'
+    return parse_axl_response(body, [path])[path]
+
+
+def xmltodict_rows(body):
+    rows = (
+        loads(dumps(xmltodict.parse(body)))
+        ['soapenv:Envelope']['soapenv:Body']['ns:executeSQLQueryResponse']
+        ['return']['row']
+    )
+    return sum(1 for r in rows if r['cfadestination'])
+
+
+def parser_rows(body):
+    return sum(1 for r in iter_axl_rows(body) if r['cfadestination'])
+
+
+def measure(func, body, repeat):
+    # Returns the mean seconds per call and the peak memory of one call
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func(body)
+    elapsed = (time.perf_counter() - start) / repeat
+    tracemalloc.start()
+    func(body)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main():
+    cases = [
+        ('getLine', get_line_response, 2000,
+         xmltodict_get_line, parser_get_line),
+        ('executeSQLQuery 1k rows', sql_response(1000), 10,
+         xmltodict_rows, parser_rows),
+        ('executeSQLQuery 10k rows', sql_response(10000), 3,
+         xmltodict_rows, parser_rows),
+    ]
+    print('{:<26} {:<10} {:>12} {:>12}'.format(
+        'case', 'parser', 'time', 'peak memory'))
+    for name, body, repeat, baseline, candidate in cases:
+        expected = None
+        for label, func in (('xmltodict', baseline), ('streaming', candidate)):
+            result, elapsed, peak = measure(func, body, repeat)
+            if expected is None:
+                expected = result
+            assert result == expected, (label, result, expected)
+            print('{:<26} {:<10} {:>10.1f}us {:>10.1f}KB'.format(
+                name, label, elapsed * 1e6, peak / 1024))
+
+
+if __name__ == '__main__':
+    main()
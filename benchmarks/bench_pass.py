@@ -0,0 +1,539 @@
+import os
+import re
+import sys
+import time
+import random
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import socketserver
+import xml.etree.ElementTree as ET
+from hashlib import sha1
+from json import loads, dumps, dump
+from urllib.parse import urlparse, parse_qs
+from xml.sax.saxutils import escape
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Runs a pass of pd.py against local stand ins for PagerDuty, the Cucm AXL
+# api and the smtp relay, for synthetic configs of increasing size.
+# EG: python benchmarks/bench_pass.py --sizes 10,100 -- --workers 8
+
+
+envelope = (
+    '<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/">'
+    '<soapenv:Body>{}</soapenv:Body></soapenv:Envelope>'
+)
+
+fault = envelope.format(
+    '<soapenv:Fault><faultcode>soapenv:Server</faultcode>'
+    '<faultstring>{}</faultstring></soapenv:Fault>'
+)
+
+sql_condition = re.compile(
+    r"n\.dnorpattern = '((?:[^']|'')*)' AND rp\.name = '((?:[^']|'')*)'"
+)
+sql_case = re.compile(r"WHEN '((?:[^']|'')*)' THEN '((?:[^']|'')*)'")
+
+
+def sql_unquote(value):
+    return value.replace("''", "'")
+
+
+class FakeState():
+
+    def __init__(self, latency=0, error_rate=0, rate_limit=0, seed=1):
+        # Seconds added to every response
+        self.latency = latency
+        # The fraction of requests answered with a 500
+        self.error_rate = error_rate
+        # Requests per second allowed per api token, 0 is unlimited
+        self.rate_limit = rate_limit
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # Token -> (tokens, last refill time)
+        self.buckets = {}
+        # (endpoint, status code) -> count
+        self.requests = {}
+
+    def count(self, endpoint, status_code):
+        with self.lock:
+            key = (endpoint, status_code)
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def take_token(self, token):
+        # A token bucket per api token, returns False when rate limited
+        if not self.rate_limit:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.get(token, (self.rate_limit, now))
+            tokens = min(self.rate_limit, tokens + (now - last) * self.rate_limit)
+            if tokens < 1:
+                self.buckets[token] = (tokens, now)
+                return False
+            self.buckets[token] = (tokens - 1, now)
+            return True
+
+    def fail(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def summary(self):
+        with self.lock:
+            return dict(
+                ('{} {}'.format(*k), v) for k, v in sorted(self.requests.items())
+            )
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # The headers and body are written separately, avoid the delayed ack
+    disable_nagle_algorithm = True
+
+    def reply(self, endpoint, status_code, body, content_type, headers=None):
+        self.server.state.count(endpoint, status_code)
+        body = body.encode()
+        self.send_response(status_code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakePagerDutyHandler(FakeHandler):
+
+    def do_GET(self):
+        state = self.server.state
+        url = urlparse(self.path)
+        endpoint = re.sub(r'/P[0-9A-Z]+', '/{id}', url.path)
+        time.sleep(state.latency)
+        if not state.take_token(self.headers.get('Authorization')):
+            return self.reply(
+                endpoint, 429, '{"error": {"message": "Rate Limit Exceeded"}}',
+                'application/json', {'Retry-After': '1'}
+            )
+        if state.fail():
+            return self.reply(endpoint, 500, '{}', 'application/json')
+        if url.path == '/oncalls':
+            body = self.server.get_on_calls(parse_qs(url.query))
+        else:
+            body = self.server.objects.get(url.path)
+        if body is None:
+            return self.reply(endpoint, 404, '{}', 'application/json')
+        # Support conditional requests like the real api
+        etag = '"{}"'.format(sha1(body.encode()).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            return self.reply(endpoint, 304, '', 'application/json')
+        self.reply(endpoint, 200, body, 'application/json', {'ETag': etag})
+
+
+class FakePagerDuty(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, state):
+        super().__init__(address, FakePagerDutyHandler)
+        self.state = state
+        self.url = 'http://127.0.0.1:{}'.format(self.server_port)
+        # Schedule id -> on call entry
+        self.on_calls = {}
+        # Url path -> json body of the user and contact method objects
+        self.objects = {}
+
+    def add_on_call(self, schedule_id, user_id, country_code, address):
+        contact_path = '/users/{0}/contact_methods/{0}M'.format(user_id)
+        contact = {
+            'id': user_id + 'M', 'type': 'phone_contact_method',
+            'summary': 'Mobile', 'self': self.url + contact_path,
+            'country_code': country_code, 'address': address
+        }
+        reference = dict(
+            (k, contact[k]) for k in ('id', 'summary', 'self')
+        )
+        reference['type'] = 'phone_contact_method_reference'
+        user = {
+            'id': user_id, 'type': 'user', 'name': 'User ' + user_id,
+            'summary': 'User ' + user_id,
+            'self': '{}/users/{}'.format(self.url, user_id),
+            'contact_methods': [reference]
+        }
+        self.objects['/users/' + user_id] = dumps({'user': user})
+        self.objects[contact_path] = dumps({'contact_method': contact})
+        self.on_calls[schedule_id] = {
+            'escalation_level': 1,
+            'schedule': {'id': schedule_id, 'type': 'schedule_reference'},
+            'user': user,
+            'start': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'end': time.strftime(
+                '%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() + 86400))
+        }
+
+    def get_on_calls(self, query):
+        on_calls = [
+            self.on_calls[s] for s in query.get('schedule_ids[]', [])
+            if s in self.on_calls
+        ]
+        if 'users' not in query.get('include[]', []):
+            on_calls = [
+                dict(o, user=dict(
+                    (k, o['user'][k]) for k in ('id', 'summary', 'self')))
+                for o in on_calls
+            ]
+        limit = int(query.get('limit', ['25'])[0])
+        offset = int(query.get('offset', ['0'])[0])
+        return dumps({
+            'oncalls': on_calls[offset:offset + limit],
+            'limit': limit, 'offset': offset,
+            'more': offset + limit < len(on_calls)
+        })
+
+
+class FakeAxlHandler(FakeHandler):
+
+    def do_GET(self):
+        # The AXL status page used as a health check
+        self.reply('GET', 200, 'Cisco CallManager: AXL Web Service', 'text/html')
+
+    def do_POST(self):
+        state = self.server.state
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        action = self.headers.get('SOAPAction', '').split(' ')[-1]
+        time.sleep(state.latency)
+        if state.fail():
+            return self.reply(
+                action, 500, fault.format('Simulated failure'), 'text/xml')
+        request = {}
+        for element in ET.fromstring(body).iter():
+            request[element.tag.split('}')[-1]] = element.text
+        lines = self.server.lines.setdefault(self.path, {})
+        if action == 'executeSQLQuery':
+            rows = []
+            for pattern, partition in sql_condition.findall(request['sql']):
+                line = lines.get((sql_unquote(pattern), sql_unquote(partition)))
+                if line is None:
+                    continue
+                rows.append(
+                    '<row><pkid>{}</pkid><dnorpattern>{}</dnorpattern>'
+                    '<partition>{}</partition><cfadestination>{}</cfadestination>'
+                    '</row>'.format(*(escape(v) for v in (
+                        line['pkid'], line['pattern'], line['partition'],
+                        line['destination'])))
+                )
+            return self.reply(action, 200, envelope.format(
+                '<ns:executeSQLQueryResponse xmlns:ns="http://www.cisco.com/AXL/API/11.5">'
+                '<return>{}</return></ns:executeSQLQueryResponse>'.format(
+                    ''.join(rows))
+            ), 'text/xml')
+        if action == 'executeSQLUpdate':
+            by_pkid = dict((l['pkid'], l) for l in lines.values())
+            updated = 0
+            for pkid, destination in sql_case.findall(request['sql']):
+                if sql_unquote(pkid) in by_pkid:
+                    by_pkid[sql_unquote(pkid)]['destination'] = \
+                        sql_unquote(destination)
+                    updated += 1
+            return self.reply(action, 200, envelope.format(
+                '<ns:executeSQLUpdateResponse xmlns:ns="http://www.cisco.com/AXL/API/11.5">'
+                '<return><rowsUpdated>{}</rowsUpdated></return>'
+                '</ns:executeSQLUpdateResponse>'.format(updated)
+            ), 'text/xml')
+        line = lines.get((request.get('pattern'), request.get('routePartitionName')))
+        if line is None:
+            return self.reply(
+                action, 500, fault.format('Item not valid'), 'text/xml')
+        if action == 'getLine':
+            return self.reply(action, 200, envelope.format(
+                '<ns:getLineResponse xmlns:ns="http://www.cisco.com/AXL/API/11.5">'
+                '<return><line uuid="{{{}}}"><callForwardAll><destination>{}'
+                '</destination></callForwardAll></line></return>'
+                '</ns:getLineResponse>'.format(
+                    escape(line['pkid']), escape(line['destination']))
+            ), 'text/xml')
+        if action == 'updateLine':
+            line['destination'] = request.get('destination') or ''
+            return self.reply(action, 200, envelope.format(
+                '<ns:updateLineResponse xmlns:ns="http://www.cisco.com/AXL/API/11.5">'
+                '<return>{{{}}}</return></ns:updateLineResponse>'.format(
+                    escape(line['pkid']))
+            ), 'text/xml')
+        self.reply(action, 500, fault.format('Unknown request'), 'text/xml')
+
+
+class FakeAxl(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, state):
+        super().__init__(address, FakeAxlHandler)
+        self.state = state
+        self.url = 'http://127.0.0.1:{}'.format(self.server_port)
+        # Url path -> (pattern, partition) -> line
+        self.lines = {}
+
+    def add_line(self, path, pattern, partition, destination):
+        lines = self.lines.setdefault(path, {})
+        lines[(pattern, partition)] = {
+            'pkid': '{:08x}-0000-0000-0000-{:012x}'.format(
+                len(lines), len(self.lines)),
+            'pattern': pattern, 'partition': partition,
+            'destination': destination
+        }
+
+
+class SmtpSinkHandler(socketserver.StreamRequestHandler):
+
+    def write(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.write('220 localhost ESMTP')
+        for line in self.rfile:
+            command = line.decode(errors='replace').strip().upper()
+            if command.startswith('DATA'):
+                self.write('354 End data with <CR><LF>.<CR><LF>')
+                size = 0
+                for data in self.rfile:
+                    if data in (b'.\r\n', b'.\n'):
+                        break
+                    size += len(data)
+                self.server.received(size)
+                self.write('250 OK')
+            elif command.startswith('QUIT'):
+                self.write('221 Bye')
+                return
+            elif command.startswith('EHLO'):
+                self.write('250 localhost')
+            else:
+                self.write('250 OK')
+
+
+class SmtpSink(socketserver.ThreadingTCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        super().__init__(address, SmtpSinkHandler)
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.bytes = 0
+
+    def received(self, size):
+        with self.lock:
+            self.messages += 1
+            self.bytes += size
+
+
+def start(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def generate_config(directory, schedules, pd, axl):
+    # Write a schedule_data.json and cucm.json with "schedules" schedules,
+    # each with a pilot line on both clusters, and populate the fakes.
+    # Every pilot line starts forwarded to a stale number
+    cucm = {
+        '1': {
+            'cucm_axl_url': axl.url + '/axl/us/', 'axl_user': 'user',
+            'axl_pass': 'pass', 'cucm_ver': '11.5'
+        },
+        '44': {
+            'cucm_axl_url': axl.url + '/axl/uk/', 'axl_user': 'user',
+            'axl_pass': 'pass', 'cucm_ver': '11.5'
+        }
+    }
+    regex = {'1': r'^(?:\+1|91)?(\d+)$', '44': r'^(?:\+44|90)?(\d+)$'}
+    data = {}
+    for i in range(schedules):
+        schedule_id = 'P{:06d}'.format(i)
+        numbers = {}
+        for cc, number in (('1', '+1303{:07d}'), ('44', '+4420{:08d}')):
+            number = number.format(i)
+            numbers[cc] = {
+                'on_call_number': number,
+                'on_call_partition': 'PAR_RESOURCES',
+                'regex': regex[cc]
+            }
+            axl.add_line(
+                urlparse(cucm[cc]['cucm_axl_url']).path,
+                '\\' + number, 'PAR_RESOURCES', '+{}0000000000'.format(cc)
+            )
+        data[schedule_id] = {
+            'pd_summary': 'Schedule {}'.format(i),
+            'mail_rcpt': ['team{}@example.com'.format(i % 20)],
+            'pd_api_host': pd.url,
+            'pd_api_headers': {
+                'Accept': 'application/vnd.pagerduty+json;version=2',
+                'Authorization': 'Token token=token{}'.format(i % 5)
+            },
+            'contact_method': 'Mobile',
+            'numbers': {'country_code': numbers}
+        }
+        cc = 44 if i % 2 else 1
+        pd.add_on_call(
+            schedule_id, 'PU{:06d}'.format(i), cc,
+            '7700{:06d}'.format(i) if cc == 44 else '555{:07d}'.format(i)
+        )
+    paths = {
+        'data': os.path.join(directory, 'schedule_data.json'),
+        'cucm': os.path.join(directory, 'cucm.json')
+    }
+    with open(paths['data'], 'w') as f:
+        dump(data, f)
+    with open(paths['cucm'], 'w') as f:
+        dump(cucm, f)
+    return paths
+
+
+def run_main(directory, paths, smtp, pd_args):
+    # Run one pass of pd.py in a child process, returns the wall clock
+    # seconds, the peak rss in KB and the per stage metrics summary
+    metrics_path = os.path.join(directory, 'metrics.json')
+    command = [
+        sys.executable, os.path.join(root, 'pd.py'),
+        '--data-file', paths['data'], '--cucm-file', paths['cucm'],
+        '--log-file', os.path.join(directory, 'PagerDutyOnCall.log'),
+        '--state-file', os.path.join(directory, 'PagerDutyOnCall.db'),
+        '--cache-file', os.path.join(directory, 'PagerDutyCache.json'),
+        '--smtp-host', '127.0.0.1', '--smtp-port', str(smtp.server_address[1]),
+        '--metrics-json', metrics_path
+    ] + pd_args
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError('pd.py exited with {}'.format(process.returncode))
+    with open(metrics_path) as f:
+        metrics = loads(f.read())
+    return elapsed, usage.ru_maxrss, metrics
+
+
+def run_case(schedules, args):
+    state = FakeState(args.latency, args.error_rate, args.rate_limit)
+    pd = start(FakePagerDuty(('127.0.0.1', 0), state))
+    axl = start(FakeAxl(('127.0.0.1', 0), FakeState(
+        args.latency, args.error_rate)))
+    smtp = start(SmtpSink(('127.0.0.1', 0)))
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            paths = generate_config(directory, schedules, pd, axl)
+            # The first pass changes every pilot line, later passes find
+            # nothing has changed
+            for n in range(args.passes):
+                before = (pd.state.summary(), axl.state.summary())
+                elapsed, peak_rss, metrics = run_main(
+                    directory, paths, smtp, args.pd_args)
+                after = (pd.state.summary(), axl.state.summary())
+                results.append({
+                    'schedules': schedules,
+                    'pass': n + 1,
+                    'seconds': round(elapsed, 3),
+                    'peak_rss_kb': peak_rss,
+                    'pagerduty_requests': delta(before[0], after[0]),
+                    'axl_requests': delta(before[1], after[1]),
+                    'stages': metrics['stages']
+                })
+                print('{:>8} {:>5} {:>10.2f}s {:>8} {:>8} {:>10}KB'.format(
+                    schedules, n + 1, elapsed,
+                    sum(results[-1]['pagerduty_requests'].values()),
+                    sum(results[-1]['axl_requests'].values()), peak_rss))
+    finally:
+        for server in (pd, axl, smtp):
+            server.shutdown()
+            server.server_close()
+    results[-1]['emails'] = smtp.messages
+    return results
+
+
+def delta(before, after):
+    return dict(
+        (k, v - before.get(k, 0)) for k, v in after.items()
+        if v - before.get(k, 0)
+    )
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=root,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark pd.py passes against local fake services'
+    )
+    parser.add_argument(
+        '--sizes', default='10,100,10000',
+        help='Comma separated numbers of schedules to benchmark'
+    )
+    parser.add_argument(
+        '--passes', type=int, default=2,
+        help='Passes to run per size, the first one is cold'
+    )
+    parser.add_argument(
+        '--latency', type=float, default=0,
+        help='Seconds added to every fake PagerDuty and AXL response'
+    )
+    parser.add_argument(
+        '--error-rate', type=float, default=0,
+        help='Fraction of fake responses that are server errors'
+    )
+    parser.add_argument(
+        '--rate-limit', type=float, default=0,
+        help='Fake PagerDuty requests per second per token, 0 is unlimited'
+    )
+    parser.add_argument(
+        '--output', default='bench_pass_results.json',
+        help='Path of the JSON results file'
+    )
+    parser.add_argument(
+        'pd_args', nargs=argparse.REMAINDER,
+        help='Arguments passed on to pd.py after "--"'
+    )
+    args = parser.parse_args(argv)
+    if args.pd_args[:1] == ['--']:
+        args.pd_args = args.pd_args[1:]
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    print('{:>8} {:>5} {:>11} {:>8} {:>8} {:>12}'.format(
+        'size', 'pass', 'time', 'pd reqs', 'axl reqs', 'peak rss'))
+    results = []
+    for size in args.sizes.split(','):
+        results.extend(run_case(int(size), args))
+    with open(args.output, 'w') as f:
+        dump({
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'settings': {
+                'latency': args.latency, 'error_rate': args.error_rate,
+                'rate_limit': args.rate_limit, 'pd_args': args.pd_args
+            },
+            'results': results
+        }, f, indent=2)
+    print('Results written to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
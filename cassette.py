@@ -0,0 +1,214 @@
+import time
+import threading
+import logging
+from base64 import b64encode, b64decode
+from collections import deque
+from datetime import timedelta
+from hashlib import sha1
+from json import loads, dumps
+from requests import Response, ConnectionError
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+
+# Header values which are replaced before anything is written
+redacted_headers = frozenset([
+    'authorization', 'proxy-authorization', 'cookie', 'set-cookie'
+])
+
+redacted = 'REDACTED'
+
+
+def redact_headers(headers):
+    return dict(
+        (k, redacted if k.lower() in redacted_headers else v)
+        for k, v in headers.items()
+    )
+
+
+def encode_body(body):
+    # Bodies are stored as text when possible, otherwise as base64
+    if body is None:
+        return None, None
+    if isinstance(body, str):
+        return body, 'text'
+    try:
+        return body.decode('utf-8'), 'text'
+    except UnicodeDecodeError:
+        return b64encode(body).decode(), 'base64'
+
+
+def decode_body(body, encoding):
+    if body is None:
+        return b''
+    if encoding == 'base64':
+        return b64decode(body)
+    return body.encode('utf-8')
+
+
+def body_digest(body):
+    if body is None:
+        return None
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    return sha1(body).hexdigest()
+
+
+class CassetteRecorder():
+
+    def __init__(self, path):
+        # The JSONL file every exchange is appended to
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, 'a')
+        self.recorded = 0
+
+    def record(self, request, response, elapsed):
+        request_body, request_encoding = encode_body(request.body)
+        response_body, response_encoding = encode_body(response.content)
+        line = dumps({
+            'method': request.method,
+            'url': request.url,
+            'request_headers': redact_headers(request.headers),
+            'request_body': request_body,
+            'request_encoding': request_encoding,
+            'request_digest': body_digest(request.body),
+            'status_code': response.status_code,
+            'reason': response.reason,
+            'response_headers': redact_headers(response.headers),
+            'response_body': response_body,
+            'response_encoding': response_encoding,
+            'elapsed': elapsed
+        })
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+            self.recorded += 1
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def summary(self):
+        return 'Requests recorded: {}'.format(self.recorded)
+
+
+class RecordingAdapter(BaseAdapter):
+
+    def __init__(self, adapter, recorder):
+        super().__init__()
+        # The adapter which really sends the requests
+        self.adapter = adapter
+        self.recorder = recorder
+
+    def send(self, request, **kwargs):
+        start = time.monotonic()
+        response = self.adapter.send(request, **kwargs)
+        # Read the body now so it can be recorded, it stays on the response
+        response.content
+        self.recorder.record(request, response, time.monotonic() - start)
+        return response
+
+    def close(self):
+        self.adapter.close()
+
+
+class Cassette():
+
+    def __init__(self, path, speed=0):
+        # Replay the responses taking "elapsed / speed" seconds each,
+        # a speed of 0 replays them without any delay
+        self.speed = speed
+        self.lock = threading.Lock()
+        # (method, url, request digest) -> deque of recorded exchanges,
+        # repeated requests get their responses in the recorded order
+        self.exchanges = {}
+        # (method, url) -> deque, used when the request body differs
+        self.by_url = {}
+        self.replayed = 0
+        self.missed = 0
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                exchange = loads(line)
+                key = (exchange['method'], exchange['url'])
+                self.exchanges.setdefault(
+                    key + (exchange['request_digest'],), deque()
+                ).append(exchange)
+                self.by_url.setdefault(key, deque()).append(exchange)
+
+    def take(self, request):
+        # Return the next recorded exchange matching "request", or None
+        key = (request.method, request.url)
+        with self.lock:
+            exchanges = self.exchanges.get(key + (body_digest(request.body),))
+            if not exchanges:
+                exchanges = self.by_url.get(key)
+            if not exchanges:
+                self.missed += 1
+                return None
+            exchange = exchanges.popleft()
+            # Keep the last response so repeated passes can replay it
+            if not exchanges:
+                exchanges.append(exchange)
+            self.replayed += 1
+            return exchange
+
+    def summary(self):
+        return 'Requests replayed: {}, not recorded: {}'.format(
+            self.replayed, self.missed
+        )
+
+
+class ReplayAdapter(BaseAdapter):
+
+    def __init__(self, cassette):
+        super().__init__()
+        self.cassette = cassette
+        self.logger = logging.getLogger('on_call_forward')
+
+    def send(self, request, **kwargs):
+        exchange = self.cassette.take(request)
+        if exchange is None:
+            self.logger.error('No recorded response for {} {}'.format(
+                request.method, request.url))
+            raise ConnectionError(
+                'No recorded response for {} {}'.format(
+                    request.method, request.url),
+                request=request
+            )
+        if self.cassette.speed:
+            time.sleep(exchange['elapsed'] / self.cassette.speed)
+        response = Response()
+        response.status_code = exchange['status_code']
+        response.reason = exchange['reason']
+        response.headers = CaseInsensitiveDict(exchange['response_headers'])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = decode_body(
+            exchange['response_body'], exchange['response_encoding']
+        )
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        response.elapsed = timedelta(seconds=exchange['elapsed'])
+        return response
+
+    def close(self):
+        pass
+
+
+def record_session(session, recorder):
+    # Record every request "session" sends through its mounted adapters
+    for prefix in ('https://', 'http://'):
+        session.mount(
+            prefix, RecordingAdapter(session.get_adapter(prefix), recorder)
+        )
+
+
+def replay_session(session, cassette):
+    # Answer every request "session" sends from the cassette
+    adapter = ReplayAdapter(cassette)
+    for prefix in ('https://', 'http://'):
+        session.mount(prefix, adapter)
@@ -0,0 +1,283 @@
+import time
+import threading
+import logging
+from urllib.parse import urlsplit
+from requests.adapters import BaseAdapter
+from custom_exceptions import UpstreamUnavailable
+from metrics import Metrics
+
+
+# PagerDuty answers errors with 5xx statuses
+pd_failure_statuses = frozenset([500, 502, 503, 504])
+
+# AXL returns a SOAP fault with a 500 for a bad request, only the
+# gateway and unavailable statuses mean the cluster is down
+axl_failure_statuses = frozenset([502, 503, 504])
+
+
+def upstream_key(url):
+    # The scheme and host of "url", EG: "https://api.pagerduty.com"
+    parts = urlsplit(url)
+    return '{}://{}'.format(parts.scheme, parts.netloc)
+
+
+def get_upstreams(config, schedule_id):
+    # The PagerDuty host and the AXL urls "schedule_id" depends on
+    schedule = config.schedules[schedule_id]
+    upstreams = [upstream_key(schedule.pd_api_host)]
+    for number_data in schedule.numbers.values():
+        cluster = config.clusters.get(number_data.country_code)
+        if cluster is not None and cluster.cucm_axl_url not in upstreams:
+            upstreams.append(cluster.cucm_axl_url)
+    return upstreams
+
+
+def get_dependent_schedules(config, upstream):
+    # The schedules which depend on "upstream"
+    return [
+        s for s in config.schedules.values()
+        if upstream in get_upstreams(config, s.schedule_id)
+    ]
+
+
+class CircuitBreaker():
+
+    def __init__(
+        self, failure_threshold=5, reset_timeout=30, clock=time.monotonic
+    ):
+        # Consecutive failures which open the breaker
+        self.failure_threshold = failure_threshold
+        # Seconds the breaker stays open before one probe request is sent
+        self.reset_timeout = reset_timeout
+        # Returns the current time in seconds, replaceable for testing
+        self.clock = clock
+        # "closed", "open" or "half-open"
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0
+        # Whether the half open probe request is in flight
+        self.probing = False
+        self.lock = threading.Lock()
+        # The current outage, the wall clock time it started, the last
+        # error, the requests failed fast and the schedules it failed
+        self.outage_started = None
+        self.last_error = None
+        self.outage_rejected = 0
+        self.affected = []
+        # Counters for the run summary
+        self.outages = 0
+        self.rejected = 0
+
+    def allow(self):
+        # Returns True if a request may be sent, its outcome must then be
+        # passed to "success" or "failure"
+        with self.lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' \
+                    and self.clock() - self.opened_at >= self.reset_timeout:
+                self.state = 'half-open'
+            if self.state == 'half-open' and not self.probing:
+                self.probing = True
+                return True
+            self.rejected += 1
+            self.outage_rejected += 1
+            return False
+
+    def success(self):
+        # Returns the ended outage as (seconds, requests failed fast,
+        # affected schedules) if this closed the breaker, otherwise None
+        with self.lock:
+            self.failures = 0
+            self.probing = False
+            if self.state == 'closed':
+                return None
+            self.state = 'closed'
+            outage = (
+                time.time() - self.outage_started, self.outage_rejected,
+                list(self.affected)
+            )
+            self.outage_started = None
+            self.outage_rejected = 0
+            self.affected = []
+            return outage
+
+    def failure(self, error):
+        # Returns True if this opened the breaker on a new outage, a
+        # failed probe reopens it on the same outage
+        with self.lock:
+            self.failures += 1
+            self.last_error = error
+            if self.state == 'half-open':
+                self.state = 'open'
+                self.opened_at = self.clock()
+                self.probing = False
+                return False
+            if self.state == 'closed' \
+                    and self.failures >= self.failure_threshold:
+                self.state = 'open'
+                self.opened_at = self.clock()
+                self.outage_started = time.time()
+                self.outages += 1
+                return True
+            return False
+
+    def restore(self, started):
+        # Resume an outage which started in an earlier run, the next
+        # request is sent as a probe
+        with self.lock:
+            self.state = 'open'
+            self.opened_at = self.clock() - self.reset_timeout
+            self.outage_started = started
+
+    def add_affected(self, name):
+        with self.lock:
+            if self.state != 'closed' and name not in self.affected:
+                self.affected.append(name)
+
+
+class CircuitBreakers():
+
+    def __init__(
+        self, failure_threshold=5, reset_timeout=30, on_open=None,
+        on_close=None, metrics=None, clock=time.monotonic
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        # Called with (upstream, start time, error) when an outage starts,
+        # and with (upstream, seconds, requests failed fast, affected
+        # schedules) when it ends
+        self.on_open = on_open
+        self.on_close = on_close
+        self.metrics = metrics or Metrics()
+        # upstream -> CircuitBreaker
+        self.breakers = {}
+        # Protect the creation of breakers across threads
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger('on_call_forward')
+
+    def restore(self, outages):
+        # Resume the outages of an earlier run, upstream -> start time
+        for upstream, started in outages.items():
+            self.get(upstream).restore(started)
+
+    def get(self, upstream):
+        with self.lock:
+            if upstream not in self.breakers:
+                self.breakers[upstream] = CircuitBreaker(
+                    self.failure_threshold, self.reset_timeout, self.clock)
+            return self.breakers[upstream]
+
+    def get_upstream(self, url):
+        # The breaker of a request to "url", the AXL breakers are keyed
+        # by the full url and the PagerDuty ones by host
+        with self.lock:
+            if url in self.breakers:
+                return url
+        return upstream_key(url)
+
+    def is_open(self, upstream):
+        # True while "upstream" is failing, half open included
+        with self.lock:
+            breaker = self.breakers.get(upstream)
+        return breaker is not None and breaker.state != 'closed'
+
+    def allow(self, upstream):
+        if self.get(upstream).allow():
+            return True
+        self.metrics.increment('circuit_rejected_total', upstream=upstream)
+        return False
+
+    def success(self, upstream):
+        outage = self.get(upstream).success()
+        if outage is None:
+            return
+        seconds, rejected, affected = outage
+        self.logger.info(
+            '"{}" is available again after {:.0f}s, {} requests failed fast'.format(
+                upstream, seconds, rejected)
+        )
+        if self.on_close is not None:
+            self.on_close(upstream, seconds, rejected, affected)
+
+    def failure(self, upstream, error):
+        breaker = self.get(upstream)
+        if not breaker.failure(error):
+            return
+        self.metrics.increment('circuit_opened_total', upstream=upstream)
+        self.logger.error(
+            'Circuit breaker of "{}" opened after {} failures, last error: {}'.format(
+                upstream, self.failure_threshold, error)
+        )
+        if self.on_open is not None:
+            self.on_open(upstream, breaker.outage_started, error)
+
+    def add_affected(self, upstream, name):
+        # Note a schedule which failed during the outage of "upstream"
+        self.get(upstream).add_affected(name)
+
+    def summary(self):
+        with self.lock:
+            breakers = list(self.breakers.items())
+        return 'Upstreams: {}, open: {}, outages: {}, requests failed fast: {}'.format(
+            len(breakers),
+            ', '.join(k for k, b in breakers if b.state != 'closed') or 'none',
+            sum(b.outages for _, b in breakers),
+            sum(b.rejected for _, b in breakers)
+        )
+
+
+class BreakerAdapter(BaseAdapter):
+
+    def __init__(
+        self, adapter, breakers, upstream=None, timeout=None,
+        failure_statuses=pd_failure_statuses
+    ):
+        super().__init__()
+        # The adapter which really sends the requests
+        self.adapter = adapter
+        self.breakers = breakers
+        # The breaker used for every request, None keys them by host
+        self.upstream = upstream
+        # The (connect, read) timeout of requests sent without one
+        self.timeout = timeout
+        self.failure_statuses = failure_statuses
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        upstream = self.upstream or upstream_key(request.url)
+        if not self.breakers.allow(upstream):
+            raise UpstreamUnavailable(
+                'The circuit breaker of "{}" is open'.format(upstream),
+                request=request
+            )
+        try:
+            response = self.adapter.send(request, **kwargs)
+        except Exception as e:
+            self.breakers.failure(upstream, repr(e))
+            raise
+        if response.status_code in self.failure_statuses:
+            self.breakers.failure(upstream, 'HTTP {} {}'.format(
+                response.status_code, response.reason))
+        else:
+            self.breakers.success(upstream)
+        return response
+
+    def close(self):
+        self.adapter.close()
+
+
+def protect_session(
+    session, breakers, upstream=None, timeout=None,
+    failure_statuses=pd_failure_statuses
+):
+    # Send every request of "session" through the breaker of its upstream
+    for prefix in ('https://', 'http://'):
+        adapter = session.get_adapter(prefix)
+        # Replace rather than stack the breaker of an earlier run
+        if isinstance(adapter, BreakerAdapter):
+            adapter = adapter.adapter
+        session.mount(prefix, BreakerAdapter(
+            adapter, breakers, upstream, timeout, failure_statuses))
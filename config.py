@@ -0,0 +1,236 @@
+import logging
+import os
+import re
+import threading
+from collections import namedtuple
+from json import loads
+from types import MappingProxyType
+from custom_exceptions import ConfigError
+from normalize import compile_regex
+
+
+# The pilot line of a schedule for one country code, "pattern" is the
+# on call number escaped for AXL, EG: "\+442078184888"
+NumberData = namedtuple('NumberData', [
+    'country_code', 'on_call_number', 'on_call_partition', 'regex', 'pattern'
+])
+
+# A schedule from schedule_data.json, "numbers" maps the integer
+# country code to its NumberData
+Schedule = namedtuple('Schedule', [
+    'schedule_id', 'pd_summary', 'mail_rcpt', 'pd_api_host',
+    'pd_api_headers', 'contact_method', 'numbers'
+])
+
+# A Cucm cluster from cucm.json, "axl_max_concurrency" is the optional
+# number of concurrent AXL requests the cluster accepts
+Cluster = namedtuple('Cluster', [
+    'country_code', 'cucm_axl_url', 'axl_user', 'axl_pass', 'cucm_ver',
+    'axl_max_concurrency'
+], defaults=(None,))
+
+# The compiled configuration and its indexes
+Config = namedtuple('Config', [
+    # schedule id -> Schedule
+    'schedules',
+    # integer country code -> Cluster
+    'clusters',
+    # cucm_axl_url -> Cluster
+    'clusters_by_url',
+    # cucm_axl_url -> tuple of (pattern, partition)
+    'lines_by_cluster',
+    # (cucm_axl_url, pattern, partition) -> tuple of schedule ids
+    'schedules_by_line'
+])
+
+schedule_keys = (
+    'pd_summary', 'mail_rcpt', 'pd_api_host', 'pd_api_headers',
+    'contact_method', 'numbers'
+)
+number_keys = ('on_call_number', 'on_call_partition', 'regex')
+cluster_keys = ('cucm_axl_url', 'axl_user', 'axl_pass', 'cucm_ver')
+
+
+def check_keys(value, keys, name):
+    if not isinstance(value, dict):
+        raise ConfigError('{} is not an object'.format(name))
+    missing = [k for k in keys if k not in value]
+    if missing:
+        raise ConfigError('{} is missing {}'.format(name, ', '.join(missing)))
+
+
+def parse_country_code(value, name):
+    try:
+        return int(value)
+    except ValueError:
+        raise ConfigError(
+            '{} has an invalid country code "{}"'.format(name, value))
+
+
+def parse_concurrency(value, name):
+    if value is None:
+        return None
+    try:
+        concurrency = int(value)
+    except (TypeError, ValueError):
+        concurrency = 0
+    if concurrency < 1:
+        raise ConfigError(
+            '{} has an invalid axl_max_concurrency "{}"'.format(name, value))
+    return concurrency
+
+
+def get_on_call_pattern(on_call_number):
+    # Check if the number starts with '+' and prepend '\\'
+    on_call_number = str(on_call_number)
+    if on_call_number.startswith('+'):
+        return '\\' + on_call_number
+    return on_call_number
+
+
+def compile_number_data(country_code, number_data, name):
+    check_keys(number_data, number_keys, name)
+    try:
+        regex = compile_regex(number_data['regex'])
+    except re.error as e:
+        raise ConfigError('{} has an invalid regex: {}'.format(name, e))
+    if regex.groups < 1:
+        raise ConfigError('{} regex has no capture group'.format(name))
+    return NumberData(
+        country_code, str(number_data['on_call_number']),
+        number_data['on_call_partition'], number_data['regex'],
+        get_on_call_pattern(number_data['on_call_number'])
+    )
+
+
+def compile_schedule(schedule_id, schedule):
+    name = 'Schedule "{}"'.format(schedule_id)
+    check_keys(schedule, schedule_keys, name)
+    mail_rcpt = schedule['mail_rcpt']
+    # A single string would become a tuple of its characters
+    if not isinstance(mail_rcpt, list) \
+            or not all(isinstance(r, str) for r in mail_rcpt):
+        raise ConfigError('{} mail_rcpt is not a list of addresses'.format(name))
+    check_keys(schedule['numbers'], ('country_code',), name + ' numbers')
+    if not isinstance(schedule['numbers']['country_code'], dict):
+        raise ConfigError('{} numbers country_code is not an object'.format(name))
+    numbers = {}
+    for cc, number_data in schedule['numbers']['country_code'].items():
+        country_code = parse_country_code(cc, name)
+        numbers[country_code] = compile_number_data(
+            country_code, number_data,
+            '{} country code "{}"'.format(name, cc)
+        )
+    return Schedule(
+        schedule_id, schedule['pd_summary'], tuple(mail_rcpt),
+        schedule['pd_api_host'],
+        MappingProxyType(dict(schedule['pd_api_headers'])),
+        schedule['contact_method'], MappingProxyType(numbers)
+    )
+
+
+def compile_config(data, cucm_data):
+    # Validate the raw schedule and cucm data and compile them into
+    # immutable records with their indexes, raises ConfigError
+    if not isinstance(data, dict) or not isinstance(cucm_data, dict):
+        raise ConfigError('The schedule and cucm data must be objects')
+    clusters = {}
+    for cc, cluster in cucm_data.items():
+        name = 'Cucm cluster "{}"'.format(cc)
+        check_keys(cluster, cluster_keys, name)
+        country_code = parse_country_code(cc, name)
+        clusters[country_code] = Cluster(
+            country_code, *(str(cluster[k]) for k in cluster_keys),
+            axl_max_concurrency=parse_concurrency(
+                cluster.get('axl_max_concurrency'), name)
+        )
+    clusters_by_url = dict((c.cucm_axl_url, c) for c in clusters.values())
+
+    schedules = {}
+    lines_by_cluster = {}
+    schedules_by_line = {}
+    for schedule_id, schedule in data.items():
+        schedule = compile_schedule(schedule_id, schedule)
+        schedules[schedule_id] = schedule
+        for number_data in schedule.numbers.values():
+            cluster = clusters.get(number_data.country_code)
+            if cluster is None:
+                continue
+            line = (number_data.pattern, number_data.on_call_partition)
+            lines_by_cluster.setdefault(cluster.cucm_axl_url, set()).add(line)
+            schedules_by_line.setdefault(
+                (cluster.cucm_axl_url,) + line, []).append(schedule_id)
+
+    return Config(
+        MappingProxyType(schedules),
+        MappingProxyType(clusters),
+        MappingProxyType(clusters_by_url),
+        MappingProxyType(dict(
+            (url, tuple(sorted(lines)))
+            for url, lines in lines_by_cluster.items()
+        )),
+        MappingProxyType(dict(
+            (line, tuple(ids)) for line, ids in schedules_by_line.items()
+        ))
+    )
+
+
+def get_lines_by_cluster(config, schedule_ids=None):
+    # Return cucm_axl_url -> tuple of (pattern, partition) for the pilot
+    # lines of "schedule_ids", or for every schedule if None
+    if schedule_ids is None:
+        return config.lines_by_cluster
+    lines_by_cluster = {}
+    for schedule_id in schedule_ids:
+        for number_data in config.schedules[schedule_id].numbers.values():
+            cluster = config.clusters.get(number_data.country_code)
+            if cluster is not None:
+                lines_by_cluster.setdefault(cluster.cucm_axl_url, set()).add(
+                    (number_data.pattern, number_data.on_call_partition))
+    return dict(
+        (url, tuple(sorted(lines))) for url, lines in lines_by_cluster.items()
+    )
+
+
+def load_config(data_path, cucm_path):
+    try:
+        data = loads(open(data_path, 'r').read())
+        cucm_data = loads(open(cucm_path, 'r').read())
+    except ValueError as e:
+        raise ConfigError('Invalid json in the config files: {}'.format(e))
+    return compile_config(data, cucm_data)
+
+
+class ConfigLoader():
+
+    def __init__(self, data_path, cucm_path):
+        # The paths of schedule_data.json and cucm.json
+        self.data_path = data_path
+        self.cucm_path = cucm_path
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger('on_call_forward')
+        # Load the files now so a bad config fails at startup
+        self.mtimes = self.get_mtimes()
+        self.config = load_config(data_path, cucm_path)
+
+    def get_mtimes(self):
+        return (
+            os.stat(self.data_path).st_mtime_ns,
+            os.stat(self.cucm_path).st_mtime_ns
+        )
+
+    def get(self):
+        # Return the current config, reloading it if either file changed.
+        # A config which fails validation is logged and the previous
+        # config is kept
+        with self.lock:
+            mtimes = self.get_mtimes()
+            if mtimes != self.mtimes:
+                self.mtimes = mtimes
+                try:
+                    self.config = load_config(self.data_path, self.cucm_path)
+                    self.logger.info('Reloaded the changed config files')
+                except ConfigError as e:
+                    self.logger.error(
+                        'Keeping the previous config, the changed config is invalid: {}'.format(e))
+            return self.config
@@ -1,7 +1,15 @@
-from headers import get_line_headers, update_line_headers
-from requests import Session
-from xml_messages import get_line_cfwdall_dest_xml, \
-    update_line_cfwdall_dest_xml
+from axl_parser import iter_axl_rows, parse_axl_response
+from axl_request import get_builder, get_lines_cfwdall_dest_sql, \
+    get_lines_cfwdall_dest_sql_condition, update_lines_cfwdall_dest_sql, \
+    update_lines_cfwdall_dest_sql_case
+from requests import Session, RequestException
+from custom_exceptions import CucmCallFwdAllRetrieveError, \
+    CucmSetCallFwdAllError
+
+
+def sql_quote(value):
+    # Escape single quotes for an informix string literal
+    return str(value).replace("'", "''")
 
 
 class Cucm(Session):
@@ -14,26 +22,110 @@ class Cucm(Session):
         for k, v in kwargs.items():
             setattr(self, k, str(v))
         self.auth = (self.axl_user, self.axl_pass)
+        # The precompiled requests of our AXL version
+        self.builder = get_builder(self.cucm_ver)
 
     def make_request(self, headers, message):
-        self.headers = headers
+        # The headers are passed per request so that the session can be
+        # shared across threads
         return self.post(
             url=self.cucm_axl_url, headers=headers,
             data=message
         )
 
+    def is_healthy(self, timeout=10):
+        # A GET on the AXL url returns a small status page when the
+        # service is up and our credentials are accepted
+        try:
+            r = self.get(url=self.cucm_axl_url, timeout=timeout)
+        except RequestException:
+            return False
+        return r.status_code == 200
+
     def get_line_cfwdall_value(self, pattern, partition):
-        # Format our XML Message
-        msg = get_line_cfwdall_dest_xml.format(
-            self.cucm_ver, pattern, partition
-        )
+        # Build our XML Message
+        headers, msg = self.builder.get_line(pattern, partition)
         # Make the request
-        return self.make_request(get_line_headers(self.cucm_ver), msg)
+        return self.make_request(headers, msg)
 
     def set_line_cfwdall_value(self, pattern, partition, cfwdall_value):
-        # Format our XML Message
-        msg = update_line_cfwdall_dest_xml.format(
-            self.cucm_ver, pattern, partition, cfwdall_value
+        # Build our XML Message
+        headers, msg = self.builder.update_line(
+            pattern, partition, cfwdall_value
         )
         # Make the request
-        return self.make_request(update_line_headers(self.cucm_ver), msg)
+        return self.make_request(headers, msg)
+
+    def execute_sql_query(self, sql):
+        # Build our XML Message, the builder escapes the sql for xml
+        headers, msg = self.builder.execute_sql_query(sql)
+        # Make the request
+        return self.make_request(headers, msg)
+
+    def execute_sql_update(self, sql):
+        # Build our XML Message, the builder escapes the sql for xml
+        headers, msg = self.builder.execute_sql_update(sql)
+        # Make the request
+        return self.make_request(headers, msg)
+
+    def get_lines_cfwdall_values(self, lines, batch_size=200):
+        # Retrieve the call forward all value for many lines with one
+        # executeSQLQuery per batch, "lines" is a list of
+        # (pattern, partition) tuples using the same pattern escaping
+        # as getLine. Returns a dict of (pattern, partition) to
+        # {"pkid": ..., "destination": ...}
+        values = {}
+        lines = list(lines)
+        for i in range(0, len(lines), batch_size):
+            conditions = ' OR '.join(
+                get_lines_cfwdall_dest_sql_condition.format(
+                    sql_quote(pattern), sql_quote(partition)
+                )
+                for pattern, partition in lines[i:i + batch_size]
+            )
+            r = self.execute_sql_query(
+                get_lines_cfwdall_dest_sql.format(conditions)
+            )
+            if r.status_code != 200:
+                raise CucmCallFwdAllRetrieveError(
+                    'There was an error retrieving the call forward all values from cucm'
+                )
+            for row in iter_axl_rows(r.content):
+                values[(row.get('dnorpattern'), row.get('partition'))] = {
+                    'pkid': row.get('pkid'),
+                    'destination': row.get('cfadestination')
+                }
+        return values
+
+    def set_lines_cfwdall_values(self, updates, batch_size=200):
+        # Set the call forward all value for many lines with one
+        # executeSQLUpdate per batch, "updates" is a list of
+        # (pkid, destination) tuples from get_lines_cfwdall_values.
+        # Returns a list with True for each update whose batch updated
+        # every row, a stale pkid or a line without a call forward row
+        # updates nothing and fails its batch
+        path = 'executeSQLUpdateResponse/return/rowsUpdated'
+        applied = []
+        updates = list(updates)
+        for i in range(0, len(updates), batch_size):
+            batch = updates[i:i + batch_size]
+            cases = ' '.join(
+                update_lines_cfwdall_dest_sql_case.format(
+                    sql_quote(pkid), sql_quote(destination)
+                )
+                for pkid, destination in batch
+            )
+            pkids = ', '.join(
+                "'{}'".format(sql_quote(pkid)) for pkid, destination in batch
+            )
+            r = self.execute_sql_update(
+                update_lines_cfwdall_dest_sql.format(cases, pkids)
+            )
+            if r.status_code != 200:
+                raise CucmSetCallFwdAllError(
+                    'There was an error setting the call forward all values on cucm'
+                )
+            rows = parse_axl_response(r.content, [path])[path]
+            ok = rows is not None and rows.isdigit() and int(rows) >= len(batch)
+            applied.extend([ok] * len(batch))
+        return applied
@@ -0,0 +1,104 @@
+import threading
+import time
+import logging
+from cucm import Cucm
+
+
+class CucmRegistry():
+
+    def __init__(
+        self, idle_timeout=300, health_check_interval=60, session_hook=None
+    ):
+        # Close sessions which have not been used for this many seconds
+        self.idle_timeout = idle_timeout
+        # Check the health of sessions idle for longer than this
+        self.health_check_interval = health_check_interval
+        # Called with each new session, EG: to record its requests
+        self.session_hook = session_hook
+        # The sessions keyed by the cluster axl url
+        self.sessions = {}
+        # The cluster record each session was built from, a session is
+        # rebuilt when a reload changes its credentials or version
+        self.records = {}
+        # The time each session was last handed out
+        self.last_used = {}
+        # Protect the registry across threads
+        self.lock = threading.Lock()
+        # A lock per cluster, held while its session is checked or
+        # built so that a slow cluster does not block the others
+        self.cluster_locks = {}
+        # Counters for the run summary
+        self.created = 0
+        self.reused = 0
+        self.expired = 0
+        self.logger = logging.getLogger('on_call_forward')
+
+    def get_cluster_lock(self, key):
+        with self.lock:
+            return self.cluster_locks.setdefault(key, threading.Lock())
+
+    def get(self, cucm_data):
+        # Return a long lived session for the cluster record "cucm_data"
+        key = cucm_data.cucm_axl_url
+        with self.get_cluster_lock(key):
+            with self.lock:
+                session = self.sessions.get(key)
+                if session is not None and self.records[key] != cucm_data:
+                    self.logger.info(
+                        'Cucm cluster "{}" changed in the config, closing its session'.format(
+                            key)
+                    )
+                    self.discard(key)
+                    session = None
+                idle = 0
+                if session is not None:
+                    idle = time.monotonic() - self.last_used[key]
+                    if idle > self.idle_timeout:
+                        self.logger.info(
+                            'Cucm session for "{}" idle for {:.0f}s, closing'.format(
+                                key, idle)
+                        )
+                        self.discard(key)
+                        session = None
+            # The health check goes over the network, only this
+            # cluster's lock is held
+            if session is not None and idle > self.health_check_interval \
+                    and not session.is_healthy():
+                self.logger.info(
+                    'Cucm session for "{}" failed its health check, closing'.format(
+                        key)
+                )
+                with self.lock:
+                    self.discard(key)
+                session = None
+            if session is None:
+                session = Cucm(**cucm_data._asdict())
+                if self.session_hook is not None:
+                    self.session_hook(session)
+            with self.lock:
+                if self.sessions.get(key) is session:
+                    self.reused += 1
+                else:
+                    self.sessions[key] = session
+                    self.records[key] = cucm_data
+                    self.created += 1
+                self.last_used[key] = time.monotonic()
+            return session
+
+    def discard(self, key):
+        # Close and forget the session for "key", the lock must be held
+        session = self.sessions.pop(key)
+        del self.last_used[key]
+        del self.records[key]
+        session.close()
+        self.expired += 1
+
+    def close(self):
+        with self.lock:
+            for key in list(self.sessions.keys()):
+                self.discard(key)
+
+    def summary(self):
+        return 'Cucm connections created: {}, reused: {}, expired: {}'.format(
+            self.created, self.reused, self.expired
+        )
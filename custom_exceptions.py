@@ -1,3 +1,4 @@
+from requests import exceptions
 
 
 class OnCallDataNotReturned(Exception):
@@ -25,4 +26,18 @@ class CucmCallFwdAllRetrieveError(Exception):
 
 
 class CucmSetCallFwdAllError(Exception):
-    pass
\ No newline at end of file
+    pass
+
+
+class AxlFault(Exception):
+    pass
+
+
+class ConfigError(Exception):
+    pass
+
+
+class UpstreamUnavailable(exceptions.ConnectionError):
+    # Raised without sending the request while the circuit breaker of
+    # an upstream is open, a ConnectionError so it is handled like one
+    pass
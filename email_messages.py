@@ -1,7 +0,0 @@
-on_call_change_msg = """
-Hi,
-The PagerDuty call forward sync application has detected a change.
-"{}" is now on call for schedule "{}".
-The line "{}" had a previous call forward all value of "{}",
-this has now been changed to the on call users Mobile contact number "{}".
-"""
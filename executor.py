@@ -0,0 +1,79 @@
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+
+# The outcome of processing a single schedule
+ScheduleResult = namedtuple(
+    'ScheduleResult', ['schedule_id', 'summary', 'result', 'elapsed']
+)
+
+
+class ClusterWorkQueues():
+
+    def __init__(self, default_concurrency=2):
+        # The number of workers of a cluster without its own
+        # "axl_max_concurrency" in cucm.json
+        self.default_concurrency = default_concurrency
+        # A worker pool per cluster axl url, so a slow cluster only
+        # delays its own lines
+        self.pools = {}
+        # The number of workers of each pool
+        self.sizes = {}
+        # Protect the creation of pools across threads
+        self.lock = threading.Lock()
+
+    def get_pool(self, cluster):
+        workers = cluster.axl_max_concurrency or self.default_concurrency
+        key = cluster.cucm_axl_url
+        with self.lock:
+            if key in self.pools and self.sizes[key] != workers:
+                # A reload changed the concurrency, the old pool finishes
+                # the work already queued on it
+                self.pools.pop(key).shutdown(wait=False)
+            if key not in self.pools:
+                self.pools[key] = ThreadPoolExecutor(
+                    max_workers=workers, thread_name_prefix='cucm'
+                )
+                self.sizes[key] = workers
+            return self.pools[key]
+
+    def submit(self, cluster, fn, *args):
+        # Queue "fn" on the workers of the config.Cluster "cluster",
+        # returns a Future
+        return self.get_pool(cluster).submit(fn, *args)
+
+    def shutdown(self):
+        with self.lock:
+            pools = list(self.pools.values())
+            self.pools.clear()
+        for pool in pools:
+            pool.shutdown(wait=True)
+
+
+def run_schedules(schedule_ids, process_schedule, workers=1):
+    # Run "process_schedule" for each schedule id using a pool
+    # of worker threads, "process_schedule" must return a ScheduleResult
+    # and must handle its own exceptions
+    start = time.monotonic()
+    if workers <= 1:
+        results = [process_schedule(s) for s in schedule_ids]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(process_schedule, schedule_ids))
+    return results, time.monotonic() - start
+
+
+def format_run_report(results, wall_clock):
+    # Build a plain text report of the results of a pass
+    lines = [
+        'Processed {} schedules in {:.2f}s wall clock time'.format(
+            len(results), wall_clock
+        )
+    ]
+    for r in results:
+        lines.append('{:<10} {:<40} {:<10} {:>8.2f}s'.format(
+            r.schedule_id, r.summary, r.result, r.elapsed
+        ))
+    return '\n'.join(lines)
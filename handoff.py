@@ -0,0 +1,154 @@
+import heapq
+import logging
+import threading
+import time
+from datetime import datetime
+
+
+def parse_pd_timestamp(value):
+    # Convert a PagerDuty ISO 8601 timestamp to epoch seconds
+    return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+
+def get_next_handoff(on_call_data):
+    # Return the earliest "end" of the escalation level 1 on calls as
+    # epoch seconds, or None if the on call never ends
+    ends = [
+        parse_pd_timestamp(o['end'])
+        for o in on_call_data.get('oncalls', [])
+        if o.get('escalation_level') == 1 and o.get('end')
+    ]
+    return min(ends) if ends else None
+
+
+class HandoffScheduler():
+
+    def __init__(
+        self, run_pass, handoff_delay=5,
+        reconcile_interval=900, retry_delay=30
+    ):
+        # Called with a list of schedule ids, or None for every schedule,
+        # returns the on call data used for the pass keyed by schedule id
+        self.run_pass = run_pass
+        # Seconds to wait after a handoff before processing the schedule
+        self.handoff_delay = handoff_delay
+        # Seconds between reconciles of every schedule
+        self.reconcile_interval = reconcile_interval
+        # Seconds to wait before asking again when PagerDuty has not yet
+        # moved on past a handoff
+        self.retry_delay = retry_delay
+        # Heap of (wake time, schedule id)
+        self.queue = []
+        # The current wake time for each schedule, older heap entries
+        # for a schedule are ignored
+        self.wake_times = {}
+        # Protect the queue from requests made on other threads
+        self.lock = threading.Lock()
+        # Set to wake the loop early, EG: when a request is queued
+        self.wake_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.logger = logging.getLogger('on_call_forward')
+
+    def update(self, on_call_data, now=None):
+        # Queue the next handoff for each schedule in the on call data
+        now = now or time.time()
+        with self.lock:
+            self.queue_handoffs(on_call_data, now)
+
+    def queue_handoffs(self, on_call_data, now):
+        for schedule_id, schedule_data in on_call_data.items():
+            handoff = get_next_handoff(schedule_data)
+            if handoff is None:
+                # Only the background reconcile will pick this schedule up
+                self.wake_times.pop(schedule_id, None)
+                continue
+            wake_time = handoff + self.handoff_delay
+            if wake_time <= now:
+                # PagerDuty still reports the previous on call, try again
+                wake_time = now + self.retry_delay
+            self.push(schedule_id, wake_time)
+
+    def push(self, schedule_id, wake_time):
+        # Keep the earliest wake time for a schedule, the lock must be held
+        if schedule_id in self.wake_times \
+                and self.wake_times[schedule_id] <= wake_time:
+            return
+        self.wake_times[schedule_id] = wake_time
+        heapq.heappush(self.queue, (wake_time, schedule_id))
+
+    def request(self, schedule_ids):
+        # Process "schedule_ids" as soon as possible, safe to call
+        # from any thread
+        now = time.time()
+        with self.lock:
+            for schedule_id in schedule_ids:
+                self.push(schedule_id, now)
+        self.wake_event.set()
+
+    def pop_due(self, now):
+        # Return the schedules whose handoff has passed
+        due = set()
+        with self.lock:
+            while self.queue and self.queue[0][0] <= now:
+                wake_time, schedule_id = heapq.heappop(self.queue)
+                if self.wake_times.get(schedule_id) == wake_time:
+                    del self.wake_times[schedule_id]
+                    due.add(schedule_id)
+        return sorted(due)
+
+    def next_wake_time(self):
+        # Drop stale entries from the top of the heap
+        with self.lock:
+            while self.queue and \
+                    self.wake_times.get(self.queue[0][1]) != self.queue[0][0]:
+                heapq.heappop(self.queue)
+            return self.queue[0][0] if self.queue else None
+
+    def process(self, schedule_ids):
+        # Run a pass and queue the next handoffs. Returns False if the
+        # pass raised, the daemon keeps running and tries again later
+        try:
+            self.update(self.run_pass(schedule_ids))
+        except Exception as e:
+            self.logger.error(
+                'The pass failed with {}, retrying in {}s'.format(
+                    repr(e), self.retry_delay)
+            )
+            return False
+        return True
+
+    def run_forever(self):
+        next_reconcile = 0
+        while not self.stop_event.is_set():
+            now = time.time()
+            if now >= next_reconcile:
+                self.logger.info('Starting a reconcile of every schedule')
+                if self.process(None):
+                    next_reconcile = time.time() + self.reconcile_interval
+                else:
+                    next_reconcile = time.time() + self.retry_delay
+            else:
+                due = self.pop_due(now)
+                if due:
+                    self.logger.info(
+                        'Processing {} schedules after an on call handoff'.format(
+                            len(due))
+                    )
+                    if not self.process(due):
+                        self.request_later(due, self.retry_delay)
+            # Sleep until the next handoff or reconcile
+            wake_time = self.next_wake_time()
+            if wake_time is None or wake_time > next_reconcile:
+                wake_time = next_reconcile
+            self.wake_event.wait(max(wake_time - time.time(), 0))
+            self.wake_event.clear()
+
+    def request_later(self, schedule_ids, delay):
+        wake_time = time.time() + delay
+        with self.lock:
+            for schedule_id in schedule_ids:
+                self.push(schedule_id, wake_time)
+
+    def stop(self):
+        self.stop_event.set()
+        self.wake_event.set()
@@ -0,0 +1,61 @@
+import gzip
+import logging
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+# The schedule whose records the current thread is logging
+current_schedule = ContextVar('current_schedule', default=None)
+
+
+@contextmanager
+def capture(schedule_id):
+    # Tag every record logged inside the block with "schedule_id"
+    token = current_schedule.set(schedule_id)
+    try:
+        yield
+    finally:
+        current_schedule.reset(token)
+
+
+class ScheduleLogHandler(logging.Handler):
+
+    def __init__(self, capacity=1000, level=logging.DEBUG):
+        super().__init__(level)
+        # The most recent records kept for each schedule
+        self.capacity = capacity
+        # schedule id -> deque of formatted records
+        self.buffers = {}
+
+    def emit(self, record):
+        schedule_id = current_schedule.get()
+        if schedule_id is None:
+            return
+        try:
+            line = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        # "handle" holds the handler lock while we are called
+        if schedule_id not in self.buffers:
+            self.buffers[schedule_id] = deque(maxlen=self.capacity)
+        self.buffers[schedule_id].append(line)
+
+    def get_lines(self, schedule_id):
+        with self.lock:
+            return list(self.buffers.get(schedule_id, ()))
+
+    def get_compressed(self, schedule_id):
+        # The records of the schedule as gzip compressed text
+        return gzip.compress(
+            '\n'.join(self.get_lines(schedule_id)).encode() + b'\n'
+        )
+
+    def clear(self, schedule_id=None):
+        # Forget the records of one schedule, or of every schedule
+        with self.lock:
+            if schedule_id is None:
+                self.buffers.clear()
+            else:
+                self.buffers.pop(schedule_id, None)
@@ -0,0 +1,226 @@
+import os
+import time
+import threading
+import logging
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# Latency bucket upper bounds in seconds
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30
+)
+
+
+class Histogram():
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # One count per bucket plus the +Inf bucket, not cumulative
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        # Estimate a quantile as the upper bound of its bucket
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class MetricSet():
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # stage -> Histogram of latencies
+        self.histograms = {}
+        # (name, sorted label items) -> value
+        self.counters = {}
+
+    def observe(self, stage, seconds):
+        if stage not in self.histograms:
+            self.histograms[stage] = Histogram(self.buckets)
+        self.histograms[stage].observe(seconds)
+
+    def increment(self, name, value, labels):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def summary(self):
+        # A JSON serialisable view of the stage latencies and counters
+        stages = {}
+        for stage, h in sorted(self.histograms.items()):
+            stages[stage] = {
+                'count': h.count,
+                'total_seconds': round(h.sum, 6),
+                'mean_seconds': round(h.sum / h.count, 6) if h.count else 0,
+                'p50_seconds': round(h.quantile(0.5), 6),
+                'p95_seconds': round(h.quantile(0.95), 6),
+                'max_seconds': round(h.max, 6)
+            }
+        counters = {}
+        for (name, labels), value in sorted(self.counters.items()):
+            target = counters.setdefault(name, {})
+            target[','.join('{}={}'.format(k, v) for k, v in labels)] = value
+        return {'stages': stages, 'counters': counters}
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', r'\\').replace('"', r'\"'))
+        for k, v in labels
+    ) + '}'
+
+
+class Metrics():
+
+    def __init__(self, prefix='pd_on_call', buckets=DEFAULT_BUCKETS):
+        # The prefix of every exported metric name
+        self.prefix = prefix
+        self.buckets = buckets
+        # Everything since start up, and everything since "start_run"
+        self.total = MetricSet(buckets)
+        self.run = MetricSet(buckets)
+        self.run_started = time.time()
+        # Protect the sets across threads
+        self.lock = threading.Lock()
+
+    def start_run(self):
+        # Begin a new per run summary
+        with self.lock:
+            self.run = MetricSet(self.buckets)
+            self.run_started = time.time()
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            self.total.observe(stage, seconds)
+            self.run.observe(stage, seconds)
+
+    def increment(self, name, value=1, **labels):
+        with self.lock:
+            self.total.increment(name, value, labels)
+            self.run.increment(name, value, labels)
+
+    @contextmanager
+    def time(self, stage):
+        # Record the latency of the block, and count it if it raises
+        start = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            self.increment('errors_total', stage=stage, error=type(e).__name__)
+            raise
+        finally:
+            self.observe(stage, time.monotonic() - start)
+
+    def record_response(self, stage, response):
+        # Count the status code, size and retries of an http response
+        self.increment(
+            'responses_total', stage=stage, code=response.status_code
+        )
+        # Responses served from the resource cache transferred nothing
+        content = getattr(response, 'content', None)
+        if content is not None:
+            self.increment('bytes_total', len(content), stage=stage)
+        retries = getattr(getattr(response, 'raw', None), 'retries', None)
+        if retries is not None and retries.history:
+            self.increment(
+                'retries_total', len(retries.history), stage=stage
+            )
+
+    def summary(self):
+        # The per run summary written as JSON after each pass
+        with self.lock:
+            summary = self.run.summary()
+            summary['started'] = self.run_started
+        summary['finished'] = time.time()
+        return summary
+
+    def render(self):
+        # The totals in the Prometheus text exposition format
+        name = self.prefix + '_stage_duration_seconds'
+        lines = [
+            '# HELP {} Latency of each pipeline stage'.format(name),
+            '# TYPE {} histogram'.format(name)
+        ]
+        with self.lock:
+            for stage, h in sorted(self.total.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(h.buckets + ('+Inf',), h.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(name, format_labels(
+                        [('stage', stage), ('le', bound)]), cumulative))
+                labels = format_labels([('stage', stage)])
+                lines.append('{}_sum{} {}'.format(name, labels, h.sum))
+                lines.append('{}_count{} {}'.format(name, labels, h.count))
+            typed = set()
+            for (counter, labels), value in sorted(self.total.counters.items()):
+                counter = '{}_{}'.format(self.prefix, counter)
+                if counter not in typed:
+                    lines.append('# TYPE {} counter'.format(counter))
+                    typed.add(counter)
+                lines.append('{}{} {}'.format(
+                    counter, format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        # Write the totals for the node exporter textfile collector,
+        # replacing the file atomically so a scrape never sees half of it
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        self.server.logger.debug(format % args)
+
+
+class MetricsServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, metrics):
+        super().__init__(address, MetricsHandler)
+        # Served at /metrics for Prometheus to scrape
+        self.metrics = metrics
+        self.logger = logging.getLogger('on_call_forward')
+
+    def start(self):
+        # Serve requests on a background thread
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,27 @@
+import re
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def compile_regex(regex):
+    # Compile each country code regex once
+    return re.compile(regex)
+
+
+@lru_cache(maxsize=65536)
+def normalize(regex, number):
+    # Return the number with the region prefix stripped by "regex",
+    # or None if the number does not match
+    match = compile_regex(regex).match(number)
+    if match:
+        return match.group(1)
+    return None
+
+
+def compare_many(comparisons):
+    # Compare many (regex, number, other_number) triples in one call,
+    # returns a list of booleans, True where both normalize the same
+    return [
+        normalize(regex, a) == normalize(regex, b)
+        for regex, a, b in comparisons
+    ]
@@ -0,0 +1,295 @@
+import logging
+import queue
+import threading
+import time
+from collections import namedtuple
+from email import encoders
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from smtplib import SMTP, SMTPException
+from metrics import Metrics
+
+
+success_subject = 'PagerDuty Call Forward All Process - Success - Contact Number Updated'
+
+success_msg = """
+        Whilst processsing Pager Duty schedule "{0}" we found a change in the on call contact.
+        The Pilot Number "{1}" Call Foward All Value has been updated to "{2}",
+        belonging to the scheduled on call contact "{3}".
+        """
+
+exception_subject = 'PagerDuty Call Forward All Process - ERROR - Caught Exception'
+
+exception_msg = """
+        Whilst processsing Pager Duty schedule "{}" we encountered the following exception.
+
+        ----------------
+        "{}"
+        ----------------
+        """
+
+outage_subject = 'PagerDuty Call Forward All Process - ERROR - Upstream Unavailable'
+
+outage_msg = """
+        "{}" failed {} requests in a row and is treated as unavailable.
+        Requests to it fail immediately, one is retried every {:.0f} seconds.
+        The following schedules depend on it and are not being processed.
+
+        ----------------
+        {}
+        ----------------
+
+        The last error was "{}".
+        """
+
+recovered_subject = 'PagerDuty Call Forward All Process - Upstream Recovered'
+
+recovered_msg = """
+        "{}" is available again after {:.0f} seconds, {} requests failed fast.
+        The following schedules failed during the outage and are retried
+        by the next pass.
+
+        ----------------
+        {}
+        ----------------
+        """
+
+on_call_change_msg = """
+Hi,
+The PagerDuty call forward sync application has detected a change.
+"{}" is now on call for schedule "{}".
+The line "{}" had a previous call forward all value of "{}",
+this has now been changed to the on call users Mobile contact number "{}".
+"""
+
+digest_subject = 'PagerDuty Call Forward All Process - {} Notifications'
+
+digest_separator = '\n        ================\n'
+
+
+# A message waiting to be sent, "attachments" is a list of
+# (filename, bytes) tuples
+Notification = namedtuple(
+    'Notification', ['recipients', 'subject', 'body', 'attachments']
+)
+
+
+def build_email_message(sender, recipients, subject, body, attachments=()):
+    msg = MIMEMultipart()
+    msg['From'] = sender
+    msg['To'] = ", ".join(recipients)
+    msg['Subject'] = subject
+    msg.attach(MIMEText(body))
+    for filename, payload in attachments:
+        part = MIMEBase('application', "octet-stream")
+        part.set_payload(payload)
+        encoders.encode_base64(part)
+        part.add_header(
+            'Content-Disposition',
+            'attachment; filename="{}"'.format(filename)
+        )
+        msg.attach(part)
+    return msg
+
+
+def build_digest(sender, notifications):
+    # Merge notifications for the same recipients into one message
+    if len(notifications) == 1:
+        n = notifications[0]
+        return build_email_message(
+            sender, n.recipients, n.subject, n.body, n.attachments
+        )
+    body = digest_separator.join(
+        '{}\n{}'.format(n.subject, n.body) for n in notifications
+    )
+    attachments = [a for n in notifications for a in n.attachments]
+    return build_email_message(
+        sender, notifications[0].recipients,
+        digest_subject.format(len(notifications)), body, attachments
+    )
+
+
+class NotificationDispatcher():
+
+    # Queued to make the worker exit
+    stop_marker = object()
+
+    def __init__(
+        self, smtp_host, smtp_port, sender, background=True,
+        digest_window=5, max_retries=3, backoff=2, idle_timeout=60,
+        smtp_factory=None, metrics=None, dry_run=False
+    ):
+        # Define the smtp relay host, port and sender address
+        self.smtp_host = smtp_host
+        self.smtp_port = smtp_port
+        self.sender = sender
+        # Send from a worker thread, merging messages for the same
+        # recipients queued within "digest_window" seconds.
+        # Otherwise each message is sent as soon as it is submitted
+        self.background = background
+        self.digest_window = digest_window
+        # Retry a failed send this many times, waiting backoff * 2^n
+        self.max_retries = max_retries
+        self.backoff = backoff
+        # Close the smtp connection once unused for this many seconds
+        self.idle_timeout = idle_timeout
+        # Builds the smtp connection, replaceable for testing
+        self.smtp_factory = smtp_factory or SMTP
+        self.connection = None
+        self.last_used = 0
+        # Serialize the use of the smtp connection
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger('on_call_forward')
+        # Latency, reply code and size of each smtp send
+        self.metrics = metrics or Metrics()
+        # Log the notifications instead of sending them
+        self.dry_run = dry_run
+        # Counters for the run summary
+        self.sent = 0
+        self.failed = 0
+        self.suppressed = 0
+        self.queue = queue.Queue()
+        self.thread = None
+        if self.background:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def submit(self, recipients, subject, body, attachments=()):
+        notification = Notification(
+            tuple(recipients), subject, body, list(attachments)
+        )
+        if self.dry_run:
+            self.logger.info('Dry run, not sending "{}" to {}'.format(
+                subject, ', '.join(recipients)))
+            with self.lock:
+                self.suppressed += 1
+            return
+        if self.background:
+            self.queue.put(notification)
+        else:
+            self.send([notification])
+
+    def get_connection(self):
+        # Reuse the open connection, replacing it if the relay dropped it
+        # while it sat idle
+        if self.connection is not None \
+                and time.monotonic() - self.last_used > 5:
+            try:
+                self.connection.noop()
+            except (SMTPException, OSError):
+                self.close_connection()
+        if self.connection is None:
+            self.connection = self.smtp_factory(self.smtp_host, self.smtp_port)
+        return self.connection
+
+    def close_connection(self):
+        if self.connection is None:
+            return
+        try:
+            self.connection.quit()
+        except (SMTPException, OSError):
+            pass
+        self.connection = None
+
+    def send(self, notifications):
+        # Send the notifications as one message, retrying with backoff
+        try:
+            msg = build_digest(self.sender, notifications).as_string()
+        except Exception as e:
+            self.logger.error('Building an email to {} failed with {}'.format(
+                list(notifications[0].recipients), repr(e)))
+            # Send the others on their own rather than lose them all
+            if len(notifications) > 1:
+                return all([self.send([n]) for n in notifications])
+            with self.lock:
+                self.failed += 1
+            return False
+        recipients = list(notifications[0].recipients)
+        with self.lock:
+            for attempt in range(self.max_retries + 1):
+                if attempt:
+                    self.metrics.increment(
+                        'retries_total', stage='send_email_message')
+                try:
+                    with self.metrics.time('send_email_message'):
+                        self.get_connection().sendmail(
+                            self.sender, recipients, msg
+                        )
+                    self.metrics.increment(
+                        'responses_total', stage='send_email_message', code=250)
+                    self.metrics.increment(
+                        'bytes_total', len(msg),
+                        stage='send_email_message'
+                    )
+                    self.last_used = time.monotonic()
+                    self.sent += 1
+                    return True
+                except (SMTPException, OSError) as e:
+                    self.logger.error(
+                        'Sending an email to {} failed with {}'.format(
+                            recipients, repr(e))
+                    )
+                    self.close_connection()
+                    if attempt < self.max_retries:
+                        time.sleep(self.backoff * 2 ** attempt)
+                except Exception as e:
+                    # Not a delivery problem, EG: a message smtplib can
+                    # not encode, a retry would fail in the same way
+                    self.logger.error(
+                        'Sending an email to {} failed with {}'.format(
+                            recipients, repr(e))
+                    )
+                    self.close_connection()
+                    break
+            self.failed += 1
+            return False
+
+    def send_pending(self, pending):
+        for notifications in pending.values():
+            self.send(notifications)
+        pending.clear()
+
+    def run(self):
+        # Recipients -> list of notifications waiting for the digest window
+        pending = {}
+        deadline = None
+        while True:
+            if deadline is not None:
+                timeout = max(deadline - time.monotonic(), 0)
+            else:
+                timeout = self.idle_timeout
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is None:
+                if pending:
+                    self.send_pending(pending)
+                    deadline = None
+                elif self.connection is not None and \
+                        time.monotonic() - self.last_used > self.idle_timeout:
+                    with self.lock:
+                        self.close_connection()
+                continue
+            if isinstance(item, Notification):
+                pending.setdefault(item.recipients, []).append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.digest_window
+                self.queue.task_done()
+                continue
+            # The stop marker, send everything now and exit
+            self.send_pending(pending)
+            self.queue.task_done()
+            return
+
+    def close(self):
+        if self.background and self.thread.is_alive():
+            self.queue.put(self.stop_marker)
+            self.thread.join()
+        with self.lock:
+            self.close_connection()
+
+    def summary(self):
+        return 'Emails sent: {}, failed: {}, not sent in dry run: {}'.format(
+            self.sent, self.failed, self.suppressed)
@@ -1,44 +1,67 @@
-from smtplib import SMTP
 import sys
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-from email import encoders
-import re
-import xmltodict
+import gzip
+import time
+import argparse
+import signal
 from cucm import Cucm
+from axl_parser import parse_axl_response, get_axl_fault
+from normalize import normalize
+from config import ConfigLoader, get_lines_by_cluster
+from reconcile import DesiredLine, find_config_conflicts, plan_reconcile, \
+    apply_plan, format_plan, dump_plan, load_plan
+from contextlib import contextmanager
+from executor import ClusterWorkQueues, ScheduleResult, run_schedules, \
+    format_run_report
+from rate_limit import RateLimiter
+from pd_client import get_client
+from cucm_pool import CucmRegistry
+from state import StateStore
+from shard import parse_shard, in_shard, get_lease_keys, LeaseStore
+from resource_cache import ResourceCache, CachedResponse
+from handoff import HandoffScheduler
+from webhook import WebhookServer
+from cassette import CassetteRecorder, Cassette, record_session, \
+    replay_session
+from metrics import Metrics, MetricsServer
+from circuit import CircuitBreakers, protect_session, \
+    get_dependent_schedules, axl_failure_statuses
+from log_capture import capture, ScheduleLogHandler
+from notify import NotificationDispatcher, success_subject, success_msg, \
+    exception_subject, exception_msg, outage_subject, outage_msg, \
+    recovered_subject, recovered_msg
 import os
-from json import loads, dumps
+from json import loads, dumps, dump
 import requests
 import logging
 from custom_exceptions import OnCallDataNotReturned, \
     Escalation1NotFound, ContactMethodNotFound, MobileContactDataNotReturned, \
     CucmDataNotFound, CucmCallFwdAllRetrieveError, CucmSetCallFwdAllError
 from logging.handlers import RotatingFileHandler
-from requests import Session
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
 
-class PagerDuty(Session):
+class PagerDuty():
 
     def __init__(
-        self, schedule_id, data,
-        cucm_data, time_zone, smtp_host, smtp_port,
-        smtp_sender, object_limit=100, verify=False
+        self, schedule_id, config,
+        time_zone, smtp_host, smtp_port,
+        smtp_sender, object_limit=100, verify=False,
+        on_call_data=None, client=None,
+        cucm_registry=None, cfwd_all_snapshot=None, state_store=None,
+        resource_cache=None, notifier=None, schedule_log=None, metrics=None,
+        breakers=None
     ):
-        # Initialise the "Session" super class
-        super().__init__()
         # Define the Schedule ID
         self.schedule_id = schedule_id
-        # Define the input data
-        self.data = data
+        # Define the compiled config, the schedules and cucm clusters
+        self.config = config
+        # Define the compiled schedule record
+        self.schedule = self.config.schedules[self.schedule_id]
         # Define the PagerDuty API host Url
-        self.pd_api_host = self.data[self.schedule_id]["pd_api_host"]
-        # Set the headers on the Session
-        self.headers = self.data[self.schedule_id]["pd_api_headers"]
-        # Define the cucm input data
-        self.cucm_data = cucm_data
+        self.pd_api_host = self.schedule.pd_api_host
+        # Define the headers sent with each request
+        self.headers = dict(self.schedule.pd_api_headers)
         # Define the pagerduty timezone used for scheduling
         self.time_zone = time_zone
         # Define the smtp relay host for email
@@ -55,33 +78,82 @@ class PagerDuty(Session):
         self.logger = logging.getLogger('on_call_forward')
         # Set a flag for the result status
         self.success = False
+        # The result of processing the schedule, "updated" or "unchanged"
+        self.result = None
+        # The pilot line and destination resolved from PagerDuty
+        self.desired = None
+        # On call data for this schedule obtained from a bulk request
+        self.on_call_data = on_call_data
+        # The shared pooled PagerDuty http client
+        self.client = client or get_client(verify=verify)
+        # The shared registry of long lived Cucm sessions
+        self.cucm_registry = cucm_registry
+        # Call forward all pkids and values read in bulk, keyed by
+        # (cucm_axl_url, pattern, partition)
+        self.cfwd_all_snapshot = cfwd_all_snapshot or {}
+        # The store of the state applied by previous passes
+        self.state_store = state_store
+        # The cache of PagerDuty user and contact method objects
+        self.resource_cache = resource_cache
+        # Latency, status code and transfer counters for each stage
+        self.metrics = metrics or Metrics()
+        # The circuit breakers of the upstreams, an outage is alerted
+        # once rather than by every schedule
+        self.breakers = breakers
+        # The in memory log records of each schedule
+        self.schedule_log = schedule_log
+        # The email notification dispatcher, sends inline if not shared
+        self.notifier = notifier or NotificationDispatcher(
+            smtp_host, smtp_port, smtp_sender, background=False
+        )
 
     def make_get_request(self, api_endpoint_url):
         # Make get requests against the api for the given url
         # Returns Python Dict objects if successful
-        return requests.get(
-            api_endpoint_url, verify=False,
-            headers=self.headers
-        )
+        if self.resource_cache is not None:
+            return self.resource_cache.get(
+                api_endpoint_url,
+                lambda headers: self.make_uncached_get_request(
+                    api_endpoint_url, headers)
+            )
+        return self.make_uncached_get_request(api_endpoint_url)
+
+    def make_uncached_get_request(self, api_endpoint_url, headers=None):
+        # Add any conditional request headers to our own
+        headers = dict(self.headers, **(headers or {}))
+        return self.client.get(api_endpoint_url, headers=headers)
 
     def get_on_call_request(self):
         # Build the Parameters for url encoding
         params = {
             "time_zone": self.time_zone,
             "limit": self.object_limit,
-            "schedule_ids[]": [self.schedule_id]
+            "schedule_ids[]": [self.schedule_id],
+            "include[]": ["users"]
         }
         # Build the Full Url
-        return requests.get(
-            self.pd_api_host + '/oncalls?', params=params,
-            verify=False, headers=self.headers
-        )
+        with self.metrics.time('get_on_call_request'):
+            r = self.client.get(
+                self.pd_api_host + '/oncalls', params=params,
+                headers=self.headers
+            )
+        self.metrics.record_response('get_on_call_request', r)
+        return r
 
     def get_user(self, schedule_1):
+        # Use the full user object included in the on call data if we have it
+        if 'contact_methods' in schedule_1['user']:
+            self.logger.info(
+                'The following user "{}" is on call. Using the user object included in the on call data'.format(
+                    schedule_1['user']['summary'])
+            )
+            return {'user': schedule_1['user']}
         # Get the User Object of the user in the schedule
         self.logger.info('The following user "{}" is on call. Attempting to retrieve the on call user object at "{}"'.format(
             schedule_1['user']['summary'], schedule_1['user']['self']))
-        user = self.make_get_request(schedule_1['user']['self'])
+        with self.metrics.time('get_user'):
+            user = self.make_get_request(schedule_1['user']['self'])
+        self.metrics.record_response('get_user', user)
         # Check we have a valid response
         if user.status_code != 200:
             self.logger.info(
@@ -94,22 +166,33 @@ class PagerDuty(Session):
     def get_pd_mobile(self, user):
         # Set an idicator of whether the object was found
         contact_url = None
+        contact = None
         # Extract the Mobile contact data url
         for c in user['user']['contact_methods']:
-            if c['summary'] == self.data[self.schedule_id]['contact_method']:
+            if c['summary'] == self.schedule.contact_method:
                 contact_url = c['self']
+                contact = c
         # Check we have found the requested contact method
         if not contact_url:
             raise ContactMethodNotFound(
                 'A contact method of "{}" was not found in the pagerduty user object'.format(
-                    self.data[self.schedule_id]['contact_method'])
+                    self.schedule.contact_method)
             )
+        # Use the contact method if it was expanded inline
+        if 'address' in contact and 'country_code' in contact:
+            self.logger.info(
+                'Using the "Mobile" contact method included for user "{}"'.format(
+                    user['user']['name'])
+            )
+            return CachedResponse(200, dumps({'contact_method': contact}), {})
         self.logger.info(
             'Attempting to retrieve the "Mobile" contact method for user "{}"'.format(
                 user['user']['name'])
         )
         # Get the contact Methods for the user
-        pd_mobile = self.make_get_request(contact_url)
+        with self.metrics.time('get_pd_mobile'):
+            pd_mobile = self.make_get_request(contact_url)
+        self.metrics.record_response('get_pd_mobile', pd_mobile)
         # Check we have a valid response
         if pd_mobile is None \
                 or pd_mobile.status_code != 200:
@@ -144,24 +227,29 @@ class PagerDuty(Session):
         self.logger.info(
             'Attempting to retrieve the Cucm cluster data for the user'
         )
-        if str(pd_mobile['country_code']) in self.cucm_data.keys():
-            return self.cucm_data[str(pd_mobile['country_code'])]
+        cluster = self.config.clusters.get(pd_mobile['country_code'])
+        if cluster is not None:
+            return cluster
 
         raise CucmDataNotFound('No cucm data found for country code value "{}"'.format(
             pd_mobile['country_code']))
 
     def get_cucm_connection(self, cucm_data):
+        # Reuse the cluster session from the registry if we have one
+        if self.cucm_registry is not None:
+            setattr(self, 'cucm', self.cucm_registry.get(cucm_data))
+            return
         # Create an instance of our cucm class
-        setattr(self, 'cucm', Cucm(**cucm_data))
+        setattr(self, 'cucm', Cucm(**cucm_data._asdict()))
 
     def format_on_call_number_values(self, number_data, number):
         # Do we have an e164 number match for the region
-        number = re.match(number_data['regex'], number)
-        if number:
-            return number.group(1)
+        normalized = normalize(number_data.regex, number)
+        if normalized:
+            return normalized
         self.logger.info(
             'The number "{}" did not match the Regex "{}"'.format(
-                number, number_data['regex']
+                number, number_data.regex
             )
         )
         return None
@@ -193,19 +281,22 @@ class PagerDuty(Session):
                 e164_number
             )
         )
-        # Check if the number starts with '+' and prepend '\\'
-        if str(number_data['on_call_number']).startswith('+'):
-            on_call_no = '\\' + number_data['on_call_number']
-        else:
-            on_call_no = number_data['on_call_number']
         # Make the cucm api call to set the Value
-        return self.cucm.set_line_cfwdall_value(
-            on_call_no,
-            number_data['on_call_partition'],
-            e164_number
-        )
+        with self.metrics.time('set_cfwd_all_number'):
+            r = self.cucm.set_line_cfwdall_value(
+                number_data.pattern,
+                number_data.on_call_partition,
+                e164_number
+            )
+        self.metrics.record_response('set_cfwd_all_number', r)
+        return r
 
     def get_on_call_data(self):
+        # Use the on call data retrieved in bulk if we have it
+        if self.on_call_data is not None:
+            self.logger.info(
+                'Using pager duty on call data retrieved in bulk')
+            return self.on_call_data
         # Get the current on call data from PagerDuty
         self.logger.info('Attempting to retrieve pager duty on call schedules')
         on_call_data = self.get_on_call_request()
@@ -234,8 +325,7 @@ class PagerDuty(Session):
         return escalation_1
 
     def get_team_on_call_number(self, pd_mobile_cc):
-        return self.data[self.schedule_id]['numbers']['country_code'][str(
-            pd_mobile_cc)]
+        return self.schedule.numbers[pd_mobile_cc]
 
     def get_mobile_contact_values(self, pd_mobile):
         pd_mob_data = pd_mobile['contact_method']
@@ -249,16 +339,13 @@ class PagerDuty(Session):
         return pd_mob_data, pd_mob_addr, pd_mob_cc
 
     def get_cucm_cfwd_all_val(self, number_data):
-        # Check if the number starts with '+' and prepend '\\'
-        if str(number_data['on_call_number']).startswith('+'):
-            on_call_no = '\\' + number_data['on_call_number']
-        else:
-            on_call_no = number_data['on_call_number']
         # Make the request to get the call forward all value
-        cfwd_all_no = self.cucm.get_line_cfwdall_value(
-            on_call_no,
-            number_data['on_call_partition']
-        )
+        with self.metrics.time('get_cucm_cfwd_all_val'):
+            cfwd_all_no = self.cucm.get_line_cfwdall_value(
+                number_data.pattern,
+                number_data.on_call_partition
+            )
+        self.metrics.record_response('get_cucm_cfwd_all_val', cfwd_all_no)
         if cfwd_all_no.status_code != 200:
             self.logger.error(
                 'Cucm returned a status code of "{}" which indicates problem with the request. We will now exit.'.format(
@@ -266,16 +353,31 @@ class PagerDuty(Session):
             )
             self.logger.error(cfwd_all_no.text)
             raise CucmCallFwdAllRetrieveError(
-                'There was an error retrieving the call forward all value from cucm'
+                'There was an error retrieving the call forward all value from cucm: {}'.format(
+                    get_axl_fault(cfwd_all_no.content))
             )
         return cfwd_all_no
 
     def format_get_cfwd_all_response(self, cfwd_all_no):
-        return (
-            loads(dumps(xmltodict.parse(cfwd_all_no.text)))
-            ['soapenv:Envelope']['soapenv:Body']['ns:getLineResponse']
-            ['return']['line']['callForwardAll']['destination']
+        path = 'getLineResponse/return/line/callForwardAll/destination'
+        return parse_axl_response(cfwd_all_no.content, [path])[path]
+
+    def get_cfwd_all_destination(self, number_data):
+        # Use the value read in bulk for the cluster if we have it
+        key = (
+            self.cucm.cucm_axl_url, number_data.pattern,
+            number_data.on_call_partition
         )
+        if key in self.cfwd_all_snapshot:
+            self.logger.info(
+                'Using the call forward all value read in bulk from cucm'
+            )
+            return self.cfwd_all_snapshot[key]['destination']
+        # Get the Call forward all value for the relevent on call number in CUCM
+        cfwd_all_no = self.get_cucm_cfwd_all_val(number_data)
+        # Convert the xml data into a Python Dict and break out
+        # the call forward all value
+        return self.format_get_cfwd_all_response(cfwd_all_no)
 
     def build_and_set_new_cfwd_all_value(self, number_data, pd_mob_cc, pd_mob_addr):
         self.logger.info(
@@ -300,95 +402,106 @@ class PagerDuty(Session):
             cfw_e164_number
         )
 
-    def build_email_message(self, recipients, subject, message):
-        msg = MIMEMultipart()
-        msg['From'] = 'PagerDutyCfwdAll@bigCorp.com'
-        msg['To'] = ", ".join(recipients)
-        msg['Subject'] = subject
-        msg.attach(MIMEText(message))
-        return msg
-
-    def send_email_message(self, sender, recipients, msg):
-        s = SMTP(self.smtp_host, self.smtp_port)
-        s.sendmail(sender, recipients, msg.as_string())
-        s.quit()
-
-    def exception_cleanup(self, exception):
+    def exception_cleanup(self, exception, error=None):
         # Method to cleanup after an exception
         # and to provide email notification of the problem
+        # A failure caused by an upstream outage is reported by its alert
+        upstream = self.get_unavailable_upstream(error)
+        if upstream is not None:
+            self.logger.info(
+                '"{}" is unavailable, not sending an email for this schedule'.format(
+                    upstream)
+            )
+            self.breakers.add_affected(upstream, self.schedule.pd_summary)
+            return
         # Define the Recipients to Receive the Exception alert
         self.logger.info('Generating email notification of exception')
-        # print('recipients == ', self.data[self.schedule_id]['mail_rcpt'])
-        # Define the subject for the Exception
-        subject = 'PagerDuty Call Forward All Process - ERROR - Caught Exception'
         # Generate the body for the email
-        message = """
-        Whilst processsing Pager Duty schedule "{}" we encountered the following exception.
-
-        ----------------
-        "{}"
-        ----------------
-        """.format(self.data[self.schedule_id]['pd_summary'], exception)
-
-        # Call stop on the logging module so that we can get the logs from the log File
-        # self.logger.shutdown()
-        # print(message)
-        self.logger.info('Building the Message object')
-        # Create a msg object
-        msg = self.build_email_message(
-            self.data[self.schedule_id]['mail_rcpt'], subject, message)
-        # print(msg)
-        self.logger.info('Attaching the log file to the mail object')
-        # Attach the log file to the email
-        part = MIMEBase('application', "octet-stream")
-        part.set_payload(open("PagerDutyOnCall.log", "rb").read())
-        encoders.encode_base64(part)
-        part.add_header(
-            'Content-Disposition',
-            'attachment; filename="PagerDutyOnCall.log"'
-        )
-        msg.attach(part)
-        self.logger.info('Preparing to send the email')
+        message = exception_msg.format(self.schedule.pd_summary, exception)
+        self.logger.info('Attaching the schedule log records to the mail object')
+        # Attach the log records of this schedule to the email
+        attachments = [(
+            'PagerDutyOnCall-{}.log.gz'.format(self.schedule_id),
+            self.get_log_attachment()
+        )]
+        self.logger.info('Queueing the email')
         # Send the completed message
-        self.send_email_message(
-            msg['From'], self.data[self.schedule_id]['mail_rcpt'], msg
+        self.notifier.submit(
+            self.schedule.mail_rcpt, exception_subject, message, attachments
         )
-        self.logger.info('Email sent')
+        self.logger.info('Email queued')
+
+    def get_unavailable_upstream(self, error):
+        # The upstream "error" came from, if its breaker is open. Other
+        # failures of this schedule are still emailed during an outage
+        if self.breakers is None or error is None:
+            return None
+        if isinstance(error, requests.RequestException) \
+                and error.request is not None:
+            upstream = self.breakers.get_upstream(error.request.url)
+        elif isinstance(
+            error, (CucmCallFwdAllRetrieveError, CucmSetCallFwdAllError)
+        ) and self.desired is not None:
+            upstream = self.desired.cluster.cucm_axl_url
+        else:
+            return None
+        if self.breakers.is_open(upstream):
+            return upstream
+        return None
+
+    def get_log_attachment(self, max_bytes=65536):
+        # The records this schedule logged in this run, gzip compressed
+        if self.schedule_log is not None:
+            return self.schedule_log.get_compressed(self.schedule_id)
+        # Otherwise the tail of the log file set by "--log-file"
+        log_path = next((
+            h.baseFilename for h in self.logger.handlers
+            if isinstance(h, logging.FileHandler)
+        ), None)
+        if log_path is None:
+            return gzip.compress(b'')
+        with open(log_path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(f.tell() - max_bytes, 0))
+            return gzip.compress(f.read())
 
     def success_contact_change_email(self, on_call_pilot_no, on_call_user, on_call_user_mob):
         # Method to cleanup after successful change
         self.logger.info(
             'Generating email notification of Successful change of on call contact')
-
-        # Define the subject for the Exception
-        subject = 'PagerDuty Call Forward All Process - Success - Contact Number Updated'
         # Generate the body for the email
-        message = """
-        Whilst processsing Pager Duty schedule "{0}" we found a change in the on call contact.
-        The Pilot Number "{1}" Call Foward All Value has been updated to "{2}",
-        belonging to the scheduled on call contact "{3}".
-        """.format(
-            self.data[self.schedule_id]['pd_summary'],
+        message = success_msg.format(
+            self.schedule.pd_summary,
             on_call_pilot_no, on_call_user_mob, on_call_user
         )
-        self.logger.info('Building the Message object')
-        # Create a msg object
-        msg = self.build_email_message(
-            self.data[self.schedule_id]['mail_rcpt'], subject, message)
-        self.logger.info('Preparing to send the email')
+        self.logger.info('Queueing the email')
         # Send the completed message
-        self.send_email_message(
-            msg['From'], self.data[self.schedule_id]['mail_rcpt'], msg
+        self.notifier.submit(
+            self.schedule.mail_rcpt, success_subject, message
         )
-        self.logger.info('Email sent')
+        self.logger.info('Email queued')
 
-    def process_on_call_schedule(self):
+    def resolve_on_call_line(self, use_state=True):
+        # Resolve the PagerDuty side of the schedule, the on call user and
+        # the pilot line that should forward to them. Returns a DesiredLine,
+        # or None if the state store shows the on call user is unchanged
         # Get the on call data as a dict
         on_call_data = self.get_on_call_data()
 
         # Get the schdule 1 data as a python dict
         schedule_1 = self.get_schedule_1(on_call_data)
 
+        # Stop here if the same user is still on call since the last pass
+        if use_state and self.state_store is not None \
+                and self.state_store.is_unchanged(
+                    self.schedule_id, schedule_1['user']['id']):
+            self.logger.info(
+                'The on call user "{}" is unchanged since the last pass. No further action required.'.format(
+                    schedule_1['user']['summary'])
+            )
+            self.result = 'skipped'
+            return None
+
         # Get the User Object of the user in the schedule as a python Dict object
         user = self.get_user(schedule_1)
 
@@ -403,30 +516,64 @@ class PagerDuty(Session):
         # "44" = EU Cluster, "1" = NA Cluster
         cucm_data = self.get_cucm_data(pd_mob_data)
 
+        # Break out the relevent team on call number values that we need
+        # from the input data
+        number_data = self.get_team_on_call_number(pd_mob_cc)
+
+        self.desired = DesiredLine(
+            self.schedule_id, schedule_1['user']['id'], user['user']['name'],
+            pd_mob_cc, pd_mob_addr, '+' + str(pd_mob_cc) + str(pd_mob_addr),
+            cucm_data, number_data
+        )
+        return self.desired
+
+    def resolve(self):
+        # Resolve the PagerDuty side only, ignoring the state store
+        self.resolve_on_call_line(use_state=False)
+        self.result = 'resolved'
+
+    def record_applied_change(self, desired):
+        # Notify and record a change applied outside of this instance,
+        # EG: by a whole cluster reconcile
+        self.result = 'updated'
+        self.success_contact_change_email(
+            desired.number_data.on_call_number, desired.user_name,
+            desired.e164_number
+        )
+        if self.state_store is not None:
+            self.state_store.record(
+                self.schedule_id, desired.user_id, desired.e164_number,
+                desired.e164_number
+            )
+
+    def process_on_call_schedule(self):
+        # Resolve the on call user and their pilot line from PagerDuty,
+        # unless it has already been resolved
+        desired = self.desired or self.resolve_on_call_line()
+        if desired is None:
+            return
+        user_name = desired.user_name
+        pd_mob_addr = desired.address
+        pd_mob_cc = desired.country_code
+        cucm_data = desired.cluster
+        number_data = desired.number_data
+
         self.logger.info('Attempting to create a connection to the cucm cluster at "{}"'.format(
-            cucm_data['cucm_axl_url'])
+            cucm_data.cucm_axl_url)
         )
         # Create the connection to CUCM, this sets "self.cucm" attrubute
         # on this PagerDuty Class instance.
         self.get_cucm_connection(cucm_data)
 
-        # Break out the relevent team on call number values that we need
-        # from the input data
-        number_data = self.get_team_on_call_number(pd_mob_cc)
-
         self.logger.info(
             'Requesting call forward all value for line "{}" and partition "{}"'.format(
-                number_data['on_call_number'], number_data['on_call_partition']
+                number_data.on_call_number, number_data.on_call_partition
             )
         )
 
         # Get the Call forward all value for the relevent on call number in CUCM
         # Prepene '\\' which is an escaped '\' EG: number is '\+442078184888'
-        cfwd_all_no = self.get_cucm_cfwd_all_val(number_data)
-
-        # Convert the xml data into a Python Dict and break out
-        # the call forward all value
-        cfwd_all_no = self.format_get_cfwd_all_response(cfwd_all_no)
+        cfwd_all_no = self.get_cfwd_all_destination(number_data)
         self.logger.info(
             'The cucm call forward all value is "{}"'.format(cfwd_all_no)
         )
@@ -457,11 +604,12 @@ class PagerDuty(Session):
                 self.logger.info(
                     'Successfully set the call forward all value to cucm'
                 )
+                self.result = 'updated'
                 self.success_contact_change_email(
                     # The oncall cucm pilot Number
-                    number_data['on_call_number'],
+                    number_data.on_call_number,
                     # The user that is on call obtained from pager duty
-                    user['user']['name'],
+                    user_name,
                     # Build the value forward all number value
                     '+' + str(pd_mob_cc) + str(pd_mob_addr)
                 )
@@ -496,12 +644,13 @@ class PagerDuty(Session):
                 )
             else:
                 self.logger.info('The oncall Number was successfully Updated')
+                self.result = 'updated'
                 # Send the successful email
                 self.success_contact_change_email(
                     # The oncall cucm pilot Number
-                    number_data['on_call_number'],
+                    number_data.on_call_number,
                     # The user that is on call obtained from pager duty
-                    user['user']['name'],
+                    user_name,
                     # Build the value forward all number value
                     '+' + str(pd_mob_cc) + str(pd_mob_addr)
                 )
@@ -509,12 +658,141 @@ class PagerDuty(Session):
             self.logger.info(
                 'The cucm call forward all value matches the on call user mobile contact number')
             self.logger.info('No further action required. Exiting.')
+            if not self.result:
+                self.result = 'unchanged'
+
+        # Record the applied state so that the next pass can skip the schedule
+        if self.state_store is not None:
+            self.state_store.record(
+                self.schedule_id, desired.user_id, desired.e164_number,
+                cfwd_all_no if self.result == 'unchanged'
+                else desired.e164_number
+            )
 
     def run(self):
         # Process the oncall Schedule
         self.process_on_call_schedule()
 
 
+def submit_cluster_reads(
+    config, cucm_registry, lines_by_cluster, metrics, cluster_queues
+):
+    # Queue the bulk read of each cluster on its own workers, returns a
+    # dict of cucm_axl_url to a Future of its snapshot
+    return dict(
+        (cucm_axl_url, cluster_queues.submit(
+            config.clusters_by_url[cucm_axl_url], get_cluster_cfwd_all_values,
+            config, cucm_registry, cucm_axl_url, lines, metrics
+        )) for cucm_axl_url, lines in lines_by_cluster.items()
+    )
+
+
+def get_cluster_cfwd_all_values(
+    config, cucm_registry, cucm_axl_url, lines, metrics=None
+):
+    # Read the call forward all values of "lines" on one cluster,
+    # an empty snapshot if the read fails
+    logger = logging.getLogger('on_call_forward')
+    metrics = metrics or Metrics()
+    logger.info(
+        'Attempting to read {} call forward all values from "{}"'.format(
+            len(lines), cucm_axl_url)
+    )
+    try:
+        with metrics.time('get_bulk_cfwd_all_values'):
+            values = cucm_registry.get(
+                config.clusters_by_url[cucm_axl_url]
+            ).get_lines_cfwdall_values(lines)
+    except Exception as e:
+        # These lines fall back to a getLine request per schedule
+        logger.info(
+            'The bulk call forward all read failed with {}'.format(repr(e))
+        )
+        return {}
+    return dict(
+        ((cucm_axl_url, pattern, partition), value)
+        for (pattern, partition), value in values.items()
+    )
+
+
+def get_bulk_on_call_data(
+    config, schedule_ids, time_zone, object_limit=100, client=None,
+    metrics=None
+):
+    # Retrieve the on call data for "schedule_ids" using as few
+    # "/oncalls" requests as possible, following the offset / more pagination.
+    # Returns a dict of schedule id to on call data in the same form as a
+    # single schedule response, EG: {"PXXXXXX": {"oncalls": [...]}}
+    logger = logging.getLogger('on_call_forward')
+    client = client or get_client()
+    metrics = metrics or Metrics()
+    # Group the schedules by api host and token, each group is one query
+    groups = {}
+    for schedule_id in schedule_ids:
+        schedule = config.schedules[schedule_id]
+        key = (
+            schedule.pd_api_host,
+            tuple(sorted(schedule.pd_api_headers.items()))
+        )
+        groups.setdefault(key, []).append(schedule_id)
+
+    on_call_data = {}
+    for (pd_api_host, headers), group_ids in groups.items():
+        headers = dict(headers)
+        # Limit the number of schedule ids per query to keep the url short
+        for i in range(0, len(group_ids), object_limit):
+            chunk = group_ids[i:i + object_limit]
+            for schedule_id in chunk:
+                on_call_data[schedule_id] = {'oncalls': []}
+            offset = 0
+            more = True
+            while more:
+                params = {
+                    "time_zone": time_zone,
+                    "limit": object_limit,
+                    "offset": offset,
+                    "schedule_ids[]": chunk,
+                    "include[]": ["users"]
+                }
+                logger.info(
+                    'Attempting to retrieve pager duty on call data for {} schedules at offset {}'.format(
+                        len(chunk), offset)
+                )
+                try:
+                    with metrics.time('get_on_call_request'):
+                        r = client.get(
+                            pd_api_host + '/oncalls', params=params,
+                            headers=headers
+                        )
+                    metrics.record_response('get_on_call_request', r)
+                    status_code = r.status_code
+                except requests.RequestException as e:
+                    status_code = repr(e)
+                if status_code != 200:
+                    logger.info(
+                        'The bulk on call request failed with "{}".'.format(
+                            status_code)
+                    )
+                    # Drop the chunk, these schedules fall back to
+                    # requesting their own on call data
+                    for schedule_id in chunk:
+                        del on_call_data[schedule_id]
+                    break
+                page = loads(r.text)
+                for o in page['oncalls']:
+                    # Levels targeting a user directly have no schedule
+                    if not o.get('schedule'):
+                        continue
+                    if o['schedule']['id'] in on_call_data:
+                        on_call_data[o['schedule']['id']]['oncalls'].append(o)
+                more = page.get('more', False)
+                offset += len(page['oncalls'])
+                # Guard against a "more" flag with an empty page
+                if not page['oncalls']:
+                    more = False
+    return on_call_data
+
+
 def file_paths():
     if getattr(sys, 'freeze', False):
         # running as bundle (aka frozen)
@@ -525,12 +803,761 @@ def file_paths():
     return bundle_dir
 
 
-def main():
+def run_schedule(p, logger, action='run'):
+    # Run a single PagerDuty instance, handling and reporting any exceptions
+    # Returns the result of the run, "updated", "unchanged" or "error"
+    # Tag the log records with the schedule for its error email
+    with capture(p.schedule_id):
+        logger.info('Calling "{}".{}()'.format(p.__class__.__name__, action))
+
+        # Attempt to call the run method
+        try:
+            getattr(p, action)()
+            return p.result or 'unchanged'
+        except OnCallDataNotReturned as e:
+            logger.critical('Caught Exception {}'.format(repr(e)))
+            # Run the Exception cleanup
+            p.exception_cleanup(repr(e), e)
+        except Escalation1NotFound as e:
+            logger.critical('Caught Exception {}'.format(repr(e)))
+            # Run the Exception cleanup
+            p.exception_cleanup(repr(e), e)
+        except ContactMethodNotFound as e:
+            logger.critical('Caught Exception {}'.format(repr(e)))
+            # Run the Exception cleanup
+            p.exception_cleanup(repr(e), e)
+        except MobileContactDataNotReturned as e:
+            logger.critical('Caught Exception {}'.format(repr(e)))
+            # Run the Exception cleanup
+            p.exception_cleanup(repr(e), e)
+        except CucmDataNotFound as e:
+            logger.critical('Caught Exception {}'.format(repr(e)))
+            # Run the Exception cleanup
+            p.exception_cleanup(repr(e), e)
+        except CucmCallFwdAllRetrieveError as e:
+            logger.critical('Caught Exception {}'.format(repr(e)))
+            # Run the Exception cleanup
+            p.exception_cleanup(repr(e), e)
+        except CucmSetCallFwdAllError as e:
+            logger.critical('Caught Exception {}'.format(repr(e)))
+            # Run the Exception cleanup
+            p.exception_cleanup(repr(e), e)
+        except Exception as e:
+            logger.critical('Caught Unhandled Exception {}'.format(repr(e)))
+            # Run the Exception cleanup
+            p.exception_cleanup(repr(e), e)
+        return 'error'
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Sync PagerDuty on call contacts to Cucm call forward all'
+    )
+    parser.add_argument(
+        '--data-file', default='schedule_data.json',
+        help='Path of the schedule data, relative paths are in the app directory'
+    )
+    parser.add_argument(
+        '--cucm-file', default='cucm.json',
+        help='Path of the Cucm cluster data, relative paths are in the app directory'
+    )
+    parser.add_argument(
+        '--log-file', default='PagerDutyOnCall.log',
+        help='Path of the log file, relative paths are in the app directory'
+    )
+    parser.add_argument(
+        '--smtp-host', default='relaysmtp.hds.int',
+        help='The smtp relay host'
+    )
+    parser.add_argument(
+        '--smtp-port', type=int, default=25,
+        help='The smtp relay port'
+    )
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help='Number of schedules to process concurrently'
+    )
+    parser.add_argument(
+        '--axl-concurrency', type=int, default=2,
+        help='AXL worker threads per Cucm cluster without axl_max_concurrency in cucm.json, the most concurrent AXL requests sent to the cluster'
+    )
+    parser.add_argument(
+        '--cucm-idle-timeout', type=int, default=300,
+        help='Seconds before an unused Cucm session is closed'
+    )
+    parser.add_argument(
+        '--state-file', default='PagerDutyOnCall.db',
+        help='Path of the state store, relative paths are in the app directory'
+    )
+    parser.add_argument(
+        '--full-reconcile-interval', type=int, default=3600,
+        help='Seconds after which an unchanged schedule is fully reconciled'
+    )
+    parser.add_argument(
+        '--force-reconcile', action='store_true',
+        help='Fully reconcile every schedule, ignoring the state store'
+    )
+    parser.add_argument(
+        '--cache-file', default='PagerDutyCache.json',
+        help='Path of the PagerDuty object cache, relative paths are in the app directory'
+    )
+    parser.add_argument(
+        '--cache-ttl', type=int, default=300,
+        help='Seconds a cached PagerDuty object is used without revalidation'
+    )
+    parser.add_argument(
+        '--cache-size', type=int, default=1000,
+        help='Maximum number of cached PagerDuty objects'
+    )
+    parser.add_argument(
+        '--reconcile-all', action='store_true',
+        help='Resolve every schedule, then apply only the changed pilot lines per cluster'
+    )
+    parser.add_argument(
+        '--plan', action='store_true',
+        help='Print the changes a reconcile would make, without changing Cucm or sending email'
+    )
+    parser.add_argument(
+        '--plan-file',
+        help='With --plan, also write the plan as JSON to this file'
+    )
+    parser.add_argument(
+        '--apply-plan',
+        help='Apply a plan written by --plan-file without reading PagerDuty or Cucm'
+    )
+    parser.add_argument(
+        '--plan-max-age', type=float, default=900,
+        help='Refuse to apply a plan written more than this many seconds ago'
+    )
+    parser.add_argument(
+        '--shard', type=parse_shard,
+        help='Only process the schedules of shard i of N, EG: 0/4'
+    )
+    parser.add_argument(
+        '--lease-file',
+        help='Path of the lease database shared by the workers, relative paths are in the app directory, defaults to PagerDutyLeases.db with --shard'
+    )
+    parser.add_argument(
+        '--lease-ttl', type=int, default=900,
+        help='Seconds after which the leases of a dead worker expire'
+    )
+    parser.add_argument(
+        '--daemon', action='store_true',
+        help='Keep running and process schedules as their on call hands off'
+    )
+    parser.add_argument(
+        '--handoff-delay', type=int, default=5,
+        help='Seconds after a handoff before the schedule is processed'
+    )
+    parser.add_argument(
+        '--reconcile-interval', type=int, default=900,
+        help='Seconds between reconciles of every schedule in daemon mode'
+    )
+    parser.add_argument(
+        '--webhook-port', type=int, default=0,
+        help='Port to receive PagerDuty webhooks on, implies --daemon, 0 is off'
+    )
+    parser.add_argument(
+        '--webhook-secret', default=os.environ.get('PD_WEBHOOK_SECRET'),
+        help='PagerDuty webhook signing secret, defaults to $PD_WEBHOOK_SECRET'
+    )
+    parser.add_argument(
+        '--webhook-debounce', type=float, default=2,
+        help='Seconds of quiet before a burst of webhook events is processed'
+    )
+    parser.add_argument(
+        '--mail-digest-window', type=float, default=5,
+        help='Seconds to collect emails for the same recipients into one digest'
+    )
+    parser.add_argument(
+        '--pd-pool-size', type=int, default=10,
+        help='Number of keep-alive connections kept per PagerDuty host'
+    )
+    parser.add_argument(
+        '--pd-retries', type=int, default=3,
+        help='Number of retries for failed PagerDuty requests'
+    )
+    parser.add_argument(
+        '--pd-backoff', type=float, default=0.5,
+        help='Backoff factor in seconds between PagerDuty retries'
+    )
+    parser.add_argument(
+        '--pd-rate', type=float, default=10,
+        help='Starting PagerDuty requests per second per api token'
+    )
+    parser.add_argument(
+        '--pd-max-rate', type=float, default=50,
+        help='Maximum PagerDuty requests per second per api token'
+    )
+    parser.add_argument(
+        '--pd-concurrency', type=int, default=4,
+        help='Starting concurrent PagerDuty requests per api token'
+    )
+    parser.add_argument(
+        '--pd-max-concurrency', type=int, default=32,
+        help='Maximum concurrent PagerDuty requests per api token, whatever the number of --workers'
+    )
+    parser.add_argument(
+        '--connect-timeout', type=float, default=5,
+        help='Seconds to wait for a PagerDuty or AXL connection'
+    )
+    parser.add_argument(
+        '--read-timeout', type=float, default=60,
+        help='Seconds to wait for a PagerDuty or AXL response'
+    )
+    parser.add_argument(
+        '--breaker-threshold', type=int, default=5,
+        help='Consecutive failures which mark a PagerDuty host or Cucm cluster unavailable'
+    )
+    parser.add_argument(
+        '--breaker-reset', type=float, default=30,
+        help='Seconds before a request is retried to an unavailable upstream'
+    )
+    parser.add_argument(
+        '--record',
+        help='Record every PagerDuty and AXL exchange to this JSONL cassette'
+    )
+    parser.add_argument(
+        '--replay',
+        help='Answer every PagerDuty and AXL request from this JSONL cassette'
+    )
+    parser.add_argument(
+        '--replay-speed', type=float, default=0,
+        help='Replay this many times faster than recorded, EG: 1 is the recorded latency and 2 is half of it. 0 is no delay'
+    )
+    parser.add_argument(
+        '--metrics-file',
+        help='Write Prometheus metrics to this textfile collector file after each pass'
+    )
+    parser.add_argument(
+        '--metrics-port', type=int, default=0,
+        help='Port to serve Prometheus metrics on at /metrics, 0 is off'
+    )
+    parser.add_argument(
+        '--metrics-json',
+        help='Write a JSON summary of each pass to this file'
+    )
+    return parser.parse_args(argv)
+
+
+class PassRunner():
+
+    def __init__(
+        self, args, path, config_loader, time_zone, smtp_host, smtp_port,
+        smtp_sender, schedule_log
+    ):
+        # The parsed command line arguments
+        self.args = args
+        # Loads the compiled config, reloading it when the files change
+        self.config_loader = config_loader
+        # Define the Time Zone and smtp settings of every schedule
+        self.time_zone = time_zone
+        self.smtp_host = smtp_host
+        self.smtp_port = smtp_port
+        self.smtp_sender = smtp_sender
+        # The in memory log records of each schedule
+        self.schedule_log = schedule_log
+        self.logger = logging.getLogger('on_call_forward')
+
+        # Pace the requests of each api token under the PagerDuty rate
+        # limits, a replay is not paced
+        rate_limiter = None
+        if not args.replay:
+            rate_limiter = RateLimiter(
+                args.pd_rate, args.pd_max_rate,
+                args.pd_concurrency, args.pd_max_concurrency
+            )
+        # Create the pooled PagerDuty client shared by every schedule
+        self.client = get_client(
+            pool_size=args.pd_pool_size, retries=args.pd_retries,
+            backoff_factor=args.pd_backoff, rate_limiter=rate_limiter
+        )
+        # Open the store of the state applied by previous passes
+        self.state_store = StateStore(
+            os.path.join(path, args.state_file),
+            0 if args.force_reconcile else args.full_reconcile_interval
+        )
+        # Cache the PagerDuty user and contact method objects
+        self.resource_cache = ResourceCache(
+            os.path.join(path, args.cache_file), args.cache_size, args.cache_ttl
+        )
+        # Run the AXL work of each cluster on its own workers
+        self.cluster_queues = ClusterWorkQueues(args.axl_concurrency)
+        # Time every stage of the pipeline
+        self.metrics = Metrics()
+        self.metrics_server = None
+        if args.metrics_port:
+            self.metrics_server = MetricsServer(
+                ('', args.metrics_port), self.metrics)
+            self.metrics_server.start()
+            self.logger.info('Serving metrics on port {}'.format(
+                args.metrics_port))
+        # Send the email notifications from a background queue
+        self.notifier = NotificationDispatcher(
+            smtp_host, smtp_port, smtp_sender,
+            digest_window=args.mail_digest_window, metrics=self.metrics,
+            dry_run=args.plan
+        )
+
+        # Fail the requests to an unavailable PagerDuty host or Cucm cluster
+        # immediately, rather than waiting on every schedule to time out
+        self.breakers = CircuitBreakers(
+            args.breaker_threshold, args.breaker_reset,
+            on_open=self.alert_outage, on_close=self.alert_recovered,
+            metrics=self.metrics
+        )
+        # An outage still open from an earlier run is probed, not alerted again
+        self.breakers.restore(self.state_store.get_outages())
+        self.timeout = (args.connect_timeout, args.read_timeout)
+
+        # Record or replay the PagerDuty and AXL traffic
+        self.recorder = self.cassette = None
+        if args.record:
+            self.recorder = CassetteRecorder(args.record)
+        elif args.replay:
+            self.cassette = Cassette(args.replay, args.replay_speed)
+        self.hook_session(self.client)
+        protect_session(self.client, self.breakers, timeout=self.timeout)
+        # Share one long lived session per Cucm cluster across the schedules
+        self.cucm_registry = CucmRegistry(
+            idle_timeout=args.cucm_idle_timeout,
+            session_hook=self.cucm_session_hook
+        )
+
+        # Lease the schedules and pilot lines of each pass, so that no two
+        # worker processes handle the same ones at once
+        self.lease_store = None
+        if args.shard or args.lease_file:
+            self.lease_store = LeaseStore(
+                os.path.join(path, args.lease_file or 'PagerDutyLeases.db'),
+                args.lease_ttl
+            )
+
+    def new_schedule(self, config, schedule_id, on_call_data=None):
+        # Create an instance of the PagerDuty Class for "schedule_id" using
+        # the shared clients, stores and notifier
+        return PagerDuty(
+            schedule_id, config, self.time_zone,
+            self.smtp_host, self.smtp_port, self.smtp_sender,
+            on_call_data=on_call_data, client=self.client,
+            cucm_registry=self.cucm_registry, state_store=self.state_store,
+            resource_cache=self.resource_cache, notifier=self.notifier,
+            schedule_log=self.schedule_log, metrics=self.metrics,
+            breakers=self.breakers
+        )
+
+    def hook_session(self, session):
+        # Record or replay the traffic of "session"
+        if self.recorder is not None:
+            record_session(session, self.recorder)
+        elif self.cassette is not None:
+            replay_session(session, self.cassette)
+
+    def cucm_session_hook(self, session):
+        self.hook_session(session)
+        protect_session(
+            session, self.breakers, session.cucm_axl_url, self.timeout,
+            axl_failure_statuses
+        )
+
+    def get_outage_audience(self, upstream):
+        # The schedules depending on "upstream" and their recipients
+        schedules = get_dependent_schedules(self.config_loader.get(), upstream)
+        return schedules, sorted(set(r for s in schedules for r in s.mail_rcpt))
+
+    def alert_outage(self, upstream, started, error):
+        # One email per outage, rather than one per schedule. A dry run
+        # sends no email, so leaves the outage for the next run to alert
+        if not self.args.plan:
+            self.state_store.start_outage(upstream, started)
+        schedules, recipients = self.get_outage_audience(upstream)
+        if recipients:
+            self.notifier.submit(recipients, outage_subject, outage_msg.format(
+                upstream, self.args.breaker_threshold, self.args.breaker_reset,
+                '\n        '.join(s.pd_summary for s in schedules), error
+            ))
+
+    def alert_recovered(self, upstream, seconds, rejected, affected):
+        if not self.args.plan:
+            self.state_store.end_outage(upstream)
+        schedules, recipients = self.get_outage_audience(upstream)
+        if recipients:
+            self.notifier.submit(
+                recipients, recovered_subject, recovered_msg.format(
+                    upstream, seconds, rejected,
+                    '\n        '.join(affected) or 'None'
+                )
+            )
+
+    @contextmanager
+    def leased(self, config, schedule_ids):
+        # Yields the schedule ids whose leases were acquired, releasing
+        # them when the block exits
+        if self.lease_store is None:
+            yield schedule_ids
+            return
+        groups = dict((s, get_lease_keys(config, s)) for s in schedule_ids)
+        acquired = self.lease_store.acquire(groups)
+        if len(acquired) < len(groups):
+            self.logger.info(
+                '{} schedules are leased by another worker, skipping them'.format(
+                    len(groups) - len(acquired))
+            )
+        held = dict((s, groups[s]) for s in acquired)
+        try:
+            # Renewed while the pass runs, however long it takes
+            with self.lease_store.keep_alive(held):
+                yield [s for s in schedule_ids if s in acquired]
+        finally:
+            self.lease_store.release(held)
+
+    def write_metrics(self):
+        # Export the metrics of the pass that just finished
+        if self.args.metrics_file:
+            self.metrics.write_textfile(self.args.metrics_file)
+        if self.args.metrics_json:
+            with open(self.args.metrics_json, 'w') as f:
+                dump(self.metrics.summary(), f, indent=2)
+
+    def finish_pass(self, report):
+        # Save the cache, export the metrics and report the pass
+        self.resource_cache.save()
+        self.write_metrics()
+        self.logger.info(report)
+        print(report)
+
+    def start_pass(self):
+        # The config and the schedules of this shard for a new pass
+        config = self.config_loader.get()
+        # Only this run's records are attached to error emails
+        self.schedule_log.clear()
+        self.metrics.start_run()
+        return config, [
+            s for s in config.schedules if in_shard(s, self.args.shard)
+        ]
+
+    def run_pass(self, schedule_ids=None):
+        # Run a pass over "schedule_ids", or every schedule if None,
+        # returns the on call data used
+        config, shard_ids = self.start_pass()
+        if schedule_ids is None:
+            schedule_ids = shard_ids
+        # Ignore any schedules removed from the config or of another shard
+        shard_ids = set(shard_ids)
+        schedule_ids = [s for s in schedule_ids if s in shard_ids]
+        # Only the schedules of this shard not leased by another worker
+        with self.leased(config, schedule_ids) as schedule_ids:
+            return self.run_schedule_pass(config, schedule_ids)
+
+    def finish_schedule(self, p, start, snapshot):
+        # The AXL side of a resolved schedule, on its cluster's workers
+        p.cfwd_all_snapshot = snapshot.result()
+        result = run_schedule(p, self.logger, 'process_on_call_schedule')
+        return ScheduleResult(
+            p.schedule_id, p.schedule.pd_summary, result,
+            time.monotonic() - start
+        )
+
+    def run_schedule_pass(self, config, schedule_ids):
+        # Run a pass over the leased "schedule_ids"
+        # Retrieve the on call data for all of the schedules up front
+        on_call_data = get_bulk_on_call_data(
+            config, schedule_ids, self.time_zone, client=self.client,
+            metrics=self.metrics
+        )
+        # The schedules whose line still has to be checked in Cucm, with
+        # the time their processing started
+        resolved = {}
+
+        def process_schedule(schedule_id):
+            start = time.monotonic()
+            self.logger.info('Processing Schedule "{}"'.format(
+                config.schedules[schedule_id].pd_summary))
+            p = self.new_schedule(
+                config, schedule_id, on_call_data.get(schedule_id))
+            self.logger.info(
+                'Successfull instantiated Class "{}" as p'.format(p.__class__.__name__))
+            # Resolve the PagerDuty side on this worker
+            result = run_schedule(p, self.logger, 'resolve_on_call_line')
+            if p.desired is not None:
+                # Finished once the lines of every such schedule are read
+                resolved[schedule_id] = (p, start)
+            # Skipped as unchanged, failed, or still to check in Cucm
+            return ScheduleResult(
+                schedule_id, config.schedules[schedule_id].pd_summary,
+                result, time.monotonic() - start
+            )
+
+        # Iterate through the input Data and process each schedule.
+        start = time.monotonic()
+        results, _ = run_schedules(
+            list(schedule_ids), process_schedule, self.args.workers
+        )
+        # Read the call forward all values of only the lines still to
+        # check, each cluster on its own workers. When every schedule was
+        # skipped Cucm is not queried at all
+        lines_by_cluster = {}
+        for p, _ in resolved.values():
+            lines_by_cluster.setdefault(
+                p.desired.cluster.cucm_axl_url, set()
+            ).add((p.desired.number_data.pattern,
+                   p.desired.number_data.on_call_partition))
+        snapshots = submit_cluster_reads(
+            config, self.cucm_registry, dict(
+                (url, tuple(sorted(lines)))
+                for url, lines in lines_by_cluster.items()
+            ), self.metrics, self.cluster_queues
+        )
+        finished = dict(
+            (schedule_id, self.cluster_queues.submit(
+                p.desired.cluster, self.finish_schedule, p, start,
+                snapshots[p.desired.cluster.cucm_axl_url]
+            )) for schedule_id, (p, start) in resolved.items()
+        )
+        results = [
+            finished[r.schedule_id].result() if r.schedule_id in finished
+            else r for r in results
+        ]
+        wall_clock = time.monotonic() - start
+        # Report the time taken and the result of each schedule
+        report = format_run_report(results, wall_clock)
+        report += '\nPagerDuty requests: {requests}, connections opened: {connections_opened}, connections reused: {connections_reused}'.format(
+            **self.client.stats.as_dict())
+        if self.client.rate_limiter is not None:
+            report += '\n' + self.client.rate_limiter.summary()
+        report += '\n' + self.resource_cache.summary()
+        report += '\n' + self.cucm_registry.summary()
+        report += '\n' + self.breakers.summary()
+        self.finish_pass(report)
+        return on_call_data
+
+    def build_plan(self, config, schedule_ids):
+        # Read everything a reconcile of "schedule_ids" needs without
+        # writing anything. Returns the plan, the resolved PagerDuty
+        # instances and the start time
+        start = time.monotonic()
+        # Read each cluster on its own workers while PagerDuty is resolved
+        snapshots = submit_cluster_reads(
+            config, self.cucm_registry, get_lines_by_cluster(
+                config,
+                None if len(schedule_ids) == len(config.schedules)
+                else schedule_ids
+            ), self.metrics, self.cluster_queues
+        )
+        on_call_data = get_bulk_on_call_data(
+            config, schedule_ids, self.time_zone, client=self.client,
+            metrics=self.metrics
+        )
+        instances = {}
+
+        def resolve_schedule(schedule_id):
+            # Resolve the PagerDuty side of the schedule
+            p = self.new_schedule(
+                config, schedule_id, on_call_data.get(schedule_id))
+            instances[schedule_id] = p
+            return run_schedule(p, self.logger, 'resolve')
+
+        run_schedules(schedule_ids, resolve_schedule, self.args.workers)
+        snapshot = {}
+        for future in snapshots.values():
+            snapshot.update(future.result())
+        for p in instances.values():
+            p.cfwd_all_snapshot = snapshot
+        for line, ids in find_config_conflicts(config).items():
+            self.logger.error(
+                'Pilot line {} is configured on schedules {}'.format(
+                    line, ', '.join(ids))
+            )
+        plan = plan_reconcile(
+            [p.desired for p in instances.values() if p.desired], snapshot
+        )
+        for line, ids in plan.conflicts.items():
+            self.logger.error(
+                'Pilot line {} is claimed by schedules {} with different numbers, it was not changed'.format(
+                    line, ', '.join(ids))
+            )
+        return plan, instances, start
+
+    def run_plan_pass(self):
+        # Print the changes a reconcile would make, with no writes to Cucm
+        # and no emails
+        config, schedule_ids = self.start_pass()
+        plan, instances, start = self.build_plan(config, schedule_ids)
+        report = format_plan(plan)
+        report += '\nPlanned in {:.2f}s wall clock time'.format(
+            time.monotonic() - start)
+        if self.args.plan_file:
+            with open(self.args.plan_file, 'w') as f:
+                dump(dump_plan(plan, [
+                    p.desired for p in instances.values() if p.desired
+                ]), f, indent=2)
+            report += '\nPlan written to "{}"'.format(self.args.plan_file)
+        self.finish_pass(report)
+
+    def run_apply_plan_pass(self):
+        # Apply a plan saved by --plan without reading PagerDuty or Cucm
+        config = self.start_pass()[0]
+        start = time.monotonic()
+        with open(self.args.apply_plan) as f:
+            data = loads(f.read())
+        # An old plan would forward the lines to whoever was on call
+        # when it was written
+        age = time.time() - data['created']
+        if age > self.args.plan_max_age:
+            self.logger.error(
+                'The plan is {:.0f}s old, not applying it'.format(age))
+            sys.exit(
+                'The plan is {:.0f}s old, older than --plan-max-age {:.0f}s. '
+                'Write a new one with --plan'.format(
+                    age, self.args.plan_max_age)
+            )
+        plan, desired = load_plan(data, config)
+        # Only the planned schedules not leased by another worker
+        with self.leased(config, list(desired.keys())) as schedule_ids:
+            schedule_ids = set(schedule_ids)
+            plan = plan._replace(changes=[
+                c for c in plan.changes if c.schedule_id in schedule_ids])
+            with self.metrics.time('apply_plan'):
+                applied = apply_plan(
+                    plan, config, self.cucm_registry,
+                    cluster_queues=self.cluster_queues
+                )
+                # Retry the lines of a failed batch one updateLine at a time
+                failed = [c for c, ok in applied.items() if not ok]
+                if failed:
+                    applied.update(apply_plan(
+                        plan._replace(changes=failed), config,
+                        self.cucm_registry, batch=False,
+                        cluster_queues=self.cluster_queues
+                    ))
+            results = []
+            for change, ok in applied.items():
+                p = self.new_schedule(config, change.schedule_id)
+                if ok:
+                    p.record_applied_change(desired[change.schedule_id])
+                else:
+                    with capture(p.schedule_id):
+                        self.logger.error(
+                            'The planned change of {} failed'.format(
+                                change.pattern)
+                        )
+                    p.exception_cleanup(
+                        'The planned call forward all change of {} to {} failed'.format(
+                            change.pattern, change.desired)
+                    )
+                results.append(ScheduleResult(
+                    p.schedule_id, p.schedule.pd_summary,
+                    'updated' if ok else 'error', 0
+                ))
+            self.write_metrics()
+            report = format_run_report(results, time.monotonic() - start)
+            self.logger.info(report)
+            print(report)
+
+    def fall_back(self, p):
+        # Process a reconciled schedule on its own. Clear the "resolved"
+        # result first, so that the state records the value it reads or
+        # writes rather than the desired number
+        p.result = None
+        p.result = run_schedule(p, self.logger, 'process_on_call_schedule')
+
+    def run_reconcile_pass(self):
+        # Resolve the desired state of every pilot line, diff it against
+        # a bulk snapshot of each cluster and apply only the changes
+        config, schedule_ids = self.start_pass()
+        # Only the schedules not leased by another worker
+        with self.leased(config, schedule_ids) as schedule_ids:
+            plan, instances, start = self.build_plan(config, schedule_ids)
+            # Apply the minimal set of changes, then notify each schedule
+            with self.metrics.time('apply_plan'):
+                applied = apply_plan(
+                    plan, config, self.cucm_registry,
+                    cluster_queues=self.cluster_queues
+                )
+            for change, ok in applied.items():
+                p = instances[change.schedule_id]
+                if ok:
+                    p.record_applied_change(p.desired)
+                else:
+                    self.fall_back(p)
+            # Lines missing from the snapshot fall back to a getLine per schedule
+            for schedule_id in plan.missing.values():
+                self.fall_back(instances[schedule_id])
+            for p in instances.values():
+                # Resolved schedules with no change to apply
+                if p.result == 'resolved':
+                    p.result = 'unchanged'
+            results = [
+                ScheduleResult(
+                    s, config.schedules[s].pd_summary,
+                    instances[s].result or 'error', 0
+                ) for s in schedule_ids
+            ]
+            report = format_run_report(results, time.monotonic() - start)
+            report += '\nLines changed: {}, unchanged: {}, conflicts: {}, missing: {}'.format(
+                len(plan.changes), len(plan.unchanged), len(plan.conflicts),
+                len(plan.missing))
+            self.finish_pass(report)
+
+    def run_daemon(self):
+        # Keep running, processing each schedule just after its handoff
+        scheduler = HandoffScheduler(
+            self.run_pass,
+            handoff_delay=self.args.handoff_delay,
+            reconcile_interval=self.args.reconcile_interval
+        )
+        signal.signal(signal.SIGTERM, lambda signum, frame: scheduler.stop())
+        webhook_server = None
+        if self.args.webhook_port:
+            # Queue the schedules named in webhook events for processing
+            webhook_server = WebhookServer(
+                ('', self.args.webhook_port), self.args.webhook_secret,
+                scheduler.request, debounce=self.args.webhook_debounce
+            )
+            webhook_server.start()
+            self.logger.info('Receiving PagerDuty webhooks on port {}'.format(
+                self.args.webhook_port))
+        try:
+            scheduler.run_forever()
+        except KeyboardInterrupt:
+            scheduler.stop()
+        finally:
+            if webhook_server is not None:
+                webhook_server.stop()
+
+    def close(self):
+        # Send the queued emails and close the sessions and stores
+        self.cluster_queues.shutdown()
+        self.notifier.close()
+        self.logger.info(self.notifier.summary())
+        self.cucm_registry.close()
+        self.state_store.close()
+        if self.lease_store is not None:
+            self.lease_store.close()
+        if self.recorder is not None:
+            self.recorder.close()
+            self.logger.info(self.recorder.summary())
+        if self.cassette is not None:
+            self.logger.info(self.cassette.summary())
+        # Include the emails sent after the last pass finished
+        self.write_metrics()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+
+
+def main(argv=None):
+
+    # Parse the command line arguments
+    args = parse_args(argv)
+    if args.webhook_port and not args.webhook_secret:
+        sys.exit('A webhook secret is required to receive webhooks')
+    if args.record and args.replay:
+        sys.exit('Only one of --record and --replay can be used')
 
     # Obtain the file path
     path = file_paths()
     # Define a function to send
-    log_file = 'PagerDutyOnCall.log'
+    log_file = args.log_file
     # Create an instance for our logger
     logger = logging.getLogger('on_call_forward')
     # Set the level to DEBUG
@@ -550,80 +1577,55 @@ def main():
         '%(asctime)s - %(name)s - %(funcName)s - %(levelname)s - %(message)s')
     fh.setFormatter(formatter)
     ch.setFormatter(formatter)
+    # Keep the recent records of each schedule in memory for error emails
+    schedule_log = ScheduleLogHandler()
+    schedule_log.setFormatter(formatter)
     # add the handlers to the logger
     logger.addHandler(fh)
     logger.addHandler(ch)
+    logger.addHandler(schedule_log)
     # Define our input variables
     logger.info('Setting the appropriate input and config file paths')
     # Define our input variables
     logger.info('Initialising input variables')
     # Define the path to the Json input file
-    data_file_path = os.path.join(path, 'schedule_data.json')
+    data_file_path = os.path.join(path, args.data_file)
     # Define the path to the Json input file
-    cucm_file_path = os.path.join(path, 'cucm.json')
+    cucm_file_path = os.path.join(path, args.cucm_file)
     # Define the Time Zone used for scheduling
     time_zone = 'UTC'
     # Define the smtp relay host
-    smtp_host = 'relaysmtp.hds.int'
+    smtp_host = args.smtp_host
     # Define the smtp port
-    smtp_port = 25
+    smtp_port = args.smtp_port
     # Smtp sender email
     smtp_sender = 'PagerDutyCfwdAll@bigCorp.com'
-    # Open the input data File
-    data = loads(open(data_file_path, 'r').read())
-    logger.info('Successfully opened and read "{}"'.format(data_file_path))
-    # Open the cucm data input file
-    cucm = loads(open(cucm_file_path, 'r').read())
-    logger.info('Successfully opened and read "{}"'.format(cucm_file_path))
-
-    # Iterate through the input Data and process each schedule.
-    for schedule_id in data.keys():
-        logger.info('Processing Schedule "{}"'.format(
-            data[schedule_id]['pd_summary']))
-        # Create an instance of the PagerDuty Class
-        p = PagerDuty(
-            schedule_id, data, cucm, time_zone,
-            smtp_host, smtp_port, smtp_sender
-        )
-        logger.info(
-            'Successfull instantiated Class "{}" as p'.format(p.__class__.__name__))
-        logger.info('Calling "{}".run()'.format(p.__class__.__name__))
+    # Open, validate and compile the input data and cucm data files,
+    # they are reloaded whenever they change
+    config_loader = ConfigLoader(data_file_path, cucm_file_path)
+    logger.info('Successfully opened and read "{}" and "{}"'.format(
+        data_file_path, cucm_file_path))
 
-        # Attempt to call the run method
-        try:
-            p.run()
-        except OnCallDataNotReturned as e:
-            logger.critical('Caught Exception {}'.format(repr(e)))
-            # Run the Exception cleanup
-            p.exception_cleanup(repr(e))
-        except Escalation1NotFound as e:
-            logger.critical('Caught Exception {}'.format(repr(e)))
-            # Run the Exception cleanup
-            p.exception_cleanup(repr(e))
-        except ContactMethodNotFound as e:
-            logger.critical('Caught Exception {}'.format(repr(e)))
-            # Run the Exception cleanup
-            p.exception_cleanup(repr(e))
-        except MobileContactDataNotReturned as e:
-            logger.critical('Caught Exception {}'.format(repr(e)))
-            # Run the Exception cleanup
-            p.exception_cleanup(repr(e))
-        except CucmDataNotFound as e:
-            logger.critical('Caught Exception {}'.format(repr(e)))
-            # Run the Exception cleanup
-            p.exception_cleanup(repr(e))
-        except CucmCallFwdAllRetrieveError as e:
-            logger.critical('Caught Exception {}'.format(repr(e)))
-            # Run the Exception cleanup
-            p.exception_cleanup(repr(e))
-        except CucmSetCallFwdAllError as e:
-            logger.critical('Caught Exception {}'.format(repr(e)))
-            # Run the Exception cleanup
-            p.exception_cleanup(repr(e))
-        except Exception as e:
-            logger.critical('Caught Unhandled Exception {}'.format(repr(e)))
-            # Run the Exception cleanup
-            p.exception_cleanup(repr(e))
+    # Share the clients, stores and notifier across every pass
+    runner = PassRunner(
+        args, path, config_loader, time_zone, smtp_host, smtp_port,
+        smtp_sender, schedule_log
+    )
+    # Always send the queued emails and close the stores, even when a
+    # pass raises
+    try:
+        if args.plan:
+            runner.run_plan_pass()
+        elif args.apply_plan:
+            runner.run_apply_plan_pass()
+        elif args.reconcile_all:
+            runner.run_reconcile_pass()
+        elif args.daemon or args.webhook_port:
+            runner.run_daemon()
+        else:
+            runner.run_pass()
+    finally:
+        runner.close()
 
 
 if __name__ == "__main__":
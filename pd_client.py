@@ -0,0 +1,145 @@
+import threading
+from inspect import signature
+from requests import Session
+from requests.adapters import BaseAdapter, HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+
+class ConnectionStats():
+
+    def __init__(self):
+        # Protect the counters across threads
+        self.lock = threading.Lock()
+        # The number of requests sent through the client
+        self.requests = 0
+        # The number of new TCP / TLS connections that were opened
+        self.connections_opened = 0
+
+    def increment(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    @property
+    def connections_reused(self):
+        return max(self.requests - self.connections_opened, 0)
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'connections_opened': self.connections_opened,
+            'connections_reused': self.connections_reused
+        }
+
+
+def counting_pool(pool_class, stats):
+    # Build a connection pool class which counts new connections
+    class CountingConnectionPool(pool_class):
+
+        def _new_conn(self):
+            stats.increment('connections_opened')
+            return super()._new_conn()
+
+    return CountingConnectionPool
+
+
+class CountingAdapter(HTTPAdapter):
+
+    def __init__(self, stats, **kwargs):
+        self.stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        # Swap in our counting connection pools
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': counting_pool(HTTPConnectionPool, self.stats),
+            'https': counting_pool(HTTPSConnectionPool, self.stats)
+        }
+
+    def send(self, request, **kwargs):
+        self.stats.increment('requests')
+        return super().send(request, **kwargs)
+
+
+class RateLimitAdapter(BaseAdapter):
+
+    def __init__(self, adapter, rate_limiter):
+        super().__init__()
+        # The adapter which really sends the requests
+        self.adapter = adapter
+        self.rate_limiter = rate_limiter
+
+    def send(self, request, **kwargs):
+        # PagerDuty rate limits each api token, a 429 is retried once
+        # the bucket allows it
+        bucket = self.rate_limiter.get_bucket(
+            request.headers.get('Authorization'))
+        for attempt in range(self.rate_limiter.max_retries + 1):
+            bucket.acquire()
+            try:
+                response = self.adapter.send(request, **kwargs)
+            except Exception:
+                bucket.release()
+                raise
+            bucket.release(response)
+            if response.status_code != 429:
+                break
+            if attempt < self.rate_limiter.max_retries:
+                response.close()
+        return response
+
+    def close(self):
+        self.adapter.close()
+
+
+class PagerDutyClient(Session):
+
+    def __init__(
+        self, pool_size=10, retries=3, backoff_factor=0.5, verify=False,
+        rate_limiter=None
+    ):
+        # Initialise the "Session" super class
+        super().__init__()
+        # Turn off https certificate verification
+        self.verify = verify
+        # Counters to confirm connections are reused
+        self.stats = ConnectionStats()
+        # Retry idempotent requests on connection errors and server errors
+        retry = Retry(
+            total=retries, backoff_factor=backoff_factor,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset(['GET']),
+            raise_on_status=False
+        )
+        adapter = CountingAdapter(
+            self.stats, pool_connections=pool_size,
+            pool_maxsize=pool_size, max_retries=retry
+        )
+        # Paces the requests of each api token, None sends immediately.
+        # Mounted below the circuit breakers of "protect_session" so that
+        # a request failed fast never waits for a token
+        self.rate_limiter = rate_limiter
+        if rate_limiter is not None:
+            adapter = RateLimitAdapter(adapter, rate_limiter)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+
+# The process wide clients shared by every schedule, keyed by their
+# settings
+_clients = {}
+_client_lock = threading.Lock()
+
+
+def get_client(**kwargs):
+    # Return the shared client with these settings, creating it on first
+    # use. A call with different settings gets a client of its own rather
+    # than one which silently ignores them
+    settings = signature(PagerDutyClient).bind(**kwargs)
+    settings.apply_defaults()
+    key = tuple(sorted(settings.arguments.items()))
+    with _client_lock:
+        if key not in _clients:
+            _clients[key] = PagerDutyClient(**kwargs)
+        return _clients[key]
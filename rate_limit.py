@@ -0,0 +1,170 @@
+import time
+import threading
+from email.utils import parsedate_to_datetime
+
+
+def parse_retry_after(value, default):
+    # "Retry-After" is either a number of seconds or an http date
+    if not value:
+        return default
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return default
+
+
+def get_header_number(headers, names):
+    for name in names:
+        value = headers.get(name)
+        if value is not None:
+            try:
+                return float(value)
+            except ValueError:
+                return None
+    return None
+
+
+class AdaptiveBucket():
+
+    def __init__(
+        self, rate, max_rate, concurrency, max_concurrency, retry_after=5,
+        clock=time.monotonic
+    ):
+        # Returns the current time in seconds, replaceable for testing
+        self.clock = clock
+        # Requests per second, raised slowly while requests succeed and
+        # halved when the api rate limits us
+        self.rate = rate
+        self.min_rate = min(rate, 1)
+        self.max_rate = max_rate
+        # The token bucket holds up to a second of requests
+        self.tokens = 1
+        self.updated = self.clock()
+        # Concurrent requests allowed, adjusted in the same way
+        self.limit = concurrency
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        # Seconds to wait after a 429 with no "Retry-After"
+        self.retry_after = retry_after
+        # No request is sent before this time after a 429
+        self.paused_until = 0
+        self.condition = threading.Condition()
+        # Counters for the run summary
+        self.sent = 0
+        self.limited = 0
+
+    def refill(self, now):
+        self.tokens = min(
+            max(self.rate, 1), self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    def try_acquire(self):
+        # Take a token and return 0 if a request may be sent now, otherwise
+        # return the seconds to wait, None to wait for a "release".
+        # Called with the condition held
+        now = self.clock()
+        self.refill(now)
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.in_flight >= max(int(self.limit), 1):
+            return None
+        if self.tokens < 1:
+            return (1 - self.tokens) / self.rate
+        self.tokens -= 1
+        self.in_flight += 1
+        self.sent += 1
+        return 0
+
+    def acquire(self):
+        # Block until a request may be sent
+        with self.condition:
+            while True:
+                timeout = self.try_acquire()
+                if timeout == 0:
+                    return
+                self.condition.wait(timeout)
+
+    def release(self, response=None):
+        # Adjust the rate and concurrency from the response, None when
+        # the request failed without one
+        with self.condition:
+            self.in_flight -= 1
+            if response is not None and response.status_code == 429:
+                self.limited += 1
+                self.rate = max(self.rate / 2, self.min_rate)
+                self.limit = max(self.limit / 2, 1)
+                self.tokens = 0
+                self.paused_until = max(
+                    self.paused_until,
+                    self.clock() + parse_retry_after(
+                        response.headers.get('Retry-After'), self.retry_after)
+                )
+            elif response is not None:
+                # Additive increase, roughly one more request per second
+                # and one more concurrent request per window of successes
+                self.rate = min(self.rate + 1 / self.rate, self.max_rate)
+                self.limit = min(
+                    self.limit + 1 / max(self.limit, 1), self.max_concurrency)
+                self.apply_rate_limit_headers(response.headers)
+            self.condition.notify_all()
+
+    def apply_rate_limit_headers(self, headers):
+        # Never send faster than the remaining allowance spread over the
+        # rest of the rate limit window
+        remaining = get_header_number(
+            headers, ('ratelimit-remaining', 'x-ratelimit-remaining'))
+        reset = get_header_number(
+            headers, ('ratelimit-reset', 'x-ratelimit-reset'))
+        if remaining is None or reset is None:
+            return
+        if remaining < 1:
+            self.paused_until = max(
+                self.paused_until, self.clock() + reset)
+            return
+        self.rate = max(min(self.rate, remaining / max(reset, 1)), self.min_rate)
+
+
+class RateLimiter():
+
+    def __init__(
+        self, rate=10, max_rate=50, concurrency=4, max_concurrency=32,
+        max_retries=5, retry_after=5, clock=time.monotonic
+    ):
+        # The starting and maximum requests per second per api token
+        self.rate = rate
+        self.max_rate = max_rate
+        # The starting and maximum concurrent requests per api token
+        self.concurrency = concurrency
+        self.max_concurrency = max_concurrency
+        # How many times a rate limited request is retried
+        self.max_retries = max_retries
+        # Seconds to wait after a 429 with no "Retry-After"
+        self.retry_after = retry_after
+        self.clock = clock
+        # A bucket per "Authorization" header, PagerDuty limits per token
+        self.buckets = {}
+        # Protect the creation of buckets across threads
+        self.lock = threading.Lock()
+
+    def get_bucket(self, key):
+        with self.lock:
+            if key not in self.buckets:
+                self.buckets[key] = AdaptiveBucket(
+                    self.rate, self.max_rate, self.concurrency,
+                    self.max_concurrency, self.retry_after, self.clock
+                )
+            return self.buckets[key]
+
+    def summary(self):
+        with self.lock:
+            buckets = list(self.buckets.values())
+        return 'PagerDuty tokens: {}, requests: {}, rate limited: {}, rates: {}'.format(
+            len(buckets), sum(b.sent for b in buckets),
+            sum(b.limited for b in buckets),
+            ', '.join('{:.1f}/s'.format(b.rate) for b in buckets) or 'none'
+        )
@@ -0,0 +1,234 @@
+import logging
+import time
+from collections import namedtuple
+from normalize import compare_many
+
+
+# The pilot line a schedule's on call user should be forwarded from,
+# "cluster" is a config.Cluster and "number_data" a config.NumberData
+DesiredLine = namedtuple('DesiredLine', [
+    'schedule_id', 'user_id', 'user_name', 'country_code', 'address',
+    'e164_number', 'cluster', 'number_data'
+])
+
+# A pilot line whose call forward all value must change
+LineChange = namedtuple('LineChange', [
+    'cucm_axl_url', 'pattern', 'partition', 'pkid', 'current', 'desired',
+    'schedule_id'
+])
+
+# The result of planning a reconcile
+# changes: list of LineChange
+# unchanged: list of line keys already forwarding to the right number
+# conflicts: dict of line key to the schedule ids which claim it
+# missing: dict of line key to schedule id, lines not found in Cucm
+Plan = namedtuple('Plan', ['changes', 'unchanged', 'conflicts', 'missing'])
+
+
+def line_key(desired):
+    # (cucm_axl_url, pattern, partition) of a DesiredLine
+    return (
+        desired.cluster.cucm_axl_url, desired.number_data.pattern,
+        desired.number_data.on_call_partition
+    )
+
+
+def find_config_conflicts(config):
+    # Return the pilot lines which more than one schedule claims
+    return dict(
+        (line, schedule_ids)
+        for line, schedule_ids in config.schedules_by_line.items()
+        if len(schedule_ids) > 1
+    )
+
+
+def build_desired_index(desired_lines):
+    # Index the desired state by pilot line, a line may be claimed by
+    # more than one schedule
+    index = {}
+    for desired in desired_lines:
+        index.setdefault(line_key(desired), []).append(desired)
+    return index
+
+
+def plan_reconcile(desired_lines, snapshot):
+    # Diff the desired state against a bulk snapshot of Cucm, "snapshot"
+    # maps (cucm_axl_url, pattern, partition) to {"pkid", "destination"}.
+    # Lines claimed by schedules wanting different numbers are conflicts
+    # and are left alone
+    changes = []
+    unchanged = []
+    conflicts = {}
+    missing = {}
+    candidates = []
+    for key, claims in build_desired_index(desired_lines).items():
+        if len(set(c.e164_number for c in claims)) > 1:
+            conflicts[key] = tuple(sorted(c.schedule_id for c in claims))
+            continue
+        desired = claims[0]
+        if key not in snapshot:
+            missing[key] = desired.schedule_id
+            continue
+        candidates.append((key, desired, snapshot[key]))
+
+    # Compare every candidate line in one call
+    matches = compare_many(
+        (desired.number_data.regex, current['destination'], desired.address)
+        for key, desired, current in candidates
+        if current['destination']
+    )
+    matches = iter(matches)
+    for key, desired, current in candidates:
+        if current['destination'] and next(matches):
+            unchanged.append(key)
+            continue
+        changes.append(LineChange(
+            key[0], key[1], key[2], current['pkid'], current['destination'],
+            desired.e164_number, desired.schedule_id
+        ))
+    return Plan(changes, unchanged, conflicts, missing)
+
+
+def apply_plan(plan, config, cucm_registry, batch=True, cluster_queues=None):
+    # Apply the changes of a plan, one executeSQLUpdate per cluster when
+    # "batch" is set, otherwise one updateLine per changed line.
+    # The clusters are updated in parallel on "cluster_queues" if given.
+    # Returns a dict of LineChange to True if it was applied
+    by_cluster = {}
+    for change in plan.changes:
+        by_cluster.setdefault(change.cucm_axl_url, []).append(change)
+    applied = {}
+    if cluster_queues is None:
+        for cucm_axl_url, changes in by_cluster.items():
+            applied.update(apply_cluster_changes(
+                config, cucm_registry, cucm_axl_url, changes, batch))
+        return applied
+    futures = [
+        cluster_queues.submit(
+            config.clusters_by_url[cucm_axl_url], apply_cluster_changes,
+            config, cucm_registry, cucm_axl_url, changes, batch
+        ) for cucm_axl_url, changes in by_cluster.items()
+    ]
+    for future in futures:
+        applied.update(future.result())
+    return applied
+
+
+def apply_cluster_changes(config, cucm_registry, cucm_axl_url, changes, batch):
+    # Apply the changes of one cluster, returns a dict of LineChange to
+    # True if it was applied
+    logger = logging.getLogger('on_call_forward')
+    applied = {}
+    try:
+        cucm = cucm_registry.get(config.clusters_by_url[cucm_axl_url])
+        logger.info('Applying {} call forward all changes to "{}"'.format(
+            len(changes), cucm_axl_url))
+        if batch:
+            results = cucm.set_lines_cfwdall_values(
+                [(c.pkid, c.desired) for c in changes]
+            )
+            applied = dict(zip(changes, results))
+            if not all(results):
+                logger.error(
+                    '{} call forward all changes on "{}" updated fewer rows than expected'.format(
+                        results.count(False), cucm_axl_url)
+                )
+            return applied
+        for change in changes:
+            r = cucm.set_line_cfwdall_value(
+                change.pattern, change.partition, change.desired
+            )
+            applied[change] = r.status_code == 200
+    except Exception as e:
+        logger.error(
+            'The call forward all update of "{}" failed with {}'.format(
+                cucm_axl_url, repr(e))
+        )
+    # Changes not reached are left to the per schedule fallback
+    for change in changes:
+        applied.setdefault(change, False)
+    return applied
+
+
+def format_plan(plan):
+    # Build a plain text table of what a plan would change
+    lines = ['{:<10} {:<20} {:<16} {:<18} {:<18}'.format(
+        'schedule', 'pilot line', 'partition', 'current', 'desired')]
+    for c in sorted(plan.changes, key=lambda c: (c.schedule_id, c.pattern)):
+        lines.append('{:<10} {:<20} {:<16} {:<18} {:<18}'.format(
+            c.schedule_id, c.pattern, c.partition, c.current or '(none)',
+            c.desired
+        ))
+    for key, schedule_id in sorted(plan.missing.items()):
+        lines.append('{:<10} {:<20} {:<16} {:<18} {:<18}'.format(
+            schedule_id, key[1], key[2], '(not found)', '(getLine)'))
+    for key, schedule_ids in sorted(plan.conflicts.items()):
+        lines.append('{:<10} {:<20} {:<16} {:<18} {:<18}'.format(
+            ','.join(schedule_ids), key[1], key[2], '(conflict)',
+            '(not changed)'
+        ))
+    lines.append(
+        'Lines to change: {}, unchanged: {}, conflicts: {}, missing: {}'.format(
+            len(plan.changes), len(plan.unchanged), len(plan.conflicts),
+            len(plan.missing))
+    )
+    return '\n'.join(lines)
+
+
+def dump_plan(plan, desired_lines):
+    # A JSON serialisable form of a plan, each change carries the on call
+    # user so it can be applied and notified without repeating the reads
+    desired = dict((d.schedule_id, d) for d in desired_lines)
+    return {
+        'created': time.time(),
+        'changes': [
+            dict(change._asdict(), **dict(
+                (k, getattr(desired[change.schedule_id], k))
+                for k in ('user_id', 'user_name', 'country_code', 'address')
+            )) for change in plan.changes
+        ],
+        'unchanged': [list(key) for key in plan.unchanged],
+        'conflicts': [
+            {'line': list(key), 'schedule_ids': list(schedule_ids)}
+            for key, schedule_ids in plan.conflicts.items()
+        ],
+        'missing': [
+            {'line': list(key), 'schedule_id': schedule_id}
+            for key, schedule_id in plan.missing.items()
+        ]
+    }
+
+
+def load_plan(data, config):
+    # Rebuild the changes of a plan from "dump_plan" against "config".
+    # Returns the Plan and a dict of schedule id to its DesiredLine,
+    # changes for schedules or clusters no longer configured are dropped
+    logger = logging.getLogger('on_call_forward')
+    changes = []
+    desired = {}
+    for c in data['changes']:
+        schedule = config.schedules.get(c['schedule_id'])
+        cluster = config.clusters_by_url.get(c['cucm_axl_url'])
+        number_data = schedule.numbers.get(c['country_code']) \
+            if schedule is not None else None
+        if cluster is None or number_data is None:
+            logger.error(
+                'The planned change of {} for schedule "{}" is no longer configured, skipping it'.format(
+                    c['pattern'], c['schedule_id'])
+            )
+            continue
+        changes.append(LineChange(*(c[k] for k in LineChange._fields)))
+        desired[c['schedule_id']] = DesiredLine(
+            c['schedule_id'], c['user_id'], c['user_name'],
+            c['country_code'], c['address'], c['desired'], cluster,
+            number_data
+        )
+    return Plan(
+        changes,
+        [tuple(key) for key in data['unchanged']],
+        dict(
+            (tuple(c['line']), tuple(c['schedule_ids']))
+            for c in data['conflicts']
+        ),
+        dict((tuple(m['line']), m['schedule_id']) for m in data['missing'])
+    ), desired
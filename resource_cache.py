@@ -0,0 +1,93 @@
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from json import loads, dumps
+
+
+# A response served from the cache, it has the attributes of a
+# requests Response object that the callers use
+CachedResponse = namedtuple('CachedResponse', ['status_code', 'text', 'headers'])
+
+
+class ResourceCache():
+
+    def __init__(self, path=None, max_entries=1000, ttl=300):
+        # The file the cache is persisted to between passes, or None
+        self.path = path
+        # The maximum number of resources kept, least recently used go first
+        self.max_entries = max_entries
+        # Seconds a resource is served without asking PagerDuty again
+        self.ttl = ttl
+        # url -> {"text": ..., "etag": ..., "fetched_at": ...}
+        self.entries = OrderedDict()
+        # Protect the cache across threads
+        self.lock = threading.Lock()
+        # Counters for the run summary
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.load()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            entries = loads(open(self.path, 'r').read())
+        except ValueError:
+            return
+        for url, entry in entries.items():
+            # Entries from a previous pass are revalidated before use
+            entry['fetched_at'] = 0
+            self.entries[url] = entry
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            data = dumps(self.entries)
+        # Write to a temporary file so a crash never leaves a partial cache
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+    def store(self, url, text, etag):
+        with self.lock:
+            self.entries[url] = {
+                'text': text, 'etag': etag, 'fetched_at': time.time()
+            }
+            self.entries.move_to_end(url)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get(self, url, fetch):
+        # Return the resource at "url", "fetch" is called with any
+        # conditional request headers when PagerDuty must be asked
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is not None:
+                self.entries.move_to_end(url)
+                if time.time() - entry['fetched_at'] < self.ttl:
+                    self.hits += 1
+                    return CachedResponse(200, entry['text'], {})
+        headers = {}
+        if entry is not None and entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        r = fetch(headers)
+        if r.status_code == 304 and entry is not None:
+            # Our copy is still current
+            with self.lock:
+                self.revalidated += 1
+            self.store(url, entry['text'], entry['etag'])
+            return CachedResponse(200, entry['text'], r.headers)
+        with self.lock:
+            self.misses += 1
+        if r.status_code == 200:
+            self.store(url, r.text, r.headers.get('ETag'))
+        return r
+
+    def summary(self):
+        return 'PagerDuty cache hits: {}, revalidated: {}, misses: {}'.format(
+            self.hits, self.revalidated, self.misses
+        )
@@ -0,0 +1,178 @@
+import os
+import socket
+import sqlite3
+import logging
+import threading
+import time
+import argparse
+from contextlib import contextmanager
+from hashlib import sha1
+
+
+def parse_shard(value):
+    # Parse "i/N" into (i, N), for use as an argparse type
+    try:
+        index, count = (int(v) for v in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'A shard must be given as i/N, EG: 0/4')
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(
+            'The shard index must be from 0 to {}'.format(count - 1))
+    return index, count
+
+
+def shard_of(key, count):
+    # The shard "key" belongs to by rendezvous hashing, only the keys of
+    # a removed shard move when the number of shards changes
+    return max(
+        range(count),
+        key=lambda shard: sha1('{}:{}'.format(shard, key).encode()).digest()
+    )
+
+
+def in_shard(key, shard):
+    # "shard" is an (index, count) tuple, None selects every key
+    if shard is None:
+        return True
+    index, count = shard
+    return shard_of(key, count) == index
+
+
+def get_lease_keys(config, schedule_id):
+    # The schedule and every pilot line it forwards, no two workers may
+    # hold any of them at the same time
+    keys = ['schedule:' + schedule_id]
+    for number_data in config.schedules[schedule_id].numbers.values():
+        cluster = config.clusters.get(number_data.country_code)
+        if cluster is not None:
+            keys.append('line:{}|{}|{}'.format(
+                cluster.cucm_axl_url, number_data.pattern,
+                number_data.on_call_partition
+            ))
+    return keys
+
+
+class LeaseStore():
+
+    def __init__(self, path, ttl=900, owner=None, clock=time.time):
+        # Leases not released within "ttl" seconds expire, EG: when
+        # their worker died
+        self.ttl = ttl
+        # Returns the current time in seconds, the expiry times are shared
+        # across processes so this is the wall clock
+        self.clock = clock
+        # Identifies this worker process in the lease table
+        self.owner = owner or '{}:{}'.format(socket.gethostname(), os.getpid())
+        # The connection is shared by the worker threads, other
+        # processes wait on the database lock for up to 30 seconds
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        with self.lock:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS leases ('
+                'key TEXT PRIMARY KEY, '
+                'owner TEXT, '
+                'expires REAL)'
+            )
+
+    def acquire(self, groups):
+        # Lease every key of each group in "groups", a dict of name to
+        # keys, all or nothing per group. Returns the names acquired
+        now = self.clock()
+        acquired = set()
+        with self.lock:
+            # Take the write lock up front so that two workers can not
+            # both see a key as free
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.conn.execute(
+                    'DELETE FROM leases WHERE expires < ?', (now,))
+                held = dict(self.conn.execute(
+                    'SELECT key, owner FROM leases').fetchall())
+                for name, keys in groups.items():
+                    if any(held.get(k, self.owner) != self.owner for k in keys):
+                        continue
+                    self.conn.executemany(
+                        'INSERT OR REPLACE INTO leases (key, owner, expires) '
+                        'VALUES (?, ?, ?)',
+                        [(k, self.owner, now + self.ttl) for k in keys]
+                    )
+                    held.update((k, self.owner) for k in keys)
+                    acquired.add(name)
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+        return acquired
+
+    def renew(self, groups):
+        # Extend the leases of "groups" held by this worker. Returns the
+        # names of the groups it no longer fully holds, EG: when they
+        # expired and another worker took them
+        now = self.clock()
+        lost = set()
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                for name, keys in groups.items():
+                    renewed = self.conn.executemany(
+                        'UPDATE leases SET expires = ? '
+                        'WHERE key = ? AND owner = ?',
+                        [(now + self.ttl, k, self.owner) for k in keys]
+                    ).rowcount
+                    if renewed < len(keys):
+                        lost.add(name)
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+        return lost
+
+    @contextmanager
+    def keep_alive(self, groups):
+        # Renew the leases of "groups" every third of the ttl until the
+        # block exits, so that a pass longer than the ttl keeps them
+        logger = logging.getLogger('on_call_forward')
+        stop = threading.Event()
+
+        def run():
+            while not stop.wait(self.ttl / 3):
+                try:
+                    lost = self.renew(groups)
+                except sqlite3.Error as e:
+                    logger.error('Renewing the leases failed with {}'.format(
+                        repr(e)))
+                    continue
+                if lost:
+                    logger.error(
+                        'The leases of {} were taken by another worker'.format(
+                            ', '.join(sorted(lost)))
+                    )
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def release(self, groups):
+        # Release the keys of the groups in "groups" held by this worker
+        keys = [(k, self.owner) for group in groups.values() for k in group]
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.conn.executemany(
+                    'DELETE FROM leases WHERE key = ? AND owner = ?', keys)
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,83 @@
+import sqlite3
+import threading
+import time
+
+
+class StateStore():
+
+    def __init__(self, path, full_reconcile_interval=3600):
+        # Force a full pass of a schedule after this many seconds,
+        # catching any changes made directly in Cucm
+        self.full_reconcile_interval = full_reconcile_interval
+        # The connection is shared by the worker threads
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS schedule_state ('
+                'schedule_id TEXT PRIMARY KEY, '
+                'user_id TEXT, '
+                'e164_number TEXT, '
+                'cucm_value TEXT, '
+                'reconciled_at REAL)'
+            )
+            # The upstreams which were unavailable when a run finished,
+            # so that an outage is alerted once across runs
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS outages ('
+                'upstream TEXT PRIMARY KEY, '
+                'started REAL)'
+            )
+
+    def get(self, schedule_id):
+        # Return the last recorded state for the schedule as a dict
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT user_id, e164_number, cucm_value, reconciled_at '
+                'FROM schedule_state WHERE schedule_id = ?', (schedule_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(
+            ('user_id', 'e164_number', 'cucm_value', 'reconciled_at'), row
+        ))
+
+    def is_unchanged(self, schedule_id, user_id):
+        # The schedule can be skipped if the same user is still on call
+        # and it has been fully reconciled recently
+        state = self.get(schedule_id)
+        if state is None or state['user_id'] != user_id:
+            return False
+        return time.time() - state['reconciled_at'] \
+            < self.full_reconcile_interval
+
+    def record(self, schedule_id, user_id, e164_number, cucm_value):
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO schedule_state '
+                '(schedule_id, user_id, e164_number, cucm_value, reconciled_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (schedule_id, user_id, e164_number, cucm_value, time.time())
+            )
+
+    def get_outages(self):
+        # Return upstream -> the time its outage started
+        with self.lock:
+            return dict(self.conn.execute(
+                'SELECT upstream, started FROM outages').fetchall())
+
+    def start_outage(self, upstream, started):
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO outages (upstream, started) '
+                'VALUES (?, ?)', (upstream, started)
+            )
+
+    def end_outage(self, upstream):
+        with self.lock, self.conn:
+            self.conn.execute(
+                'DELETE FROM outages WHERE upstream = ?', (upstream,))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,30 @@
+import os
+import sys
+import pytest
+
+# The modules live at the top of the repository
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeClock():
+
+    def __init__(self, tick=0):
+        self.now = 1000.0
+        # Seconds that pass on every reading, EG: to let a pause expire
+        # without waiting for it
+        self.tick = tick
+
+    def __call__(self):
+        self.now += self.tick
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    # Passed as the "clock" of the code under test in place of the
+    # monotonic clock
+    return FakeClock()
@@ -0,0 +1,179 @@
+import io
+import time
+import pytest
+from requests import Response, Session, exceptions
+from requests.adapters import BaseAdapter
+from circuit import CircuitBreaker, CircuitBreakers, protect_session, \
+    axl_failure_statuses
+from custom_exceptions import UpstreamUnavailable
+from pd_client import PagerDutyClient
+from rate_limit import RateLimiter
+
+
+class StatusAdapter(BaseAdapter):
+    # Answers every request with "status", None raises a connection error
+
+    def __init__(self, status=200):
+        super().__init__()
+        self.status = status
+        self.sent = 0
+        self.timeouts = []
+
+    def send(self, request, **kwargs):
+        self.sent += 1
+        self.timeouts.append(kwargs.get('timeout'))
+        if self.status is None:
+            raise exceptions.ConnectionError('refused', request=request)
+        response = Response()
+        response.status_code = self.status
+        response.request = request
+        response.url = request.url
+        response.raw = io.BytesIO(b'')
+        return response
+
+    def close(self):
+        pass
+
+
+def make_session(adapter, breakers, **kwargs):
+    session = Session()
+    session.mount('http://', adapter)
+    protect_session(session, breakers, **kwargs)
+    return session
+
+
+def test_breaker_opens_after_the_threshold(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60, clock=clock)
+    assert not breaker.failure('error')
+    assert not breaker.failure('error')
+    # A success resets the count of consecutive failures
+    assert breaker.success() is None
+    assert not breaker.failure('error')
+    assert not breaker.failure('error')
+    assert breaker.failure('error')
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+    assert breaker.rejected == 1
+
+
+def test_half_open_lets_one_probe_through(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30, clock=clock)
+    breaker.failure('error')
+    assert not breaker.allow()
+    clock.advance(30)
+    assert breaker.allow()
+    assert breaker.state == 'half-open'
+    # Only the probe is sent until it completes
+    assert not breaker.allow()
+    # A failed probe reopens the breaker on the same outage
+    assert not breaker.failure('error')
+    assert breaker.state == 'open'
+    assert breaker.outages == 1
+    clock.advance(29)
+    assert not breaker.allow()
+    clock.advance(1)
+    assert breaker.allow()
+    seconds, rejected, affected = breaker.success()
+    assert breaker.state == 'closed'
+    assert rejected == 3
+
+
+def test_restored_outage_is_probed_at_once(clock):
+    breaker = CircuitBreaker(failure_threshold=5, reset_timeout=60, clock=clock)
+    breaker.restore(time.time() - 100)
+    assert breaker.allow()
+    assert not breaker.allow()
+    seconds, rejected, affected = breaker.success()
+    assert seconds >= 100
+
+
+def test_one_alert_per_outage(clock):
+    opened = []
+    closed = []
+    breakers = CircuitBreakers(
+        failure_threshold=2, reset_timeout=30,
+        on_open=lambda *args: opened.append(args),
+        on_close=lambda *args: closed.append(args),
+        clock=clock
+    )
+    for _ in range(5):
+        breakers.failure('https://cucm', 'HTTP 503')
+    breakers.add_affected('https://cucm', 'Schedule 1')
+    clock.advance(30)
+    assert breakers.allow('https://cucm')
+    breakers.failure('https://cucm', 'HTTP 503')
+    assert len(opened) == 1
+    assert opened[0][0] == 'https://cucm'
+    clock.advance(30)
+    assert breakers.allow('https://cucm')
+    breakers.success('https://cucm')
+    assert len(closed) == 1
+    assert closed[0][3] == ['Schedule 1']
+    assert not breakers.is_open('https://cucm')
+
+
+def test_session_fails_fast_while_the_upstream_is_down(clock):
+    breakers = CircuitBreakers(failure_threshold=2, reset_timeout=30, clock=clock)
+    adapter = StatusAdapter(500)
+    session = make_session(adapter, breakers)
+    for _ in range(2):
+        assert session.get('http://pagerduty/oncalls').status_code == 500
+    assert breakers.is_open('http://pagerduty')
+    with pytest.raises(UpstreamUnavailable):
+        session.get('http://pagerduty/oncalls')
+    # The rejected request never reached the upstream
+    assert adapter.sent == 2
+    adapter.status = 200
+    clock.advance(30)
+    assert session.get('http://pagerduty/oncalls').status_code == 200
+    assert not breakers.is_open('http://pagerduty')
+
+
+def test_axl_faults_do_not_open_the_breaker(clock):
+    breakers = CircuitBreakers(failure_threshold=1, clock=clock)
+    session = make_session(
+        StatusAdapter(500), breakers, upstream='http://cucm/axl/',
+        failure_statuses=axl_failure_statuses
+    )
+    session.post('http://cucm/axl/')
+    assert not breakers.is_open('http://cucm/axl/')
+
+
+def test_session_breaks_on_connection_errors(clock):
+    breakers = CircuitBreakers(failure_threshold=1, clock=clock)
+    session = make_session(StatusAdapter(None), breakers)
+    with pytest.raises(exceptions.ConnectionError):
+        session.get('http://cucm/axl/')
+    with pytest.raises(UpstreamUnavailable):
+        session.get('http://cucm/axl/')
+
+
+def test_default_timeout_is_applied(clock):
+    adapter = StatusAdapter()
+    session = make_session(
+        adapter, CircuitBreakers(clock=clock), timeout=(5, 30))
+    for timeout in (None, 2):
+        session.get('http://cucm/axl/', timeout=timeout)
+    assert adapter.timeouts == [(5, 30), 2]
+
+
+def test_open_breaker_does_not_wait_for_a_rate_limit_token(clock):
+    clock.tick = 1
+    limiter = RateLimiter(rate=1, max_rate=1, clock=clock)
+    client = PagerDutyClient(rate_limiter=limiter)
+    # Answer below the rate limiter of the client
+    adapter = StatusAdapter(503)
+    client.get_adapter('http://').adapter = adapter
+    # The clock ticks for the limiter, the breaker stays open throughout
+    breakers = CircuitBreakers(
+        failure_threshold=2, reset_timeout=3600, clock=clock)
+    protect_session(client, breakers)
+    for _ in range(2):
+        client.get('http://pagerduty/oncalls')
+    bucket = limiter.get_bucket(None)
+    assert bucket.sent == 2
+    for _ in range(50):
+        with pytest.raises(UpstreamUnavailable):
+            client.get('http://pagerduty/oncalls')
+    assert bucket.sent == 2
+    assert adapter.sent == 2
@@ -0,0 +1,42 @@
+import pytest
+from config import compile_schedule
+from custom_exceptions import ConfigError
+
+
+def make_schedule(**changes):
+    schedule = {
+        'pd_summary': 'Networks',
+        'mail_rcpt': ['support@example.com'],
+        'pd_api_host': 'https://api.pagerduty.com',
+        'pd_api_headers': {'Authorization': 'Token token=token'},
+        'contact_method': 'Mobile',
+        'numbers': {'country_code': {'44': {
+            'on_call_number': '+442078184888',
+            'on_call_partition': 'PAR_RESOURCES',
+            'regex': '^(?:\\+44|90)?(\\d+)$'
+        }}}
+    }
+    schedule.update(changes)
+    return schedule
+
+
+def test_a_valid_schedule_is_compiled():
+    schedule = compile_schedule('S1', make_schedule())
+    assert schedule.mail_rcpt == ('support@example.com',)
+    assert schedule.numbers[44].pattern == '\\+442078184888'
+
+
+@pytest.mark.parametrize('mail_rcpt', [
+    'support@example.com', None, ['support@example.com', 1]
+])
+def test_mail_rcpt_must_be_a_list_of_addresses(mail_rcpt):
+    with pytest.raises(ConfigError, match='mail_rcpt'):
+        compile_schedule('S1', make_schedule(mail_rcpt=mail_rcpt))
+
+
+@pytest.mark.parametrize('numbers', [
+    [], {'country_code': ['44']}, {'country_code': {'44': '+442078184888'}}
+])
+def test_numbers_must_be_objects(numbers):
+    with pytest.raises(ConfigError):
+        compile_schedule('S1', make_schedule(numbers=numbers))
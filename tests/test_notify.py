@@ -0,0 +1,75 @@
+from smtplib import SMTPServerDisconnected
+from notify import NotificationDispatcher
+
+
+class FakeSmtp():
+    # Records the messages sent, raising the queued errors first
+
+    def __init__(self, errors=()):
+        self.errors = list(errors)
+        self.messages = []
+
+    def __call__(self, host, port):
+        return self
+
+    def sendmail(self, sender, recipients, msg):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.messages.append((recipients, msg))
+
+    def noop(self):
+        pass
+
+    def quit(self):
+        pass
+
+
+def make_dispatcher(smtp, **kwargs):
+    return NotificationDispatcher(
+        'smtp', 25, 'sender@example.com', smtp_factory=smtp, backoff=0,
+        **kwargs
+    )
+
+
+def test_notifications_are_merged_per_recipients():
+    smtp = FakeSmtp()
+    notifier = make_dispatcher(smtp, digest_window=5)
+    notifier.submit(['a@example.com'], 'First', 'One')
+    notifier.submit(['a@example.com'], 'Second', 'Two')
+    notifier.submit(['b@example.com'], 'Third', 'Three')
+    notifier.close()
+    assert sorted(r for r, _ in smtp.messages) == [
+        ['a@example.com'], ['b@example.com']]
+    assert notifier.sent == 2
+
+
+def test_delivery_failures_are_retried():
+    smtp = FakeSmtp([SMTPServerDisconnected('gone')])
+    notifier = make_dispatcher(smtp, background=False)
+    notifier.submit(['a@example.com'], 'Subject', 'Body')
+    assert len(smtp.messages) == 1
+    assert (notifier.sent, notifier.failed) == (1, 0)
+
+
+def test_a_message_that_can_not_be_built_is_dropped_alone():
+    smtp = FakeSmtp()
+    notifier = make_dispatcher(smtp, digest_window=5)
+    notifier.submit(['a@example.com'], 'Good', 'Body')
+    # An attachment payload must be bytes
+    notifier.submit(['a@example.com'], 'Bad', 'Body', [('log.gz', 1)])
+    notifier.close()
+    assert len(smtp.messages) == 1
+    assert 'Subject: Good' in smtp.messages[0][1]
+    assert (notifier.sent, notifier.failed) == (1, 1)
+
+
+def test_an_unexpected_error_does_not_stop_the_worker(caplog):
+    smtp = FakeSmtp([ValueError('can not encode')])
+    notifier = make_dispatcher(smtp, digest_window=0)
+    notifier.submit(['a@example.com'], 'First', 'Body')
+    notifier.submit(['b@example.com'], 'Second', 'Body')
+    notifier.close()
+    # Not retried, the other message is still sent
+    assert len(smtp.messages) == 1
+    assert (notifier.sent, notifier.failed) == (1, 1)
+    assert "ValueError('can not encode')" in caplog.text
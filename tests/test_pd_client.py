@@ -0,0 +1,16 @@
+import pytest
+from pd_client import get_client
+
+
+def test_clients_are_shared_by_settings():
+    assert get_client() is get_client(verify=False)
+    assert get_client(pool_size=4) is get_client(pool_size=4)
+    # Later settings are never silently ignored
+    client = get_client(verify=True, retries=1)
+    assert client is not get_client()
+    assert client.verify is True
+
+
+def test_unknown_settings_are_rejected():
+    with pytest.raises(TypeError):
+        get_client(timeout=5)
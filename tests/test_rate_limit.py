@@ -0,0 +1,151 @@
+import io
+import time
+import pytest
+from email.utils import formatdate
+from requests import Response, Session
+from requests.adapters import BaseAdapter
+from pd_client import PagerDutyClient, RateLimitAdapter
+from rate_limit import AdaptiveBucket, RateLimiter, parse_retry_after
+
+
+class ScriptedAdapter(BaseAdapter):
+    # Answers each request with the next status code of "statuses"
+
+    def __init__(self, statuses, headers=None):
+        super().__init__()
+        self.statuses = list(statuses)
+        self.headers = headers or {}
+        self.sent = 0
+
+    def send(self, request, **kwargs):
+        self.sent += 1
+        response = make_response(self.statuses.pop(0), self.headers)
+        response.request = request
+        response.url = request.url
+        return response
+
+    def close(self):
+        pass
+
+
+def make_response(status_code, headers=None):
+    response = Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    response.raw = io.BytesIO(b'')
+    return response
+
+
+def make_bucket(clock, rate=20, max_rate=50, concurrency=8, max_concurrency=32):
+    return AdaptiveBucket(
+        rate, max_rate, concurrency, max_concurrency, clock=clock)
+
+
+def test_parse_retry_after():
+    assert parse_retry_after('2', 5) == 2
+    assert parse_retry_after('-1', 5) == 0
+    assert parse_retry_after(None, 5) == 5
+    assert parse_retry_after('soon', 5) == 5
+    assert 8 <= parse_retry_after(formatdate(time.time() + 10, usegmt=True), 5) <= 10
+
+
+def test_tokens_pace_the_requests(clock):
+    bucket = make_bucket(clock, rate=2)
+    assert bucket.try_acquire() == 0
+    assert bucket.try_acquire() == pytest.approx(0.5)
+    clock.advance(0.5)
+    assert bucket.try_acquire() == 0
+
+
+def test_429_halves_the_rate_and_pauses(clock):
+    bucket = make_bucket(clock)
+    assert bucket.try_acquire() == 0
+    bucket.release(make_response(429, {'Retry-After': '30'}))
+    assert bucket.rate == 10
+    assert bucket.limit == 4
+    assert bucket.limited == 1
+    # Nothing is sent until the "Retry-After" has passed
+    assert bucket.try_acquire() == pytest.approx(30)
+    clock.advance(30)
+    assert bucket.try_acquire() == 0
+
+
+def test_429_without_retry_after_uses_the_default(clock):
+    bucket = make_bucket(clock)
+    bucket.try_acquire()
+    bucket.release(make_response(429))
+    assert bucket.try_acquire() == pytest.approx(5)
+
+
+def test_successes_raise_the_rate_up_to_the_maximum(clock):
+    bucket = make_bucket(clock, rate=2, max_rate=3, concurrency=1,
+                         max_concurrency=2)
+    for _ in range(20):
+        bucket.in_flight += 1
+        bucket.release(make_response(200))
+    assert bucket.rate == 3
+    assert bucket.limit == 2
+
+
+def test_rate_limit_headers_cap_the_rate(clock):
+    bucket = make_bucket(clock, rate=10)
+    bucket.in_flight += 1
+    bucket.release(make_response(
+        200, {'ratelimit-remaining': '10', 'ratelimit-reset': '5'}))
+    assert bucket.rate == 2
+    # No allowance left pauses the bucket until the window resets
+    bucket.in_flight += 1
+    bucket.release(make_response(
+        200, {'ratelimit-remaining': '0', 'ratelimit-reset': '60'}))
+    assert bucket.try_acquire() == pytest.approx(60)
+
+
+def test_concurrency_is_limited(clock):
+    bucket = make_bucket(clock, rate=1000, concurrency=1, max_concurrency=1)
+    assert bucket.try_acquire() == 0
+    # Waits for a release, not for a time
+    assert bucket.try_acquire() is None
+    bucket.release(make_response(200))
+    clock.advance(1)
+    assert bucket.try_acquire() == 0
+
+
+def test_buckets_are_per_token(clock):
+    limiter = RateLimiter(clock=clock)
+    assert limiter.get_bucket('Token token=a') is limiter.get_bucket('Token token=a')
+    assert limiter.get_bucket('Token token=a') is not limiter.get_bucket('Token token=b')
+
+
+def test_client_retries_rate_limited_requests(clock):
+    clock.tick = 1
+    limiter = RateLimiter(rate=10, max_retries=5, clock=clock)
+    adapter = ScriptedAdapter([429, 429, 200], {'Retry-After': '0.5'})
+    client = Session()
+    client.mount('http://', RateLimitAdapter(adapter, limiter))
+    response = client.get(
+        'http://pagerduty/oncalls',
+        headers={'Authorization': 'Token token=test'}
+    )
+    assert response.status_code == 200
+    assert adapter.sent == 3
+    bucket = limiter.get_bucket('Token token=test')
+    assert bucket.limited == 2
+    assert bucket.rate < 10
+
+
+def test_client_gives_up_after_max_retries(clock):
+    clock.tick = 1
+    limiter = RateLimiter(max_retries=1, clock=clock)
+    adapter = ScriptedAdapter([429, 429, 200], {'Retry-After': '0.5'})
+    client = Session()
+    client.mount('http://', RateLimitAdapter(adapter, limiter))
+    response = client.get('http://pagerduty/oncalls')
+    assert response.status_code == 429
+    assert adapter.sent == 2
+
+
+def test_client_mounts_the_rate_limiter():
+    client = PagerDutyClient(rate_limiter=RateLimiter())
+    assert isinstance(client.get_adapter('https://api.pagerduty.com'), RateLimitAdapter)
+    client = PagerDutyClient()
+    assert not isinstance(client.get_adapter('https://api.pagerduty.com'), RateLimitAdapter)
@@ -0,0 +1,116 @@
+import logging
+import threading
+from shard import LeaseStore, shard_of, in_shard
+
+
+def make_stores(tmp_path, ttl=900, clock=None):
+    path = str(tmp_path / 'leases.db')
+    kwargs = {'clock': clock} if clock else {}
+    return (
+        LeaseStore(path, ttl, owner='a', **kwargs),
+        LeaseStore(path, ttl, owner='b', **kwargs)
+    )
+
+
+def test_a_held_key_blocks_every_group_using_it(tmp_path):
+    a, b = make_stores(tmp_path)
+    assert a.acquire({'S1': ['schedule:S1', 'line:x']}) == {'S1'}
+    # S2 shares the pilot line of S1, S3 does not
+    acquired = b.acquire({
+        'S2': ['schedule:S2', 'line:x'],
+        'S3': ['schedule:S3', 'line:y']
+    })
+    assert acquired == {'S3'}
+    # The group is all or nothing, no key of S2 was taken
+    assert a.acquire({'S2': ['schedule:S2']}) == {'S2'}
+
+
+def test_release_only_frees_the_owners_leases(tmp_path):
+    a, b = make_stores(tmp_path)
+    groups = {'S1': ['schedule:S1', 'line:x']}
+    a.acquire(groups)
+    b.release(groups)
+    assert b.acquire(groups) == set()
+    a.release(groups)
+    assert b.acquire(groups) == {'S1'}
+
+
+def test_an_expired_lease_is_taken_over_and_reported_lost(tmp_path, clock):
+    a, b = make_stores(tmp_path, ttl=60, clock=clock)
+    groups = {'S1': ['schedule:S1', 'line:x']}
+    a.acquire(groups)
+    clock.advance(60)
+    assert b.acquire(groups) == set()
+    clock.advance(1)
+    assert b.acquire(groups) == {'S1'}
+    assert a.renew(groups) == {'S1'}
+    assert b.renew(groups) == set()
+
+
+def test_renew_holds_the_leases_past_the_ttl(tmp_path, clock):
+    a, b = make_stores(tmp_path, ttl=60, clock=clock)
+    groups = {'S1': ['schedule:S1', 'line:x']}
+    a.acquire(groups)
+    clock.advance(50)
+    assert a.renew(groups) == set()
+    clock.advance(50)
+    assert b.acquire(groups) == set()
+
+
+def test_keep_alive_logs_lost_leases(tmp_path, clock, caplog):
+    # Renewed every third of the ttl, so within milliseconds
+    a, b = make_stores(tmp_path, ttl=0.03, clock=clock)
+    groups = {'S1': ['schedule:S1', 'line:x']}
+    a.acquire(groups)
+    clock.advance(1)
+    b.acquire(groups)
+    renewed = threading.Event()
+    renew = a.renew
+
+    def spy(groups):
+        lost = renew(groups)
+        renewed.set()
+        return lost
+
+    a.renew = spy
+    with caplog.at_level(logging.ERROR, logger='on_call_forward'):
+        with a.keep_alive(groups):
+            assert renewed.wait(5)
+    assert 'The leases of S1 were taken by another worker' in caplog.text
+
+
+def test_concurrent_owners_never_share_a_group(tmp_path):
+    a, b = make_stores(tmp_path)
+    groups = dict(
+        ('S{}'.format(i), ['schedule:S{}'.format(i), 'line:{}'.format(i % 7)])
+        for i in range(50)
+    )
+    acquired = {}
+
+    def take(store):
+        acquired[store.owner] = set()
+        for name in groups:
+            acquired[store.owner] |= store.acquire({name: groups[name]})
+
+    threads = [threading.Thread(target=take, args=(s,)) for s in (a, b)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # No pilot line is leased by both owners
+    lines = dict(
+        (owner, set(groups[name][1] for name in names))
+        for owner, names in acquired.items()
+    )
+    assert not lines['a'] & lines['b']
+
+
+def test_every_key_belongs_to_exactly_one_shard():
+    keys = ['P{:06d}'.format(i) for i in range(200)]
+    for key in keys:
+        assert sum(in_shard(key, (i, 4)) for i in range(4)) == 1
+        assert in_shard(key, None)
+    # Adding a shard only moves keys to the new shard
+    for key in keys:
+        if shard_of(key, 4) != shard_of(key, 5):
+            assert shard_of(key, 5) == 4
@@ -0,0 +1,101 @@
+import threading
+import pytest
+from json import dumps
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+from webhook import WebhookServer, extract_schedule_ids, send_test_event, \
+    sign_payload, verify_signature
+
+secret = 'test-secret'
+
+
+class Recorder():
+    # Collects the coalesced callbacks of the server
+
+    def __init__(self):
+        self.calls = []
+        self.called = threading.Event()
+
+    def __call__(self, schedule_ids):
+        self.calls.append(schedule_ids)
+        self.called.set()
+
+
+@pytest.fixture
+def recorder():
+    return Recorder()
+
+
+@pytest.fixture
+def server(recorder):
+    server = WebhookServer(
+        ('127.0.0.1', 0), secret, recorder, debounce=0.5, max_delay=5,
+        max_body_size=1024
+    )
+    server.url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    server.start()
+    yield server
+    server.stop()
+
+
+def post(url, body, signature):
+    request = Request(url, data=body, method='POST', headers={
+        'Content-Type': 'application/json',
+        'X-PagerDuty-Signature': signature
+    })
+    try:
+        with urlopen(request) as r:
+            return r.status
+    except HTTPError as e:
+        return e.code
+
+
+def test_verify_signature():
+    body = b'{"event": {}}'
+    assert verify_signature(secret, body, sign_payload(secret, body))
+    # Any of the signatures sent while a secret is rotated may match
+    assert verify_signature(
+        secret, body, 'v1=0000, ' + sign_payload(secret, body))
+    assert not verify_signature(secret, body, sign_payload('other', body))
+    assert not verify_signature(secret, body, None)
+
+
+def test_extract_schedule_ids():
+    data = {
+        'schedules': [{'id': 'S1', 'type': 'schedule_reference'}],
+        'incident': {'service': {'id': 'P1', 'type': 'service_reference'}},
+        'schedule': {'id': 'S2', 'type': 'schedule'}
+    }
+    assert extract_schedule_ids(data) == {'S1', 'S2'}
+
+
+def test_a_valid_signature_is_accepted(server, recorder):
+    assert send_test_event(server.url, secret, ['S1']) == 202
+    assert recorder.called.wait(5)
+    assert recorder.calls == [['S1']]
+
+
+def test_a_bad_signature_is_rejected(server, recorder):
+    with pytest.raises(HTTPError) as e:
+        send_test_event(server.url, 'other-secret', ['S1'])
+    assert e.value.code == 401
+    assert not server.coalescer.pending
+
+
+def test_an_oversized_body_is_rejected(server):
+    body = dumps({'event': {'data': 'x' * 2048}}).encode()
+    assert post(server.url, body, sign_payload(secret, body)) == 413
+
+
+@pytest.mark.parametrize('body', [
+    b'not json', b'[]', b'{"event": ["S1"]}', b'{"event": "S1"}', b'{}'
+])
+def test_a_malformed_event_is_rejected(server, body):
+    assert post(server.url, body, sign_payload(secret, body)) == 400
+
+
+def test_repeated_events_are_coalesced(server, recorder):
+    for schedule_ids in (['S1'], ['S2', 'S1'], ['S1']):
+        assert send_test_event(server.url, secret, schedule_ids) == 202
+    assert recorder.called.wait(5)
+    assert recorder.calls == [['S1', 'S2']]
@@ -0,0 +1,205 @@
+import hashlib
+import hmac
+import logging
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from json import loads, dumps
+from urllib.request import Request, urlopen
+
+
+def sign_payload(secret, body):
+    # The PagerDuty v3 webhook signature of a raw request body
+    return 'v1=' + hmac.new(
+        secret.encode(), body, hashlib.sha256
+    ).hexdigest()
+
+
+def verify_signature(secret, body, header):
+    # The header may hold several comma separated signatures while
+    # a secret is being rotated, any one of them may match
+    if not header:
+        return False
+    expected = sign_payload(secret, body)
+    return any(
+        hmac.compare_digest(expected, signature.strip())
+        for signature in header.split(',')
+    )
+
+
+def extract_schedule_ids(value):
+    # Walk the event data and collect the ids of any schedules it refers to
+    ids = set()
+    if isinstance(value, dict):
+        if value.get('type') in ('schedule', 'schedule_reference') \
+                and value.get('id'):
+            ids.add(value['id'])
+        for v in value.values():
+            ids |= extract_schedule_ids(v)
+    elif isinstance(value, list):
+        for v in value:
+            ids |= extract_schedule_ids(v)
+    return ids
+
+
+class Coalescer():
+
+    def __init__(self, callback, debounce=2, max_delay=10):
+        # Called with a sorted list of schedule ids
+        self.callback = callback
+        # Flush once no new ids have arrived for this many seconds
+        self.debounce = debounce
+        # Flush at the latest this many seconds after the first id arrived
+        self.max_delay = max_delay
+        self.pending = set()
+        self.first_added = None
+        self.last_added = None
+        self.lock = threading.Lock()
+        self.wake_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def add(self, schedule_ids):
+        now = time.monotonic()
+        with self.lock:
+            if not self.pending:
+                self.first_added = now
+            self.pending |= set(schedule_ids)
+            self.last_added = now
+        self.wake_event.set()
+
+    def flush_time(self):
+        # The time the pending ids should be flushed, the lock must be held
+        return min(
+            self.last_added + self.debounce,
+            self.first_added + self.max_delay
+        )
+
+    def run(self):
+        while not self.stop_event.is_set():
+            with self.lock:
+                timeout = None
+                if self.pending:
+                    timeout = self.flush_time() - time.monotonic()
+                    if timeout <= 0:
+                        schedule_ids = sorted(self.pending)
+                        self.pending = set()
+                        timeout = None
+                    else:
+                        schedule_ids = None
+                else:
+                    schedule_ids = None
+            if schedule_ids:
+                self.callback(schedule_ids)
+                continue
+            self.wake_event.wait(timeout)
+            self.wake_event.clear()
+
+    def stop(self):
+        self.stop_event.set()
+        self.wake_event.set()
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        # Check the length before reading, the body is not authenticated
+        # until its signature is verified
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            return self.reject(400)
+        if length > self.server.max_body_size:
+            self.server.logger.info(
+                'Rejected a webhook of {} bytes'.format(length))
+            return self.reject(413)
+        body = self.rfile.read(length)
+        if not verify_signature(
+            self.server.secret, body,
+            self.headers.get('X-PagerDuty-Signature')
+        ):
+            self.server.logger.info('Rejected a webhook with a bad signature')
+            self.send_response(401)
+            self.end_headers()
+            return
+        try:
+            event = loads(body.decode())['event']
+        except (ValueError, KeyError, TypeError):
+            event = None
+        if not isinstance(event, dict):
+            self.send_response(400)
+            self.end_headers()
+            return
+        schedule_ids = extract_schedule_ids(event.get('data'))
+        self.server.logger.info(
+            'Received webhook event "{}" for schedules {}'.format(
+                event.get('event_type'), sorted(schedule_ids))
+        )
+        if schedule_ids:
+            self.server.coalescer.add(schedule_ids)
+        self.send_response(202)
+        self.end_headers()
+
+    def reject(self, code):
+        # The body was not read, so the connection can not be reused
+        self.close_connection = True
+        self.send_response(code)
+        self.send_header('Connection', 'close')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        self.server.logger.debug(format % args)
+
+
+class WebhookServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(
+        self, address, secret, on_schedules, debounce=2, max_delay=10,
+        max_body_size=1048576
+    ):
+        super().__init__(address, WebhookHandler)
+        # The webhook subscription signing secret
+        self.secret = secret
+        # Larger requests are rejected without being read
+        self.max_body_size = max_body_size
+        # Bursts of events are merged before "on_schedules" is called
+        self.coalescer = Coalescer(on_schedules, debounce, max_delay)
+        self.logger = logging.getLogger('on_call_forward')
+
+    def start(self):
+        # Serve requests on a background thread
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.shutdown()
+        self.coalescer.stop()
+        self.server_close()
+
+
+def send_test_event(url, secret, schedule_ids, event_type='pagey.ping'):
+    # Send a signed event referring to "schedule_ids" to a receiver,
+    # acting as a local stand in for PagerDuty
+    body = dumps({
+        'event': {
+            'event_type': event_type,
+            'data': {
+                'schedules': [
+                    {'id': s, 'type': 'schedule_reference'}
+                    for s in schedule_ids
+                ]
+            }
+        }
+    }).encode()
+    request = Request(url, data=body, method='POST', headers={
+        'Content-Type': 'application/json',
+        'X-PagerDuty-Signature': sign_payload(secret, body)
+    })
+    with urlopen(request) as r:
+        return r.status